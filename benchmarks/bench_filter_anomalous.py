@@ -0,0 +1,98 @@
+# Benchmark of align_road.filter_anomalous_points against the original per-point walk.
+# Usage: python benchmarks/bench_filter_anomalous.py --roads 200 --points 1200
+import os
+import sys
+import time
+import types
+import argparse
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(SRC_DIR)
+# stage2/__init__.py 会导入依赖 bpy 的 export_glb。这里注册一个不执行 __init__ 的 stage2 包，
+# 使 align_road 可以在 Blender 之外的普通 Python 中导入（仍需 requirements.txt 中的依赖）
+stage2 = types.ModuleType("stage2")
+stage2.__path__ = [os.path.join(SRC_DIR, "stage2")]
+sys.modules["stage2"] = stage2
+from stage2.align_road import filter_anomalous_points
+
+
+def filter_anomalous_points_loop(points, height_diff=0.5, height_diff_max=0.8, future_points_num=10, future_points_ratio=0.8,
+                                 bounded_lookahead=True):
+    """
+    The original walk from the lowest point. With bounded_lookahead=False the look-ahead counter is never
+    incremented, as before, and every rejected point rescans all the way to the road's end.
+    """
+    loc_list = points[:, [0, 2]]
+    height_list = points[:, 1]
+    lowest_point_index = np.argmin(height_list)
+    points_valid = [False] * len(points)
+    points_valid[lowest_point_index] = True
+    for direction in (-1, 1):
+        last_height, last_loc = height_list[lowest_point_index], loc_list[lowest_point_index]
+        index = lowest_point_index + direction
+        while 0 <= index < len(points):
+            new_height, new_loc = height_list[index], loc_list[index]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = abs(new_height - last_height) / np.linalg.norm(last_loc - new_loc)
+            if slope <= height_diff and abs(new_height - last_height) < height_diff_max:
+                last_height, last_loc = new_height, new_loc
+                points_valid[index] = True
+            elif abs(new_height - last_height) <= height_diff_max:
+                checked_future_points = 0
+                valid_future_points = 0
+                j = index
+                while checked_future_points < future_points_num and 0 <= j + direction < len(points):
+                    j += direction
+                    if bounded_lookahead:
+                        checked_future_points += 1
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        if abs(new_height - height_list[j]) / np.linalg.norm(loc_list[j] - loc_list[j - direction]) <= height_diff:
+                            valid_future_points += 1
+                if valid_future_points >= future_points_ratio * future_points_num:
+                    last_height, last_loc = new_height, new_loc
+                    points_valid[index] = True
+            index += direction
+    return points[np.array(points_valid)]
+
+
+def make_road(rng, num_points, length=2000.0):
+    """A long arterial road: gentle grade, small noise and occasional spikes from cars, trees and bridges."""
+    t = np.linspace(0.0, length, num_points)
+    heading = rng.uniform(0, 2 * np.pi)
+    x, z = t * np.cos(heading), t * np.sin(heading)
+    y = -0.01 * t + rng.normal(0.0, 0.05, num_points)
+    spikes = rng.random(num_points) < 0.1
+    y[spikes] -= rng.uniform(0.3, 6.0, spikes.sum())
+    return np.column_stack((x, y, z))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roads", type=int, default=200, help="Number of roads")
+    parser.add_argument("--points", type=int, default=1200, help="Samples per road")
+    parser.add_argument("--unbounded", action="store_true", help="Also time the original unbounded look-ahead")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    roads = [make_road(rng, args.points) for _ in range(args.roads)]
+    print(f"Roads: {args.roads}  samples per road: {args.points}")
+
+    start = time.perf_counter()
+    expected = [filter_anomalous_points_loop(road) for road in roads]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = [filter_anomalous_points(road) for road in roads]
+    fast_time = time.perf_counter() - start
+
+    for a, b in zip(expected, result):
+        assert np.array_equal(a, b)
+    print(f"loop: {loop_time:.2f}s  single-pass: {fast_time:.2f}s  speedup: {loop_time / fast_time:.1f}x")
+
+    if args.unbounded:
+        start = time.perf_counter()
+        for road in roads:
+            filter_anomalous_points_loop(road, bounded_lookahead=False)
+        print(f"unbounded look-ahead loop: {time.perf_counter() - start:.2f}s")
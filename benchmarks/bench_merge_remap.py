@@ -0,0 +1,48 @@
+# Benchmark of the axis remap in merge.py: per-vertex loop vs foreach_get/foreach_set.
+# Usage: blender -b --python benchmarks/bench_merge_remap.py -- --subdivisions 1700
+import os
+import sys
+import time
+import argparse
+import bpy
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from merge import remap_vertices_loop, remap_vertices_bulk
+
+
+def make_grid(name, subdivisions):
+    bpy.ops.mesh.primitive_grid_add(x_subdivisions=subdivisions, y_subdivisions=subdivisions, size=800)
+    obj = bpy.context.active_object
+    obj.name = name
+    return obj
+
+
+def read_co(obj):
+    co = np.empty(len(obj.data.vertices) * 3, dtype=np.float32)
+    obj.data.vertices.foreach_get("co", co)
+    return co.reshape(-1, 3)
+
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subdivisions", type=int, default=1700, help="Grid subdivisions per side (1700 ~ 2.9M verts)")
+    args = parser.parse_args(argv)
+
+    bpy.ops.object.select_all(action='SELECT')
+    bpy.ops.object.delete(use_global=False)
+    loop_obj = make_grid("Loop", args.subdivisions)
+    bulk_obj = make_grid("Bulk", args.subdivisions)
+    print(f"Vertices: {len(loop_obj.data.vertices)}")
+
+    start = time.perf_counter()
+    remap_vertices_loop(loop_obj)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    remap_vertices_bulk(bulk_obj)
+    bulk_time = time.perf_counter() - start
+
+    assert np.allclose(read_co(loop_obj), read_co(bulk_obj), atol=1e-4)
+    print(f"loop: {loop_time:.2f}s  bulk: {bulk_time:.2f}s  speedup: {loop_time / bulk_time:.1f}x")
@@ -93,6 +93,10 @@ single_tag="${tagroot}/${scene_name}/single_glb_done.txt"
 pano_download_tag="${tagroot}/${scene_name}/pano_download_done.txt"
 inpaint_done_tag="${tagroot}/${scene_name}/inpaint_done.txt"
 detached_tag="${tagroot}/${scene_name}/detached_done.txt"
+# Scene center and radius (meters), shared by every stage
+scene_lat="39.894954"
+scene_lng="116.313162"
+scene_rad="400"
 # INPUT
 tileset_json="${tmproot}/${scene_name}/original_data/tileset.json"
 osm_blender_file="${tmproot}/${scene_name}/osm_buildings/clean_osm.blend"
@@ -103,6 +107,7 @@ glb_file="${dataroot}/${scene_name}/${scene_name}.glb"
 merged_blend="${dataroot}/${scene_name}/${scene_name}_merged.blend"
 masked_blend="${dataroot}/${scene_name}/${scene_name}_masked.blend"
 ref_ground_file="${dataroot}/${scene_name}/street_view_loc_clean_all.pkl"
+road_index_dir="${dataroot}/${scene_name}/road_index"
 terrain_blender_file="${dataroot}/${scene_name}/${scene_name}_terrain.blend"
 height_field_file="${dataroot}/${scene_name}/${scene_name}_height_field.npz"
 baked_terrain_file="${dataroot}/${scene_name}/${scene_name}_baked_terrain.blend"
@@ -124,29 +129,51 @@ echo "dataroot=$dataroot"
 echo "scene_name=$scene_name"
 echo "tileset_json=$tileset_json"
 # stage0:fetch single glb
-if [[ ! -f "$single_tag" ]]; then
-  python ./src/fetch_single_glb.py \
-    --tileset ${tileset_json} \
-    --outdir ${tmproot}/${scene_name}/extracted_single_glbs \
-    --tag ${single_tag} 
-
-  status=$?
-  if [[ $status -eq 0 ]]; then
-    write_color_output green "    [OK ] Fetching Single Done."
-    # 继续后续流程...
-  else
-    write_color_output red "    [ERR] Fetching Single Failed, stopping."
-    exit 1
+# 每次运行都执行：提取清单按 size / mtime 复用旧哈希，未变化的瓦片不会重新复制，
+# 只有瓦片有增删改时才让下游产物失效并重新生成
+python ./src/fetch_single_glb.py \
+  --tileset ${tileset_json} \
+  --outdir ${tmproot}/${scene_name}/extracted_single_glbs \
+  --tag ${single_tag} \
+  --lat ${scene_lat} \
+  --lng ${scene_lng} \
+  --rad ${scene_rad}
+
+status=$?
+if [[ $status -eq 0 ]]; then
+  write_color_output green "    [OK ] Fetching Single Done."
+  # 瓦片有增删改时，所有由合并网格派生的产物都需要重新生成（各 stage 均以产物是否存在决定是否跳过）
+  tile_diff="${tmproot}/${scene_name}/extracted_single_glbs/manifest_diff.json"
+  if python -c "import json,sys; sys.exit(0 if json.load(open('$tile_diff'))['changed_count'] else 1)"; then
+    mesh_derived=(
+      "$merged_blend" "${merged_blend%.blend}.glb"
+      "$masked_blend" "${tmproot}/aligned.glb" "${tmproot}/aligned_height_field.npy" "${tmproot}/aligned_height_field.json"
+      "$ref_ground_file" "$road_index_dir"
+      "$terrain_blender_file" "$height_field_file" "$baked_terrain_file" "$baked_osm_file"
+      "${dataroot}/${scene_name}"/bake_osm_*_height_field.npy "${dataroot}/${scene_name}"/bake_osm_*_height_field.json
+      "$pano_file" "$with_camera_blender_file" "$solve_result_file" "$solved_csv_file"
+      "$pano_download_tag" "$detached_tag" "$inpaint_done_tag"
+      "$projected_file" "$inpainted_terrain" "$inpainted_buildings"
+      "${tagroot}/${scene_name}/ground_inpaint_done.txt" "${tagroot}/${scene_name}/building_inpaint_done.txt"
+      "$combined_blender_file" "$aabb_file" "${dataroot}/${scene_name}/roof_basic.glb"
+    )
+    rm -rf "${mesh_derived[@]}"
+    write_color_output yellow "    [WRN] Tiles changed, every stage derived from the merged mesh will be rebuilt."
   fi
+  # 继续后续流程...
 else
-  write_color_output blue "    [Ign] Fetching Single Skip."
+  write_color_output red "    [ERR] Fetching Single Failed, stopping."
+  exit 1
 fi
 
 # stage1:merge glbs to one and align to center
 if [[ ! -f "$merged_blend" ]]; then
   "$blender" -b --python ./src/merge.py -- \
     --input_dir ${tmproot}/${scene_name}/extracted_single_glbs \
-    --output_file ${merged_blend}
+    --output_file ${merged_blend} \
+    --engine numpy \
+    --weld_distance 0.001 \
+    --crop_rad ${scene_rad}
 
   if [[ -f "$merged_blend" ]]; then
     write_color_output green "    [OK ] Merging Done." 
@@ -165,10 +192,12 @@ if [[ ! -f "$masked_blend" ]]; then
     --input_blender_path ${merged_blend} \
     --mask_output_path ${masked_blend} \
     --glb_output_path ${tmproot}/${scene_name} \
-    --lat 39.894954 \
-    --lng 116.313162 \
-    --rad 400\
-    --ref_ground_output_path ${ref_ground_file}
+    --lat ${scene_lat} \
+    --lng ${scene_lng} \
+    --rad ${scene_rad} \
+    --ref_ground_output_path ${ref_ground_file} \
+    --road_index_path ${road_index_dir} \
+    --osm_cache_dir ${tmproot}/${scene_name}/osm_cache
   if [[ -f "$masked_blend" ]]; then
     write_color_output green "    [OK ] Mask Done." 
     # 继续后续流程...
@@ -180,11 +209,17 @@ else
   write_color_output blue "    [Ign] Mask Skip."
 fi
 
+# 后续 stage 优先以 mmap 方式读取 stage 2 的道路索引，旧的产物只有 pickle 时沿用 pickle
+ground_ref="$ref_ground_file"
+if [[ -f "${road_index_dir}/meta.json" ]]; then
+  ground_ref="$road_index_dir"
+fi
+
 # stage3:build terrain
 if [[ ! -f "$terrain_blender_file" ]]; then
   "$blender" -b --python ./src/export_terrain.py -- \
-    --rad "400" \
-    --ground_points_ref "$ref_ground_file" \
+    --rad "${scene_rad}" \
+    --ground_points_ref "$ground_ref" \
     --save_dir "$terrain_blender_file"
   if [[ -f "$terrain_blender_file" ]]; then
     write_color_output green "    [OK ] Build Terrain Done."
@@ -199,7 +234,7 @@ fi
 # stage4:export height field
 if [[ ! -f "$height_field_file" ]]; then
   "$blender" -b --python ./src/export_height_field.py -- \
-    --ground_points_ref "$ref_ground_file" \
+    --ground_points_ref "$ground_ref" \
     --save_dir "$height_field_file"
   if [[ -f "$height_field_file" ]]; then
     write_color_output green "    [OK ] Export Height Field Done."
@@ -250,8 +285,8 @@ if [[ ! -f "$pano_file_meta_data" || ! -f "$pano_file" ]]; then
     --work_dir $tmproot \
     --output_csv $pano_file_meta_data \
     --output_pkl "$pano_file" \
-    --lat 39.894954 \
-    --lng 116.313162 
+    --lat ${scene_lat} \
+    --lng ${scene_lng}
   if [[ -f "$pano_file_meta_data" && -f "$pano_file" ]]; then
     write_color_output green "    [OK ] Fetching StreetView Meta Done."
   else
@@ -417,7 +452,7 @@ if [[ ! -f "$aabb_file" ]]; then
     --building_file "$combined_blender_file" \
     --exclude_names "Roof" "Terrain" \
     --save_as "$aabb_file" \
-    --circle "39.894954" "116.313162" "400"
+    --circle "${scene_lat}" "${scene_lng}" "${scene_rad}"
   write_color_output green "    [OK ] Building meta & AABB generation done."
 else
   write_color_output yellow "    [Ign] Skip generating metadata & AABB."
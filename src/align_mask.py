@@ -8,11 +8,13 @@ import pickle
 from datetime import datetime
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
+from road_index import RoadIndex
 from stage2 import (
     export_glb,
     align_road,
     smooth_sampled_points,
     create_masks,
+    build_road_raster,
     cut_selected_mesh_xz
 )
 
@@ -22,36 +24,82 @@ if __name__ == "__main__":
     else:
         sys.argv = [""] + sys.argv[sys.argv.index("--") + 1:]
     parser = argparse.ArgumentParser(description="Align and create masks for scene reconstruction")
-    parser.add_argument("--input_blender_path", type=str, required=True, help="Path to the input .glb file")
+    parser.add_argument("--input_blender_path", type=str, required=True, help="Path to the merged .blend file, or the merged .glb from glb_merge.py")
     parser.add_argument("--mask_output_path", type=str, required=True, help="Path to save the mask output")
     parser.add_argument("--glb_output_path", type=str, required=True, help="Path to save the aligned .glb file")
     parser.add_argument("--lat", type=float, required=True, help="Latitude of the location")
     parser.add_argument("--lng", type=float, required=True, help="Longitude of the location")
     parser.add_argument("--rad", type=float, required=True, help="Radius around the location")
     parser.add_argument("--ref_ground_output_path", type=str, required=True, help="Pathto save the reference ground output")
+    parser.add_argument("--osm_cache_dir", type=str, default=None, help="Directory to cache Overpass/OSM responses in")
+    parser.add_argument("--osm_cache_ttl", type=float, default=7 * 24 * 3600, help="Seconds before a cached OSM response is refetched")
+    parser.add_argument("--offline", action="store_true", help="Only replay cached OSM responses, never touch the network")
+    parser.add_argument("--separate_osm_queries", action="store_true",
+                        help="Fetch roads, buildings and ground areas with three requests instead of one combined query")
+    parser.add_argument("--height_field_resolution", type=float, default=0.25,
+                        help="Cell size in meters of the cached surface height field; 0 casts every ray against the mesh")
+    parser.add_argument("--plane_solver", type=str, default="batched", choices=["batched", "least_squares"],
+                        help="Fit road/ground planes in one closed-form batched pass, or one SciPy least_squares per plane")
+    parser.add_argument("--ground_density", type=float, default=1.0, help="Grid spacing in meters for sampling ground areas")
+    parser.add_argument("--road_index_path", type=str, default=None,
+                        help="Directory to save the memory-mappable road index (per-type points, plane params, KD-trees) for later stages")
+    parser.add_argument("--road_raster_resolution", type=float, default=0,
+                        help="Cell size in centimeters of an optional road-corridor label raster that approximates the per-vertex lookups near corridor interiors; 0 (default) queries the KD-trees for every vertex")
+    parser.add_argument("--road_raster_path", type=str, default=None,
+                        help="Directory to save the road-corridor raster and its preview.png")
+    parser.add_argument("--mask_chunk_size", type=float, default=0,
+                        help="Side in meters of the XZ chunks the mask faces are classified in, so --mask_workers processes can classify them in parallel; not a memory saving, the mesh and its per-vertex arrays are loaded whole; 0 classifies the whole mesh at once")
+    parser.add_argument("--mask_workers", type=int, default=1,
+                        help="Worker processes forked for the chunked mask classification; 1 runs serially, 0 uses every CPU")
     args = parser.parse_args()  
-    bpy.ops.wm.open_mainfile(filepath=args.input_blender_path)
+    if args.input_blender_path.lower().endswith(".glb"):
+        # 直接读取 glb_merge.py 输出的合并 glb
+        bpy.ops.object.select_all(action='SELECT')
+        bpy.ops.object.delete(use_global=False)
+        bpy.ops.import_scene.gltf(filepath=args.input_blender_path)
+    else:
+        bpy.ops.wm.open_mainfile(filepath=args.input_blender_path)
     meshes_dir = os.path.dirname(args.glb_output_path)
     if not os.path.exists(os.path.join(meshes_dir, "aligned.glb")):
         print("Start cutting the aligned glb...")
-        cut_selected_mesh_xz(-400, 400, -400, 400,mesh_name="Mesh_0")
+        cut_selected_mesh_xz(-args.rad, args.rad, -args.rad, args.rad, mesh_name="Mesh_0")
         export_glb(mesh_name="Mesh_0",output_path=os.path.join(meshes_dir, "aligned.glb"))
     print("Start aligning and creating masks...")
-    all_valid_points, all_ground_points, ground_polygons = align_road(
+    all_valid_points, all_ground_points, ground_polygons, building_polygons = align_road(
             input_glb_path=os.path.join(meshes_dir, "aligned.glb"),
             lat=args.lat, lng=args.lng, rad=args.rad,
+            cache_dir=args.osm_cache_dir, cache_ttl=args.osm_cache_ttl, offline=args.offline,
+            combined_query=not args.separate_osm_queries,
+            ground_density=args.ground_density,
+            height_field_resolution=args.height_field_resolution,
+            return_buildings=True,
         )
     print("Start smoothing points and creating masks...")
     road_info_dict, street_view_loc_clean_smooth, street_view_loc_clean_all, ground_info_dict = smooth_sampled_points(
             all_road_data=all_valid_points,
             all_ground_data=all_ground_points,
             ground_polygons=ground_polygons,
+            plane_solver=args.plane_solver,
         )
     pickle.dump(street_view_loc_clean_all, open(args.ref_ground_output_path, "wb"))
+    road_index = RoadIndex.from_reference_points(street_view_loc_clean_all, road_info_dict)
+    if args.road_index_path:
+        road_index.save(args.road_index_path)
+    road_raster = None
+    if args.road_raster_resolution:
+        road_raster = build_road_raster(road_index, ground_info_dict, building_polygons,
+                                        resolution=args.road_raster_resolution / 100)
+        if args.road_raster_path:
+            road_raster.save(args.road_raster_path)
+            road_raster.save_preview(os.path.join(args.road_raster_path, "preview.png"))
     create_masks(
             reference_points=street_view_loc_clean_all,
             road_type_list=road_info_dict,
             ground_info=ground_info_dict,
             output_path=args.mask_output_path,
+            road_index=road_index,
+            road_raster=road_raster,
+            chunk_size=args.mask_chunk_size,
+            workers=args.mask_workers,
         )
     print("All done. The masked blend file is saved at:", args.mask_output_path)
\ No newline at end of file
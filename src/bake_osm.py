@@ -19,6 +19,7 @@ from blenderlib import (
     MeshObject, BakeService, VertexGroup,
     CoordSystem, AssertLiteralType
 )
+from height_field import HeightField
 
 @persistent
 def save_mod_images(_):
@@ -144,10 +145,38 @@ def get_aabb(obj: MeshObject):
     return verts.min(axis=0), verts.max(axis=0)
 
 
+def height_field_axes(coord_sys: CoordSystem) -> tuple[tuple[int, int], int]:
+    AssertLiteralType(coord_sys, CoordSystem)
+    return ((0, 1), 2) if coord_sys == "Z+" else ((0, 2), 1)
+
+
+def mesh_height_field(mesh: MeshObject, coord_sys: CoordSystem, resolution: float) -> HeightField:
+    """Rasterize the world-space triangles of a mesh into a top-down HeightField"""
+    data = mesh.data
+    data.calc_loop_triangles()
+    tris = np.empty(len(data.loop_triangles) * 3, dtype=np.int32)
+    data.loop_triangles.foreach_get("vertices", tris)
+    plane_axes, up_axis = height_field_axes(coord_sys)
+    return HeightField.from_triangles(mesh.verts_Tworld, tris, resolution, plane_axes, up_axis)
+
+
+def cached_mesh_height_field(mesh: MeshObject, coord_sys: CoordSystem, resolution: float,
+                             path: str, source: str) -> HeightField:
+    """mesh_height_field stored at path and reused while source (the .blend the mesh comes from) is not newer"""
+    plane_axes, up_axis = height_field_axes(coord_sys)
+    return HeightField.load_or_build(path, None, resolution, plane_axes, up_axis, source=source,
+                                     build=lambda: mesh_height_field(mesh, coord_sys, resolution))
+
+
 def align_mesh_alt(target_mesh: MeshObject, move_meshes: list[MeshObject], coord_sys: CoordSystem,
                    reduction: T.Literal["Median", "Mean", "Min", "Max"], only_bottom_verts: bool,
                    direction: T.Literal["TopDown", "BottomUp"],
-                   sample_strategy: T.Literal["Vertex", "Uniform"]="Vertex") -> list[float]:
+                   sample_strategy: T.Literal["Vertex", "Uniform"]="Vertex",
+                   target_field: HeightField | None = None) -> list[float]:
+    """
+    target_field: optional HeightField of target_mesh (see mesh_height_field); when given, the target
+        altitude is looked up in it and only steep / missing cells are ray casted.
+    """
     AssertLiteralType(coord_sys, CoordSystem)
     target_mesh.apply_transform()
     
@@ -165,6 +194,20 @@ def align_mesh_alt(target_mesh: MeshObject, move_meshes: list[MeshObject], coord
     alt_offsets: list[float] = []
     target_bvhtree = None
     
+    def cast_on_target(sources: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        nonlocal target_bvhtree
+        positions, mask, target_bvhtree = target_mesh.cast_ray_on(
+            sources, ray_direction, 500., target_bvhtree, use_modifiers=False
+        )
+        return positions, mask
+    
+    def field_fallback(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        sources = np.empty((len(points), 3))
+        sources[..., [plane_axis_1, plane_axis_2]] = points
+        sources[..., alt_axis] = -100. if direction == "BottomUp" else 100.
+        positions, mask = cast_on_target(sources)
+        return positions[..., alt_axis], mask
+    
     for move_mesh in move_meshes:
         move_mesh.apply_transform()
         move_mesh_verts = move_mesh.verts_Tworld
@@ -191,9 +234,15 @@ def align_mesh_alt(target_mesh: MeshObject, move_meshes: list[MeshObject], coord
             ray_sources[..., plane_axis_2] = sample_y.flatten()
         ray_sources[..., alt_axis] = -100. if direction == "BottomUp" else 100.
         
-        target_alts, mask, target_bvhtree = target_mesh.cast_ray_on(
-            ray_sources, ray_direction, 500., target_bvhtree, use_modifiers=False
-        )
+        if target_field is None:
+            target_alts, mask = cast_on_target(ray_sources)
+        else:
+            heights, mask = target_field.query(
+                ray_sources[..., [plane_axis_1, plane_axis_2]],
+                reduction="min" if direction == "BottomUp" else "max", fallback=field_fallback
+            )
+            target_alts = ray_sources.copy()
+            target_alts[..., alt_axis] = heights
         
         if sample_strategy == "Vertex":
             offsets = (move_mesh_verts[mask][..., alt_axis] - target_alts[mask][..., alt_axis])
@@ -311,20 +360,31 @@ def main(args):
     # for osm_building in tqdm(osm_buildings):
     #     convert_z2y(osm_building)
     
+    # Height fields are cached next to the output, in the scene dir
+    field_dir = os.path.dirname(os.path.abspath(args.save_dir))
     terrain_mesh = MeshObject.remoteAppend(args.terrain_file, args.terrain_name)
+    terrain_field = cached_mesh_height_field(
+        terrain_mesh, coord, args.height_field_resolution,
+        os.path.join(field_dir, f"bake_osm_{args.terrain_name}_height_field.npy"), args.terrain_file
+    ) if args.height_field_resolution else None
     
     # Align meshes
-    alt_offsets = align_mesh_alt(terrain_mesh, osm_buildings, coord, reduction="Median", only_bottom_verts=True, direction="TopDown")
+    alt_offsets = align_mesh_alt(terrain_mesh, osm_buildings, coord, reduction="Median", only_bottom_verts=True, direction="TopDown",
+                                 target_field=terrain_field)
     for building, offset in zip(osm_buildings, alt_offsets):
         building.mesh_object.matrix_world[alt_axis][3] -= offset
         # building.apply_transform()
     
     tile_mesh = MeshObject.remoteAppend(args.tile_file, args.tile_name)
     # tile_mesh.apply_transform()
+    tile_field = cached_mesh_height_field(
+        tile_mesh, coord, args.height_field_resolution,
+        os.path.join(field_dir, f"bake_osm_{args.tile_name}_height_field.npy"), args.tile_file
+    ) if args.height_field_resolution else None
     
     roof_offsets = align_mesh_alt(
         tile_mesh, osm_buildings, coord, reduction="Mean", only_bottom_verts=False, direction="TopDown",
-        sample_strategy="Uniform"
+        sample_strategy="Uniform", target_field=tile_field
     )
     for building, roof_offset in zip(osm_buildings, roof_offsets):
         try:
@@ -333,7 +393,8 @@ def main(args):
             continue
         add_delta_z_to_vertices(building, -1 * roof_offset, lambda x: x[alt_axis] > min_alt + 1., coord)
     
-    bottom_offsets = align_mesh_alt(terrain_mesh, osm_buildings, coord, reduction="Max", only_bottom_verts=True, direction="TopDown")
+    bottom_offsets = align_mesh_alt(terrain_mesh, osm_buildings, coord, reduction="Max", only_bottom_verts=True, direction="TopDown",
+                                    target_field=terrain_field)
     for building, bottom_offset in zip(osm_buildings, bottom_offsets):
         try:
             bottom = building.verts_Tworld[..., alt_axis].min()
@@ -415,6 +476,8 @@ if __name__ == "__main__":
     parser.add_argument("--tile_name"   , type=str, default="Mesh_0", help="Name of tile mesh in tile_file (default: Mesh_0)")
     
     parser.add_argument("--save_dir", type=str, required=True, help="Save resulted blender file to ...")
+    parser.add_argument("--height_field_resolution", type=float, default=0.25,
+                        help="Cell size in meters of the height fields used for altitude alignment; 0 casts every ray (default: 0.25)")
     
     args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
     
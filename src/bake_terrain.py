@@ -71,22 +71,12 @@ def apply_bsdf_material_per_face(mesh_name: str):
         material_names.append(material_name)
     print ("")
 
+    # Face idx gets material_names[idx]; assign all faces and project each face's UVs in bulk
+    # instead of selecting faces one by one for material_slot_assign + uv.smart_project
     bpy.ops.object.mode_set(mode='OBJECT')
-    for idx in range(len(mesh_obj.data.polygons)):
-        print(f"\rApplying materials: {idx + 1} / {len(mesh_obj.data.polygons)}", end="")
-        bpy.ops.object.mode_set(mode='OBJECT')
-        
-        mesh_obj.data.polygons[idx].select = True
-
-        bpy.ops.object.mode_set(mode="EDIT")
-        bpy.ops.mesh.select_mode(type="FACE")
-        
-        material_index = mesh_obj.data.materials.find(material_names[idx])
-        mesh_obj.active_material_index = material_index
-        bpy.ops.object.material_slot_assign()
-        bpy.ops.uv.smart_project(correct_aspect=False)
-        
-        bpy.ops.mesh.select_all(action='DESELECT')
+    mesh = MeshObject(mesh_obj)
+    mesh.set_material_indices([mesh_obj.data.materials.find(name) for name in material_names])
+    mesh.project_uv_per_face()
 
     print(f"\nCreated {len(material_names)} material(s)")
     return material_names
@@ -23,6 +23,37 @@ CoordSystem = T.Literal["Z+", "Y+"]
 ArrayCoord = T.Annotated[npt.NDArray[np.float32], T.Literal["N", "N", 3]]
 ArrayMask  = T.Annotated[npt.NDArray[np.bool_], T.Literal["N"]]
 
+def planar_face_uvs(coords: np.ndarray, loop_start: np.ndarray, loop_total: np.ndarray, loop_verts: np.ndarray) -> np.ndarray:
+    """
+    Per-face planar UV projection for every loop at once, the vectorized counterpart of running
+    uv.smart_project on one selected face at a time: each face is projected onto its own plane
+    (Newell normal, u along its first edge) and scaled uniformly so that it fits the [0, 1] square.
+    Returns an (n_loops, 2) array.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    face_of_loop = np.repeat(np.arange(len(loop_start)), loop_total)
+    points = coords[loop_verts]
+    # Next loop within the same face, wrapping the last loop back to the face start
+    next_loop = np.arange(len(loop_verts)) + 1
+    next_loop[loop_start + loop_total - 1] = loop_start
+    normal = np.add.reduceat(np.cross(points, points[next_loop]), loop_start, axis=0)
+
+    u_axis = points[loop_start + 1] - points[loop_start]
+    normal_sq = np.maximum(np.einsum("ij,ij->i", normal, normal), 1e-20)
+    u_axis -= normal * (np.einsum("ij,ij->i", u_axis, normal) / normal_sq)[:, None]
+    u_axis /= np.maximum(np.linalg.norm(u_axis, axis=1), 1e-12)[:, None]
+    v_axis = np.cross(normal, u_axis)
+    v_axis /= np.maximum(np.linalg.norm(v_axis, axis=1), 1e-12)[:, None]
+
+    offset = points - points[loop_start][face_of_loop]
+    local = np.column_stack((np.einsum("ij,ij->i", offset, u_axis[face_of_loop]),
+                             np.einsum("ij,ij->i", offset, v_axis[face_of_loop])))
+    lower = np.minimum.reduceat(local, loop_start, axis=0)
+    extent = (np.maximum.reduceat(local, loop_start, axis=0) - lower).max(axis=1)
+    extent[extent <= 0] = 1.0
+    return (local - lower[face_of_loop]) / extent[face_of_loop, None]
+
+
 def AssertLiteralType(value: str | float | int | bool, type: T.Type):
     assert value in T.get_args(type), f"AssertLiteralType failed - expect `value` to be one of {T.get_args(type)}, but get {value}"
 
@@ -316,6 +347,28 @@ class MeshObject:
             if apply: bpy.ops.object.modifier_apply(modifier=mask_modifier.name)
             return mask_modifier
 
+    def set_material_indices(self, material_indices: np.ndarray) -> None:
+        """Assign material_index of every polygon in one foreach_set call (object data must be in OBJECT mode)"""
+        mesh = self.mesh_object.data
+        mesh.polygons.foreach_set("material_index", np.asarray(material_indices, dtype=np.int32).reshape(len(mesh.polygons)))
+        mesh.update()
+
+    def project_uv_per_face(self, uv_name: str = "UVMap") -> None:
+        """Write planar_face_uvs of every face to the UV layer uv_name (created if missing) in one foreach_set call"""
+        mesh = self.mesh_object.data
+        n_faces = len(mesh.polygons)
+        loop_start = np.empty(n_faces, dtype=np.int64)
+        loop_total = np.empty(n_faces, dtype=np.int64)
+        loop_verts = np.empty(len(mesh.loops), dtype=np.int64)
+        mesh.polygons.foreach_get("loop_start", loop_start)
+        mesh.polygons.foreach_get("loop_total", loop_total)
+        mesh.loops.foreach_get("vertex_index", loop_verts)
+        # Blender stores the loops of each face contiguously, in face order
+        uvs = planar_face_uvs(self.verts_Tobj, loop_start, loop_total, loop_verts).astype(np.float32)
+        uv_layer = mesh.uv_layers.get(uv_name) or mesh.uv_layers.new(name=uv_name)
+        uv_layer.data.foreach_set("uv", uvs.reshape(-1))
+        mesh.update()
+
     def delete_loose(self):
         with self.scoped_select(True), self.scoped_mode("EDIT", True):
             bpy.ops.mesh.select_all(action = 'SELECT')
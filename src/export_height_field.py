@@ -1,4 +1,3 @@
-import pickle
 import numpy as np
 
 import os, sys
@@ -6,6 +5,7 @@ dir = os.path.dirname(__file__)
 if not dir in sys.path: sys.path.append(dir)
 
 from blenderlib import CoordSystem, AssertLiteralType
+from road_index import load_reference_points
 
 def main(ref_pts: str, save_as: str):
     coord: CoordSystem = "Y+"
@@ -18,7 +18,7 @@ def main(ref_pts: str, save_as: str):
         alt_axis = 2
         gnd_axis = [0, 1]
     
-    with open(ref_pts, "rb") as fb: ref_points = pickle.load(fb)
+    ref_points = load_reference_points(ref_pts)
     
     plane_coord  = ref_points[..., gnd_axis]
     terrain_alt  = ref_points[..., alt_axis] + 100. 
@@ -33,7 +33,7 @@ def main(ref_pts: str, save_as: str):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--ground_points_ref", type=str, required=True, help="Name of heightfield to save as")
+    parser.add_argument("--ground_points_ref", type=str, required=True, help="Reference ground points: the stage 2 pickle or road index directory")
     parser.add_argument("--save_dir", type=str, required=True, help="Name of heightfield to save as")
     args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
 
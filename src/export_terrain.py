@@ -1,6 +1,5 @@
 import os, sys
 import math
-import pickle
 import bpy
 import bmesh
 import numpy as np
@@ -13,6 +12,7 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
 
 from blenderlib import MeshObject, CoordSystem, AssertLiteralType, BakeService
+from road_index import load_reference_points
 # Register save handlers
 
 @persistent
@@ -89,22 +89,12 @@ def apply_emissive_material_per_face(mesh_name: str):
         material_names.append(material_name)
     print ("")
 
+    # Face idx gets material_names[idx]; assign all faces and project each face's UVs in bulk
+    # instead of selecting faces one by one for material_slot_assign + uv.smart_project
     bpy.ops.object.mode_set(mode='OBJECT')
-    for idx in range(len(mesh_obj.data.polygons)):
-        print(f"\rApplying materials: {idx + 1} / {len(mesh_obj.data.polygons)}", end="")
-        bpy.ops.object.mode_set(mode='OBJECT')
-        
-        mesh_obj.data.polygons[idx].select = True
-
-        bpy.ops.object.mode_set(mode="EDIT")
-        bpy.ops.mesh.select_mode(type="FACE")
-        
-        material_index = mesh_obj.data.materials.find(material_names[idx])
-        mesh_obj.active_material_index = material_index
-        bpy.ops.object.material_slot_assign()
-        bpy.ops.uv.smart_project(correct_aspect=False)
-        
-        bpy.ops.mesh.select_all(action='DESELECT')
+    mesh = MeshObject(mesh_obj)
+    mesh.set_material_indices([mesh_obj.data.materials.find(name) for name in material_names])
+    mesh.project_uv_per_face()
 
     print(f"\nCreated {len(material_names)} material(s)")
     return material_names
@@ -190,7 +180,7 @@ def main(radius: float, ref: str, save: str):
         
         bmesh.update_edit_mesh(terrain.data)
 
-    with open(ref, "rb") as fb: Reference_Points = pickle.load(fb)
+    Reference_Points = load_reference_points(ref)
     alt_axis = 1 if coord == "Y+" else 2
     plane_2nd_axis = 2 if coord == "Y+" else 1
     
@@ -229,7 +219,7 @@ if __name__ == "__main__":
     import argparse, sys
     parser = argparse.ArgumentParser()
     parser.add_argument('--rad', type=float, required=True, help="Radius of the scene")
-    parser.add_argument('--ground_points_ref', type=str, required=True, help="Reference Points")
+    parser.add_argument('--ground_points_ref', type=str, required=True, help="Reference Points (pickle or road index directory)")
     parser.add_argument('--save_dir', type=str, required=True, help="Save terrain to")
     args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
     main(args.rad, args.ground_points_ref, args.save_dir)
@@ -11,6 +11,7 @@ import requests
 import sys
 sys.path.append(os.path.dirname(__file__))
 from stage7 import transform        # 你已有的坐标转换模块
+from height_field import HeightField, trimesh_ray_heights
 from PIL import Image
 import argparse
 import pickle
@@ -133,32 +134,6 @@ def get_street_view_meta_data(output_csv):
         assert False 
     return meta_data_list
 
-def find_mesh_upper_bound_y(input_mesh, x, y):
-    """
-    Find the y-axis upper bound of a mesh at a given x, z coordinate.
-
-    Parameters:
-    - mesh (trimesh.Trimesh): The mesh to query.
-    - x (float): The x coordinate.
-    - z (float): The z coordinate.
-
-    Returns:
-    - float or None: The upper bound on the y-axis if an upper bound is found, otherwise None.
-    """
-    ray_origins = np.array([[x, y, input_mesh.bounds[1][2] + 1]])
-    ray_directions = np.array([[0, 0, -1]])
-
-    locations, index_ray, index_tri = input_mesh.ray.intersects_location(
-        ray_origins=ray_origins,
-        ray_directions=ray_directions
-    )
-
-    if len(locations) > 0:
-        z_upbound = np.max(locations[:, 2])
-        return z_upbound, True
-    else:
-        return 0, False    
-
 def lat_lng_to_xy_matrix(lat0, lng0):
     R = 6371.0 * 1000
 
@@ -173,7 +148,7 @@ def lat_lng_to_xy_matrix(lat0, lng0):
 
     return conversion_matrix
 
-def find_pos(lat_lng_list, original_lat, original_lng, input_mesh, output_path):
+def find_pos(lat_lng_list, original_lat, original_lng, input_mesh, output_path, height_field=None):
     """
     Input
         lat_lng_list: latitude, longitude of street views
@@ -184,15 +159,21 @@ def find_pos(lat_lng_list, original_lat, original_lng, input_mesh, output_path):
         mesh: input mesh
         output_streeview_glb_dir: output glb of street view (use small spheres to represent them)
         car_height: height of Google street view car
+        height_field: optional HeightField over input_mesh; heights are looked up in it and
+            only steep / missing cells fall back to ray casting
     """
     transform_matrix = lat_lng_to_xy_matrix(original_lat, original_lng)
+    lat_lng = np.array([[lat, lng] for lat, lng, _, _ in lat_lng_list], dtype=np.float64)
+    xy_trans = np.dot(lat_lng - np.array([original_lat, original_lng]), transform_matrix)
+    ray_heights = trimesh_ray_heights(input_mesh, reduction="max")
+    if height_field is not None:
+        z_trans, find = height_field.query(xy_trans, reduction="max", fallback=ray_heights)
+    else:
+        z_trans, find = ray_heights(xy_trans)
     street_view_locs = {}
-    for lat_lng in tqdm(lat_lng_list):
-        lat, lng, pano_id, heading = lat_lng
-        x_trans, y_trans = np.dot(np.array([lat - original_lat, lng - original_lng]), transform_matrix)
-        z_trans, find = find_mesh_upper_bound_y(input_mesh, x_trans, y_trans)
-        if find:
-            street_view_locs[pano_id] = [x_trans, -z_trans, y_trans, lat, lng]
+    for (lat, lng, pano_id, heading), (x_trans, y_trans), z, found in zip(lat_lng_list, xy_trans, z_trans, find):
+        if found:
+            street_view_locs[pano_id] = [x_trans, -z, y_trans, lat, lng]
     pickle.dump(street_view_locs, open(output_path, "wb"))
 
 
@@ -210,6 +191,8 @@ if __name__ == "__main__":
     parser.add_argument("--lat", type=float, required=True, help="Origin latitude for coordinate conversion")
     parser.add_argument("--lng", type=float, required=True, help="Origin longitude for coordinate conversion")
     parser.add_argument("--num_points", type=float, default=50, help="Number of points to sample along each axis")
+    parser.add_argument("--height_field_resolution", type=float, default=0.25,
+                        help="Cell size in meters of the cached surface height field; 0 casts every ray against the mesh")
     args = parser.parse_args()
     # fetch strret view meta data
     origin_lng, origin_lat = args.lng,args.lat
@@ -231,5 +214,12 @@ if __name__ == "__main__":
 
     # align street view meta data
     street_view_list = get_street_view_meta_data(output_csv)
+    height_field = None
+    if args.height_field_resolution:
+        # 与 stage 2 的 align_road 共用同一个高度场文件
+        height_field = HeightField.load_or_build(
+            os.path.join(args.work_dir, "aligned_height_field.npy"), tmesh,
+            resolution=args.height_field_resolution, source=input_glb,
+        )
     find_pos(lat_lng_list=street_view_list, original_lat=origin_lat, original_lng=origin_lng, input_mesh=tmesh,
-             output_path=args.output_pkl)
+             output_path=args.output_pkl, height_field=height_field)
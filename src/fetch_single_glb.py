@@ -1,62 +1,451 @@
 import os
 import json
+import math
 import shutil
+import hashlib
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def find_deepest_glb_boxes_in_file(json_path, output_dir):
+import numpy as np
+
+try:
+    import ijson
+except ImportError:
+    # 没有 ijson 时退回整文件 json.load，遍历仍是迭代式的
+    ijson = None
+
+# WGS84 椭球参数
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+
+IDENTITY = np.eye(4)
+
+
+def latlng_to_ecef(lat, lng, alt=0.0):
+    """
+    经纬度（度）+ 椭球高 转换为 ECEF 坐标
+    """
+    lat_r = math.radians(lat)
+    lng_r = math.radians(lng)
+    n = WGS84_A / math.sqrt(1 - WGS84_E2 * math.sin(lat_r) ** 2)
+    x = (n + alt) * math.cos(lat_r) * math.cos(lng_r)
+    y = (n + alt) * math.cos(lat_r) * math.sin(lng_r)
+    z = (n * (1 - WGS84_E2) + alt) * math.sin(lat_r)
+    return np.array([x, y, z])
+
+
+def ecef_to_latlng(point):
+    """
+    ECEF 坐标转换为 (大地纬度, 经度, 椭球高)，角度为弧度。
+    用 Bowring 公式求初值，再做几次不动点迭代，地表附近精度远高于毫米级
+    """
+    x, y, z = point
+    p = math.hypot(x, y)
+    lng = math.atan2(y, x)
+    b = WGS84_A * math.sqrt(1 - WGS84_E2)
+    ep2 = WGS84_E2 / (1 - WGS84_E2)
+    theta = math.atan2(z * WGS84_A, p * b)
+    lat = math.atan2(z + ep2 * b * math.sin(theta) ** 3, p - WGS84_E2 * WGS84_A * math.cos(theta) ** 3)
+    for _ in range(3):
+        n = WGS84_A / math.sqrt(1 - WGS84_E2 * math.sin(lat) ** 2)
+        alt = p / math.cos(lat) - n if abs(lat) < math.pi / 4 else z / math.sin(lat) - n * (1 - WGS84_E2)
+        lat = math.atan2(z, p * (1 - WGS84_E2 * n / (n + alt)))
+    n = WGS84_A / math.sqrt(1 - WGS84_E2 * math.sin(lat) ** 2)
+    alt = p / math.cos(lat) - n if abs(lat) < math.pi / 4 else z / math.sin(lat) - n * (1 - WGS84_E2)
+    return lat, lng, alt
+
+
+def node_transform(node, parent_transform):
+    """
+    3D Tiles 的 transform 为列主序 4x4 矩阵，与父节点的变换级联
+    """
+    transform = node.get("transform")
+    if transform is None:
+        return parent_transform
+    return parent_transform @ np.array(transform, dtype=float).reshape(4, 4).T
+
+
+def bounding_volume_intersects(volume, transform, center, radius):
+    """
+    判断节点 boundingVolume 是否与以 center 为球心、radius 为半径的球相交。
+    不支持或缺失的包围体一律视为相交，保证只会保守地剪枝。
+    """
+    if center is None or not volume:
+        return True
+    if "box" in volume:
+        box = np.array(volume["box"], dtype=float)
+        box_center = transform[:3, :3] @ box[:3] + transform[:3, 3]
+        half_axes = transform[:3, :3] @ box[3:].reshape(3, 3).T
+        offset = center - box_center
+        closest = np.zeros(3)
+        for i in range(3):
+            axis = half_axes[:, i]
+            half_len = np.linalg.norm(axis)
+            if half_len == 0:
+                continue
+            unit = axis / half_len
+            closest += np.clip(offset @ unit, -half_len, half_len) * unit
+        return np.linalg.norm(offset - closest) <= radius
+    if "sphere" in volume:
+        sphere = np.array(volume["sphere"], dtype=float)
+        sphere_center = transform[:3, :3] @ sphere[:3] + transform[:3, 3]
+        scale = np.max(np.linalg.norm(transform[:3, :3], axis=0))
+        return np.linalg.norm(center - sphere_center) <= radius + sphere[3] * scale
+    if "region" in volume:
+        # region 为 [west, south, east, north, minh, maxh]（大地纬度 / 经度为弧度），始终位于 WGS84 坐标系。
+        # 局部的北 / 东 / 上三个方向相互正交，把球心的大地坐标逐项夹到 region 内即得到近似的最近点；
+        # 再放宽 region 在椭球面上弯曲的下垂量，保证只会保守地剪枝
+        west, south, east, north, min_h, max_h = volume["region"]
+        lat, lng, alt = ecef_to_latlng(center)
+        if east < west:
+            # 跨越 180° 经线的 region
+            east += 2 * math.pi
+            if lng < west:
+                lng += 2 * math.pi
+        closest = latlng_to_ecef(math.degrees(min(max(lat, south), north)), math.degrees(min(max(lng, west), east)),
+                                 min(max(alt, min_h), max_h))
+        extent = WGS84_A * max(north - south, (east - west) * math.cos(min(max(lat, south), north)))
+        return np.linalg.norm(center - closest) <= radius + extent ** 2 / WGS84_A
+    return True
+
+
+# 决定一个节点的子节点如何遍历的字段，通常位于 children 之前
+TRAVERSAL_KEYS = ("transform", "boundingVolume", "content")
+
+
+class _StreamNode:
+    """流式遍历中正在读取的节点：已读到的字段（不含 children），以及读到第一个子节点时对子节点的处理方式"""
+    __slots__ = ("fields", "parent_transform", "transform", "state", "in_children", "is_root")
+
+    def __init__(self, parent_transform, is_root=False):
+        self.fields = {}
+        self.parent_transform = parent_transform
+        self.transform = None
+        self.state = None       # None: 尚未读到子节点；"walk" / "pruned" / "external"
+        self.in_children = False
+        self.is_root = is_root
+
+
+def walk_tileset_file(json_path, center=None, radius=None, parent_transform=IDENTITY):
+    """
+    遍历单个 tileset 文件，返回 (最深层 GLB 的 (路径, box) 列表, 待加载的外部子 tileset (路径, transform) 列表)。
+    若给定 center/radius，则与场景球不相交的子树整体跳过。
+    有 ijson 时用事件流一次读完：每个节点只在内存中保留自身字段，各层 children 逐个流式读入，
+    被剪枝的子树直接跳过，内存只随树的深度增长，与文件大小无关。
+    """
     results = []
+    externals = []
     base_dir = os.path.dirname(json_path)
 
+    def content_uri(node):
+        return node.get("content", {}).get("uri", "")
+
+    def add_leaf(node):
+        uri = content_uri(node)
+        box = node.get("boundingVolume", {}).get("box")
+        if box:
+            glb_path = os.path.normpath(os.path.join(base_dir, uri))
+            results.append((glb_path, box))
+            print(f"找到最深层 GLB: {uri}")
+
+    def add_external(node, parent):
+        child_transform = node_transform(node, parent)
+        if bounding_volume_intersects(node.get("boundingVolume"), child_transform, center, radius):
+            externals.append((os.path.normpath(os.path.join(base_dir, content_uri(node))), child_transform))
+
+    def walk_subtree(node, parent):
+        """整棵子树已在内存中时的遍历（没有 ijson，或流式遍历遇到少见的字段顺序时使用）"""
+        stack = [(node, parent)]
+        while stack:
+            node, parent = stack.pop()
+            transform = node_transform(node, parent)
+            if not bounding_volume_intersects(node.get("boundingVolume"), transform, center, radius):
+                continue
+            children = node.get("children", [])
+            if content_uri(node).lower().endswith(".glb") and not children:
+                add_leaf(node)
+                continue
+            for child in reversed(children):
+                if content_uri(child).lower().endswith(".json"):
+                    add_external(child, transform)
+                else:
+                    stack.append((child, transform))
+
+    def decide(node):
+        """读到第一个子节点时，按已读到的字段决定子节点的处理方式"""
+        if not node.is_root and content_uri(node.fields).lower().endswith(".json"):
+            node.state = "external"
+            return
+        node.transform = node_transform(node.fields, node.parent_transform)
+        visible = bounding_volume_intersects(node.fields.get("boundingVolume"), node.transform, center, radius)
+        node.state = "walk" if visible else "pruned"
+
+    def finish(node):
+        """节点读完：外部 tileset 记入 externals，没有子节点的 GLB 记为叶子"""
+        if not node.is_root and content_uri(node.fields).lower().endswith(".json"):
+            add_external(node.fields, node.parent_transform)
+        elif node.state is None and content_uri(node.fields).lower().endswith(".glb"):
+            transform = node_transform(node.fields, node.parent_transform)
+            if bounding_volume_intersects(node.fields.get("boundingVolume"), transform, center, radius):
+                add_leaf(node.fields)
+
+    def stream_walk(f):
+        """一次 ijson.parse 完成遍历；某个节点的 TRAVERSAL_KEYS 出现在其 children 之后时返回 False"""
+        stack, builder, depth, key, skip = [], None, 0, None, 0
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if skip:
+                # 跳过被剪枝节点的子树
+                if event in ("start_map", "start_array"):
+                    skip += 1
+                elif event in ("end_map", "end_array"):
+                    skip -= 1
+                continue
+            if builder is not None:
+                builder.event(event, value)
+                if event in ("start_map", "start_array"):
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+                if depth == 0:
+                    stack[-1].fields[key] = builder.value
+                    builder = None
+                continue
+            if not stack:
+                if prefix == "root" and event == "start_map":
+                    stack.append(_StreamNode(parent_transform, is_root=True))
+                continue
+            node = stack[-1]
+            if node.in_children:
+                if event == "start_array":
+                    continue
+                if event == "start_map":
+                    if node.state is None:
+                        decide(node)
+                    if node.state == "walk":
+                        stack.append(_StreamNode(node.transform))
+                    else:
+                        skip = 1
+                    continue
+                # 数组结束，或 children 不是数组
+                node.in_children = False
+                if event == "end_array":
+                    continue
+            if event == "map_key":
+                key = value
+                if key == "children":
+                    node.in_children = True
+                    continue
+                if node.state is not None and key in TRAVERSAL_KEYS:
+                    return False
+                builder, depth = ijson.ObjectBuilder(), 0
+            elif event == "end_map":
+                finish(stack.pop())
+                if not stack:
+                    break
+        return True
+
+    if ijson is not None:
+        with open(json_path, 'rb') as f:
+            if stream_walk(f):
+                return results, externals
+        # 少见的布局：transform / boundingVolume / content 出现在 children 之后，整文件读入后重新遍历
+        print(f"{json_path} 的节点字段位于 children 之后，改为整文件读取")
+        results.clear()
+        externals.clear()
     with open(json_path, 'r') as f:
+        root = json.load(f)["root"]
+    walk_subtree(root, parent_transform)
+    return results, externals
+
+
+def find_deepest_glb_boxes_in_file(json_path, center=None, radius=None, parent_transform=IDENTITY, workers=1):
+    """
+    以显式工作队列遍历 tileset.json 及其外部子 tileset，返回最深层 GLB 的 (路径, box)。
+    workers > 1 时用线程池并发加载外部子 tileset。
+    """
+    results = []
+    pending = deque([(json_path, parent_transform)])
+    if workers <= 1:
+        while pending:
+            path, transform = pending.popleft()
+            leaves, externals = walk_tileset_file(path, center, radius, transform)
+            results.extend(leaves)
+            pending.extend(externals)
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(walk_tileset_file, path, center, radius, transform) for path, transform in pending}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                leaves, externals = future.result()
+                results.extend(leaves)
+                for path, transform in externals:
+                    futures.add(executor.submit(walk_tileset_file, path, center, radius, transform))
+    return results
+
+
+def extract_glb(glb_path, output_dir, link=False):
+    """
+    复制（或硬链接）单个 GLB 到目标文件夹，返回目标路径；源文件不存在时返回 None
+    """
+    if not os.path.isfile(glb_path):
+        print(f"文件不存在: {glb_path}")
+        return None
+    target = os.path.join(output_dir, os.path.basename(glb_path))
+    if link:
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(glb_path, target)
+            return target
+        except OSError:
+            # 跨设备等情况无法硬链接，退回复制
+            pass
+    shutil.copy2(glb_path, target)
+    return target
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    """
+    分块计算文件内容的 sha1
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    读取上一次的提取清单，返回 {uri: entry}；不存在时返回空字典
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
         data = json.load(f)
+    return {entry["uri"]: entry for entry in data.get("tiles", []) if "uri" in entry}
 
-    def recurse_node(node):
-        children = node.get("children", [])
-        content = node.get("content", {})
-        uri = content.get("uri", "")
-
-        if uri.lower().endswith(".glb") and not children:
-            box = node.get("boundingVolume", {}).get("box")
-            if box:
-                glb_path = os.path.normpath(os.path.join(base_dir, uri))
-                results.append((glb_path, box))
-                print(f"找到最深层 GLB: {uri}")
-                # 复制文件到目标文件夹
-                if os.path.isfile(glb_path):
-                    shutil.copy2(glb_path, os.path.join(output_dir, os.path.basename(glb_path)))
-                    print(f"已提取到: {output_dir}")
-                else:
-                    print(f"文件不存在: {glb_path}")
+
+def describe_tile(glb_path, box, tileset_dir, previous):
+    """
+    生成单个瓦片的清单条目；size 和 mtime 与上次一致时复用旧的哈希，避免重新读文件
+    """
+    if not os.path.isfile(glb_path):
+        print(f"文件不存在: {glb_path}")
+        return None
+    stat = os.stat(glb_path)
+    uri = os.path.relpath(glb_path, tileset_dir).replace(os.sep, "/")
+    old = previous.get(uri)
+    if old is not None and old.get("size") == stat.st_size and old.get("mtime") == stat.st_mtime:
+        content_hash = old["hash"]
+    else:
+        content_hash = file_sha1(glb_path)
+    return {
+        "uri": uri,
+        "source": glb_path,
+        "target": os.path.basename(glb_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "hash": content_hash,
+        "box": box,
+    }
+
+
+def extract_glbs(glb_boxes, output_dir, tileset_dir, previous=None, workers=8, link=False):
+    """
+    增量提取 GLB：只复制新增或内容变化的瓦片，删除已不在范围内的瓦片。
+    返回 (新的清单条目列表, 差异字典)
+    """
+    previous = previous or {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(lambda item: describe_tile(item[0], item[1], tileset_dir, previous), glb_boxes))
+    entries = [entry for entry in entries if entry is not None]
+
+    diff = {"added": [], "changed": [], "removed": [], "unchanged": []}
+    to_extract = []
+    for entry in entries:
+        old = previous.get(entry["uri"])
+        target_exists = os.path.isfile(os.path.join(output_dir, entry["target"]))
+        if old is None:
+            diff["added"].append(entry["uri"])
+        elif old.get("hash") != entry["hash"] or old.get("box") != entry["box"]:
+            diff["changed"].append(entry["uri"])
         else:
-            for child in children:
-                child_content = child.get("content", {})
-                child_uri = child_content.get("uri", "")
-                if child_uri.lower().endswith(".json"):
-                    child_json_path = os.path.normpath(os.path.join(base_dir, child_uri))
-                    results.extend(find_deepest_glb_boxes_in_file(child_json_path, output_dir))
-                else:
-                    recurse_node(child)
+            diff["unchanged"].append(entry["uri"])
+            if target_exists:
+                continue
+            # 清单一致但目标文件被删，只补拷贝，不算作变化
+        to_extract.append(entry)
+
+    current_uris = {entry["uri"] for entry in entries}
+    current_targets = {entry["target"] for entry in entries}
+    for uri, old in previous.items():
+        if uri in current_uris:
+            continue
+        diff["removed"].append(uri)
+        target = os.path.join(output_dir, old.get("target", ""))
+        if old.get("target") not in current_targets and os.path.isfile(target):
+            os.remove(target)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda entry: extract_glb(entry["source"], output_dir, link), to_extract))
+    diff["changed_count"] = len(diff["added"]) + len(diff["changed"]) + len(diff["removed"])
+    return entries, diff
 
-    recurse_node(data["root"])
-    return results
 
 def main():
     parser = argparse.ArgumentParser(description="Extract deepest .glb files from Cesium 3D Tiles tileset.json")
     parser.add_argument("--tileset", "-t", required=True, help="Path to the top-level tileset.json file")
     parser.add_argument("--outdir", "-o", required=True, help="Directory to copy extracted .glb files")
     parser.add_argument("--tag", "-g", required=True, help="Tag the output with 'Done' in tag.txt")
+    parser.add_argument("--lat", type=float, default=None, help="Latitude of the scene center, enables spatial filtering")
+    parser.add_argument("--lng", type=float, default=None, help="Longitude of the scene center, enables spatial filtering")
+    parser.add_argument("--alt", type=float, default=0.0, help="Ellipsoid height of the scene center in meters")
+    parser.add_argument("--rad", type=float, default=None, help="Radius around the scene center in meters")
+    parser.add_argument("--workers", type=int, default=8, help="Number of threads used to extract tiles")
+    parser.add_argument("--tileset_workers", type=int, default=1, help="Number of threads used to load external child tilesets")
+    parser.add_argument("--link", action="store_true", help="Hardlink tiles instead of copying when possible")
+    parser.add_argument("--manifest", type=str, default=None, help="Path of the JSON manifest (default: <outdir>/manifest.json)")
+    parser.add_argument("--diff", type=str, default=None, help="Path of the JSON diff against the previous run (default: <outdir>/manifest_diff.json)")
     args = parser.parse_args()
 
     top_tileset_path = args.tileset
     output_dir = args.outdir
     tag_path = args.tag
+    manifest_path = args.manifest or os.path.join(output_dir, "manifest.json")
+    diff_path = args.diff or os.path.join(output_dir, "manifest_diff.json")
     os.makedirs(output_dir, exist_ok=True)
 
-    deepest_glbs = find_deepest_glb_boxes_in_file(top_tileset_path, output_dir)
-    print(f"找到 {len(deepest_glbs)} 个最深层 .glb 文件并已提取到 {output_dir}")
+    center, radius = None, None
+    if args.lat is not None and args.lng is not None and args.rad is not None:
+        center = latlng_to_ecef(args.lat, args.lng, args.alt)
+        radius = args.rad
+        print(f"按场景范围过滤: lat={args.lat}, lng={args.lng}, rad={args.rad}m")
+
+    deepest_glbs = find_deepest_glb_boxes_in_file(top_tileset_path, center, radius, workers=args.tileset_workers)
+    if not deepest_glbs:
+        # 不写完成标记，避免后续运行跳过 stage 0
+        if center is not None:
+            raise SystemExit("错误: 范围内没有找到任何 GLB，请检查经纬度或 tileset 的坐标系"
+                             "（root 缺少 ECEF transform 时所有瓦片都会被剔除）。")
+        raise SystemExit("错误: tileset 中没有找到任何 GLB。")
+    previous = load_manifest(manifest_path)
+    manifest, diff = extract_glbs(deepest_glbs, output_dir, os.path.dirname(os.path.abspath(top_tileset_path)),
+                                  previous=previous, workers=args.workers, link=args.link)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"tileset": os.path.abspath(top_tileset_path), "tiles": manifest}, f, indent=2)
+    with open(diff_path, "w", encoding="utf-8") as f:
+        json.dump(diff, f, indent=2)
+    print(f"找到 {len(deepest_glbs)} 个最深层 .glb 文件，清单中共 {len(manifest)} 个")
+    print(f"新增 {len(diff['added'])} 个，变化 {len(diff['changed'])} 个，"
+          f"删除 {len(diff['removed'])} 个，未变 {len(diff['unchanged'])} 个")
+    print(f"提取清单已写入 {manifest_path}，差异已写入 {diff_path}")
     os.makedirs(os.path.dirname(tag_path), exist_ok=True)
     with open(tag_path, "w", encoding="utf-8") as f:
         f.write("Done\n")
     print(f"已在 {tag_path} 中标记完成状态。")
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,411 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import argparse
+import typing as T
+
+import numpy as np
+
+# GLB 文件格式常量
+GLB_MAGIC = 0x46546C67
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+COMPONENT_DTYPES = {
+    5120: np.int8,
+    5121: np.uint8,
+    5122: np.int16,
+    5123: np.uint16,
+    5125: np.uint32,
+    5126: np.float32,
+}
+TYPE_SIZES = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT2": 4, "MAT3": 9, "MAT4": 16}
+
+# 与 merge.py 的 Blender 流程等价的坐标轴重映射：
+# Blender 导入 glTF 时做 (x, y, z) -> (x, -z, y)，merge.py 再做 (x, y, z) -> (x, z, -y) 并把物体绕 X 轴转 -90 度，
+# 最终世界坐标为 (x, z, -y)。这里直接写出 (x, -y, -z)，Blender 导入后即得到相同的世界坐标。
+AXIS_REMAP = np.diag([1.0, -1.0, -1.0, 1.0])
+
+
+class UnsupportedGLB(ValueError):
+    """GLB 使用了 NumPy 合并不支持的特性（外部 buffer、sparse accessor、Draco / meshopt 压缩），应改用 Blender 合并"""
+
+
+class TilePrimitive(T.NamedTuple):
+    positions: np.ndarray           # (N, 3) float32，已变换到合并后的坐标系
+    indices: np.ndarray             # (M,) uint32，三角形索引
+    uvs: np.ndarray | None          # (N, 2) float32
+    image: tuple[bytes, str] | None # (图片数据, mimeType)
+
+
+def read_glb(path):
+    """
+    读取 GLB，返回 (glTF JSON, BIN chunk)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, length = struct.unpack_from("<III", data, 0)
+    if magic != GLB_MAGIC:
+        raise ValueError(f"不是有效的 GLB 文件: {path}")
+    offset = 12
+    gltf, binary = None, b""
+    while offset < length:
+        chunk_length, chunk_type = struct.unpack_from("<II", data, offset)
+        chunk = data[offset + 8: offset + 8 + chunk_length]
+        if chunk_type == CHUNK_JSON:
+            gltf = json.loads(chunk)
+        elif chunk_type == CHUNK_BIN:
+            binary = chunk
+        offset += 8 + chunk_length
+    if gltf is None:
+        raise ValueError(f"GLB 缺少 JSON chunk: {path}")
+    return gltf, binary
+
+
+def read_buffer_view(gltf, binary, view_idx):
+    view = gltf["bufferViews"][view_idx]
+    if view.get("buffer", 0) != 0:
+        raise UnsupportedGLB("只支持 GLB 内嵌的单个 buffer")
+    start = view.get("byteOffset", 0)
+    return binary[start: start + view["byteLength"]], view.get("byteStride")
+
+
+def read_accessor(gltf, binary, accessor_idx):
+    """
+    把 accessor 解码为 (count, n) 的 NumPy 数组，支持 byteStride 与 normalized 整型
+    """
+    accessor = gltf["accessors"][accessor_idx]
+    if "sparse" in accessor:
+        raise UnsupportedGLB("不支持 sparse accessor")
+    dtype = np.dtype(COMPONENT_DTYPES[accessor["componentType"]])
+    n = TYPE_SIZES[accessor["type"]]
+    count = accessor["count"]
+    if "bufferView" not in accessor:
+        return np.zeros((count, n), dtype=dtype)
+    view, stride = read_buffer_view(gltf, binary, accessor["bufferView"])
+    offset = accessor.get("byteOffset", 0)
+    item_size = dtype.itemsize * n
+    if stride and stride != item_size:
+        raw = np.frombuffer(view, dtype=np.uint8, count=stride * (count - 1) + item_size, offset=offset)
+        raw = np.lib.stride_tricks.as_strided(raw, shape=(count, item_size), strides=(stride, 1))
+        array = np.ascontiguousarray(raw).view(dtype).reshape(count, n)
+    else:
+        array = np.frombuffer(view, dtype=dtype, count=count * n, offset=offset).reshape(count, n)
+    if accessor.get("normalized") and dtype.kind in "iu":
+        array = np.maximum(array.astype(np.float32) / np.iinfo(dtype).max, -1.0)
+    return array
+
+
+def node_matrix(node):
+    """
+    节点的局部变换：matrix（列主序）或 TRS
+    """
+    if "matrix" in node:
+        return np.array(node["matrix"], dtype=float).reshape(4, 4).T
+    x, y, z, w = node.get("rotation", [0.0, 0.0, 0.0, 1.0])
+    rotation = np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation * np.array(node.get("scale", [1.0, 1.0, 1.0]))
+    matrix[:3, 3] = node.get("translation", [0.0, 0.0, 0.0])
+    return matrix
+
+
+def iter_mesh_nodes(gltf):
+    """
+    遍历默认场景，产出 (mesh 索引, 世界变换矩阵)
+    """
+    nodes = gltf.get("nodes", [])
+    scenes = gltf.get("scenes", [])
+    if scenes:
+        roots = scenes[gltf.get("scene", 0)].get("nodes", [])
+    else:
+        roots = range(len(nodes))
+    stack = [(idx, np.eye(4)) for idx in roots]
+    while stack:
+        idx, parent = stack.pop()
+        node = nodes[idx]
+        world = parent @ node_matrix(node)
+        if "mesh" in node:
+            yield node["mesh"], world
+        stack.extend((child, world) for child in node.get("children", []))
+
+
+def read_image(gltf, binary, material_idx, base_dir):
+    """
+    读取材质的 baseColor 贴图，返回 (图片数据, mimeType)，无贴图时返回 None
+    """
+    if material_idx is None:
+        return None
+    material = gltf["materials"][material_idx]
+    texture_info = material.get("pbrMetallicRoughness", {}).get("baseColorTexture")
+    if texture_info is None:
+        return None
+    image = gltf["images"][gltf["textures"][texture_info["index"]]["source"]]
+    if "bufferView" in image:
+        data, _ = read_buffer_view(gltf, binary, image["bufferView"])
+        return bytes(data), image.get("mimeType", "image/jpeg")
+    uri = image.get("uri", "")
+    with open(os.path.join(base_dir, uri), "rb") as f:
+        data = f.read()
+    return data, "image/png" if uri.lower().endswith(".png") else "image/jpeg"
+
+
+def crop_mask(positions, crop):
+    """
+    crop 为 Blender 世界坐标下的 (x_min, x_max, z_min, z_max)。
+    写出的坐标经 Blender 导入后，世界 x 对应 positions[:, 0]，世界 z 对应 positions[:, 1]。
+    """
+    x_min, x_max, z_min, z_max = crop
+    x, z = positions[:, 0], positions[:, 1]
+    return (x >= x_min) & (x <= x_max) & (z >= z_min) & (z <= z_max)
+
+
+def crop_triangles(positions, indices, crop, uvs=None):
+    """
+    与 cut_selected_mesh_xz 相同的语义：删除范围外的顶点以及引用它们的三角形，并压缩顶点数组
+    """
+    inside = crop_mask(positions, crop)
+    faces = indices.reshape(-1, 3)
+    faces = faces[inside[faces].all(axis=1)]
+    used = np.unique(faces)
+    new_index = np.full(len(positions), 0, dtype=np.uint32)
+    new_index[used] = np.arange(len(used), dtype=np.uint32)
+    return positions[used], new_index[faces].reshape(-1), uvs[used] if uvs is not None else None
+
+
+def decode_glb(path, crop=None):
+    """
+    把单个 GLB 解码为 TilePrimitive 列表，顶点已应用世界变换与坐标轴重映射。
+    给定 crop 时，包围盒完全在范围外的图元直接丢弃，跨边界的图元按顶点裁剪。
+    """
+    gltf, binary = read_glb(path)
+    unsupported = {"KHR_draco_mesh_compression", "EXT_meshopt_compression"} & set(gltf.get("extensionsRequired", []))
+    if unsupported:
+        raise UnsupportedGLB(f"{path} 使用了 {sorted(unsupported)}，请改用 Blender 合并")
+    base_dir = os.path.dirname(path)
+    primitives = []
+    for mesh_idx, world in iter_mesh_nodes(gltf):
+        transform = AXIS_REMAP @ world
+        for primitive in gltf["meshes"][mesh_idx]["primitives"]:
+            if primitive.get("mode", 4) != 4:
+                continue
+            attributes = primitive["attributes"]
+            positions = read_accessor(gltf, binary, attributes["POSITION"]).astype(np.float64)
+            positions = (positions @ transform[:3, :3].T + transform[:3, 3]).astype(np.float32)
+            if crop is not None:
+                lo, hi = positions.min(axis=0), positions.max(axis=0)
+                if hi[0] < crop[0] or lo[0] > crop[1] or hi[1] < crop[2] or lo[1] > crop[3]:
+                    continue
+            if "indices" in primitive:
+                indices = read_accessor(gltf, binary, primitive["indices"]).reshape(-1).astype(np.uint32)
+            else:
+                indices = np.arange(len(positions), dtype=np.uint32)
+            if np.linalg.det(transform[:3, :3]) < 0:
+                # 镜像变换会翻转三角形朝向
+                indices = indices.reshape(-1, 3)[:, ::-1].reshape(-1)
+            uvs = None
+            if "TEXCOORD_0" in attributes:
+                uvs = read_accessor(gltf, binary, attributes["TEXCOORD_0"]).astype(np.float32)
+            if crop is not None and not crop_mask(positions, crop).all():
+                positions, indices, uvs = crop_triangles(positions, indices, crop, uvs)
+                if len(indices) == 0:
+                    continue
+            image = read_image(gltf, binary, primitive.get("material"), base_dir)
+            primitives.append(TilePrimitive(positions, indices, uvs, image))
+    return primitives
+
+
+def pack_primitives(primitives):
+    """
+    按贴图内容分组，把所有图元拼接为若干大的顶点/索引数组。
+    返回 [(positions, indices, uvs, image_key)], {image_key: (data, mimeType)}
+    """
+    groups: dict[str | None, list[TilePrimitive]] = {}
+    images = {}
+    for primitive in primitives:
+        key = None
+        if primitive.image is not None:
+            key = hashlib.sha1(primitive.image[0]).hexdigest()
+            images[key] = primitive.image
+        groups.setdefault(key, []).append(primitive)
+
+    packed = []
+    for key, items in groups.items():
+        offsets = np.cumsum([0] + [len(p.positions) for p in items[:-1]])
+        positions = np.concatenate([p.positions for p in items])
+        indices = np.concatenate([p.indices + np.uint32(offset) for p, offset in zip(items, offsets)])
+        uvs = None
+        if key is not None:
+            uvs = np.concatenate([p.uvs if p.uvs is not None else np.zeros((len(p.positions), 2), np.float32)
+                                  for p in items])
+        packed.append((positions, indices, uvs, key))
+    return packed, images
+
+
+def weld_vertices(positions, indices, tolerance, uvs=None):
+    """
+    空间哈希焊接：把距离在 tolerance 内的重复顶点合并，并删除退化三角形。
+    顶点坐标（和 UV）按 tolerance 量化后去重，再在错开半格的网格上去重一次，
+    以合并落在相邻格子边界两侧的顶点。
+    返回 (positions, indices, uvs, 删除的顶点数, 删除的三角形数)
+    """
+    rep = np.arange(len(positions))
+    for shift in (0.0, 0.5):
+        candidates = np.unique(rep)
+        keys = np.floor(positions[candidates] / tolerance + shift).astype(np.int64)
+        if uvs is not None:
+            keys = np.hstack([keys, np.round(uvs[candidates] / 1e-5).astype(np.int64)])
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        cell_rep = candidates[first][inverse.reshape(-1)]
+        rep = cell_rep[np.searchsorted(candidates, rep)]
+
+    kept = np.unique(rep)
+    new_index = np.searchsorted(kept, rep).astype(np.uint32)
+    faces = new_index[indices].reshape(-1, 3)
+    valid = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    removed_verts = len(positions) - len(kept)
+    removed_faces = int((~valid).sum())
+    return (positions[kept], faces[valid].reshape(-1), uvs[kept] if uvs is not None else None,
+            removed_verts, removed_faces)
+
+
+def write_glb(path, packed, images, mesh_name="Mesh_0"):
+    """
+    把打包后的数组写成单个 mesh 的 GLB，每个贴图一个 primitive
+    """
+    binary = bytearray()
+    gltf = {
+        "asset": {"version": "2.0", "generator": "glb_merge.py"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"name": mesh_name, "mesh": 0}],
+        "meshes": [{"name": mesh_name, "primitives": []}],
+        "buffers": [],
+        "bufferViews": [],
+        "accessors": [],
+    }
+
+    def add_view(data, target=None):
+        while len(binary) % 4:
+            binary.append(0)
+        view = {"buffer": 0, "byteOffset": len(binary), "byteLength": len(data)}
+        if target is not None:
+            view["target"] = target
+        binary.extend(data)
+        gltf["bufferViews"].append(view)
+        return len(gltf["bufferViews"]) - 1
+
+    def add_accessor(array, component_type, type_name, target, with_bounds=False):
+        accessor = {
+            "bufferView": add_view(np.ascontiguousarray(array).tobytes(), target),
+            "componentType": component_type,
+            "count": len(array),
+            "type": type_name,
+        }
+        if with_bounds:
+            accessor["min"] = array.min(axis=0).tolist()
+            accessor["max"] = array.max(axis=0).tolist()
+        gltf["accessors"].append(accessor)
+        return len(gltf["accessors"]) - 1
+
+    material_of = {}
+    if images:
+        gltf.update({"images": [], "textures": [], "materials": [], "samplers": [{}]})
+        for key, (data, mime_type) in images.items():
+            gltf["images"].append({"bufferView": add_view(data), "mimeType": mime_type})
+            gltf["textures"].append({"source": len(gltf["images"]) - 1, "sampler": 0})
+            gltf["materials"].append({
+                "name": f"Material_{key[:8]}",
+                "pbrMetallicRoughness": {
+                    "baseColorTexture": {"index": len(gltf["textures"]) - 1},
+                    "metallicFactor": 0.0,
+                },
+            })
+            material_of[key] = len(gltf["materials"]) - 1
+
+    for positions, indices, uvs, key in packed:
+        if len(indices) == 0:
+            continue
+        attributes = {"POSITION": add_accessor(positions, 5126, "VEC3", 34962, with_bounds=True)}
+        if uvs is not None:
+            attributes["TEXCOORD_0"] = add_accessor(uvs, 5126, "VEC2", 34962)
+        primitive = {"attributes": attributes, "indices": add_accessor(indices, 5125, "SCALAR", 34963), "mode": 4}
+        if key is not None:
+            primitive["material"] = material_of[key]
+        gltf["meshes"][0]["primitives"].append(primitive)
+
+    while len(binary) % 4:
+        binary.append(0)
+    gltf["buffers"].append({"byteLength": len(binary)})
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    total = 12 + 8 + len(json_chunk) + 8 + len(binary)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<III", GLB_MAGIC, 2, total))
+        f.write(struct.pack("<II", len(json_chunk), CHUNK_JSON))
+        f.write(json_chunk)
+        f.write(struct.pack("<II", len(binary), CHUNK_BIN))
+        f.write(binary)
+
+
+def merge_glbs(input_dir, output_file, mesh_name="Mesh_0", weld_distance=0.0, crop=None):
+    """
+    不依赖 Blender 合并目录下所有 GLB 为单个 mesh，返回各阶段耗时（秒）。
+    weld_distance > 0 时在每个贴图分组内按位置与 UV 焊接重复顶点，只减少导入 Blender 的顶点数；
+    相邻瓦片的接缝顶点分属不同贴图分组，要在导入后由 merge.weld_mesh 焊接。
+    crop 为 Blender 世界坐标下的 (x_min, x_max, z_min, z_max)，在解码时就裁掉场景范围外的几何。
+    """
+    timings = {}
+    start = time.perf_counter()
+    glb_files = sorted(f for f in os.listdir(input_dir) if f.lower().endswith('.glb'))
+    primitives = []
+    for glb_file in glb_files:
+        primitives.extend(decode_glb(os.path.join(input_dir, glb_file), crop=crop))
+    timings["decode+transform+crop"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    packed, images = pack_primitives(primitives)
+    timings["pack"] = time.perf_counter() - start
+
+    if weld_distance > 0:
+        start = time.perf_counter()
+        removed_verts, removed_faces = 0, 0
+        for i, (positions, indices, uvs, key) in enumerate(packed):
+            positions, indices, uvs, n_verts, n_faces = weld_vertices(positions, indices, weld_distance, uvs)
+            packed[i] = (positions, indices, uvs, key)
+            removed_verts += n_verts
+            removed_faces += n_faces
+        timings["weld"] = time.perf_counter() - start
+        print(f"焊接删除了 {removed_verts} 个重复顶点，{removed_faces} 个退化三角形")
+
+    start = time.perf_counter()
+    write_glb(output_file, packed, images, mesh_name=mesh_name)
+    timings["write"] = time.perf_counter() - start
+
+    num_verts = sum(len(p[0]) for p in packed)
+    num_faces = sum(len(p[1]) for p in packed) // 3
+    print(f"合并 {len(glb_files)} 个 GLB：{num_verts} 个顶点，{num_faces} 个三角形，{len(images)} 张贴图")
+    for phase, seconds in timings.items():
+        print(f"  {phase}: {seconds:.2f}s")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge all .glb files in a directory into one packed .glb without Blender")
+    parser.add_argument('--input_dir', required=True, help='Directory containing all .glb files to merge')
+    parser.add_argument('--output_file', required=True, help='Path to save the merged .glb file')
+    parser.add_argument('--weld_distance', type=float, default=0.0, help='Weld vertices closer than this distance in meters (0 disables)')
+    parser.add_argument('--crop_rad', type=float, default=None, help='Keep only geometry within [-rad, rad] on the world x/z axes')
+    args = parser.parse_args()
+    crop = None if args.crop_rad is None else (-args.crop_rad, args.crop_rad, -args.crop_rad, args.crop_rad)
+    merge_glbs(args.input_dir, args.output_file, weld_distance=args.weld_distance, crop=crop)
+
+
+if __name__ == "__main__":
+    main()
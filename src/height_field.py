@@ -0,0 +1,195 @@
+import os
+import json
+
+import numpy as np
+
+# 文件格式版本，读取时不一致则重新构建
+HEIGHT_FIELD_VERSION = 1
+# 单批光栅化的采样点数上限，控制峰值内存
+RASTER_CHUNK_POINTS = 4_000_000
+
+
+def triangle_lattice(n):
+    """
+    三角形上间隔 1/n 的重心坐标格点，返回 (m, 3)，m = (n + 1)(n + 2) / 2
+    """
+    i, j = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="ij")
+    keep = i + j <= n
+    w1, w2 = i[keep] / n, j[keep] / n
+    return np.column_stack((1.0 - w1 - w2, w1, w2))
+
+
+class HeightField:
+    """
+    网格自顶向下的高度场：在水平面 plane_axes 上按 resolution 划分网格，
+    每个格子记录落在其中的表面沿 up_axis 的最小 / 最大值（无表面为 NaN）。
+
+    - heights 形状为 (2, H, W)，[0] 为最小值，[1] 为最大值，heights[:, i, j] 对应格子中心
+      origin + (i + 0.5, j + 0.5) * resolution；
+    - 以 .npy + .json 存盘，load 时以 mmap 方式打开，查询直接读映射内存；
+    - query 用双线性插值回答批量的 "(a, b) 处表面高度" 查询，陡变处可回退到精确的光线求交。
+    """
+    def __init__(self, heights, origin, resolution, plane_axes=(0, 1), up_axis=2):
+        self.heights = heights
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.resolution = float(resolution)
+        self.plane_axes = tuple(plane_axes)
+        self.up_axis = int(up_axis)
+
+    @classmethod
+    def from_triangles(cls, vertices, faces, resolution=0.25, plane_axes=(0, 1), up_axis=2):
+        """
+        光栅化三角网格：每个三角形按不超过 resolution / 2 的间距取重心格点，
+        格点高度按所在格子做 min / max 归约
+        """
+        vertices = np.asarray(vertices, dtype=np.float64)
+        faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        plane = vertices[:, plane_axes]
+        origin = plane.min(axis=0)
+        shape = np.floor((plane.max(axis=0) - origin) / resolution).astype(np.int64) + 1
+        min_h = np.full(shape[0] * shape[1], np.inf)
+        max_h = np.full(shape[0] * shape[1], -np.inf)
+
+        tris = vertices[faces][:, :, list(plane_axes) + [up_axis]]     # (F, 3, 3)：两个平面坐标 + 高度
+        edges = tris[:, [1, 2, 0], :2] - tris[:, :, :2]
+        longest = np.linalg.norm(edges, axis=2).max(axis=1)
+        subdivisions = np.maximum(np.ceil(longest / (resolution / 2)), 1).astype(np.int64)
+
+        for n in np.unique(subdivisions):
+            lattice = triangle_lattice(int(n))
+            group = tris[subdivisions == n]
+            step = max(1, RASTER_CHUNK_POINTS // len(lattice))
+            for start in range(0, len(group), step):
+                points = np.einsum("mv,kvd->kmd", lattice, group[start:start + step]).reshape(-1, 3)
+                cells = np.floor((points[:, :2] - origin) / resolution).astype(np.int64)
+                np.clip(cells, 0, shape - 1, out=cells)
+                flat = cells[:, 0] * shape[1] + cells[:, 1]
+                np.minimum.at(min_h, flat, points[:, 2])
+                np.maximum.at(max_h, flat, points[:, 2])
+
+        heights = np.stack((min_h, max_h)).reshape(2, shape[0], shape[1])
+        heights[~np.isfinite(heights)] = np.nan
+        return cls(heights.astype(np.float32), origin, resolution, plane_axes, up_axis)
+
+    @classmethod
+    def from_trimesh(cls, mesh, resolution=0.25, plane_axes=(0, 1), up_axis=2):
+        return cls.from_triangles(mesh.vertices, mesh.faces, resolution, plane_axes, up_axis)
+
+    @staticmethod
+    def meta_path(path):
+        return f"{os.path.splitext(path)[0]}.json"
+
+    def save(self, path):
+        heights = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=self.heights.shape)
+        heights[:] = self.heights
+        heights.flush()
+        meta = {
+            "version": HEIGHT_FIELD_VERSION,
+            "origin": self.origin.tolist(),
+            "resolution": self.resolution,
+            "plane_axes": list(self.plane_axes),
+            "up_axis": self.up_axis,
+        }
+        with open(self.meta_path(path), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(cls.meta_path(path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != HEIGHT_FIELD_VERSION:
+            raise ValueError(f"Height field {path} has version {meta.get('version')}, expected {HEIGHT_FIELD_VERSION}")
+        heights = np.load(path, mmap_mode="r")
+        return cls(heights, meta["origin"], meta["resolution"], meta["plane_axes"], meta["up_axis"])
+
+    @classmethod
+    def load_or_build(cls, path, mesh, resolution=0.25, plane_axes=(0, 1), up_axis=2, source=None, build=None):
+        """
+        path 处已有同参数的高度场则直接映射，否则从 trimesh 网格构建并存盘。
+        给定 source（网格文件路径）时，source 比高度场新也会重新构建。
+        build: 可选的 build() -> HeightField，网格不是 trimesh 时用它代替 from_trimesh（此时 mesh 可为 None）
+        """
+        stale = source is not None and os.path.isfile(path) and os.path.getmtime(source) > os.path.getmtime(path)
+        if not stale and os.path.isfile(path) and os.path.isfile(cls.meta_path(path)):
+            try:
+                field = cls.load(path)
+            except ValueError as e:
+                print(f"{e}, rebuilding")
+            else:
+                if (field.resolution == resolution and field.plane_axes == tuple(plane_axes)
+                        and field.up_axis == up_axis):
+                    return field
+        field = build() if build is not None else cls.from_trimesh(mesh, resolution, plane_axes, up_axis)
+        field.save(path)
+        return field
+
+    def query(self, points, reduction="max", fallback=None, max_step=0.5):
+        """
+        批量查询表面高度。
+
+        - points: (N, 2) 的水平坐标，顺序与 plane_axes 一致；
+        - reduction: "min" / "max"，对应格子内最低 / 最高的表面；
+        - fallback: 可选的 fallback(points) -> (heights, valid)，对落在网格外、邻格缺失、
+          相邻格子高差或格内上下表面距离超过 max_step 的点做精确求交；不提供时这些点分别视为无效 / 取最近格子的值。
+
+        返回 (heights, valid)，valid 为 False 的位置高度无意义。
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        channel = self.heights[0 if reduction == "min" else 1]
+        shape = np.array(channel.shape)
+
+        u = (points - self.origin) / self.resolution - 0.5
+        inside = np.all((u > -0.5) & (u < shape - 0.5), axis=1)
+        base = np.clip(np.floor(u).astype(np.int64), 0, np.maximum(shape - 2, 0))
+        frac = np.clip(u - base, 0.0, 1.0)
+        i0, j0 = base[:, 0], base[:, 1]
+        i1, j1 = np.minimum(i0 + 1, shape[0] - 1), np.minimum(j0 + 1, shape[1] - 1)
+        corners = np.stack((channel[i0, j0], channel[i0, j1], channel[i1, j0], channel[i1, j1]), axis=1)
+        fi, fj = frac[:, 0], frac[:, 1]
+        heights = (corners[:, 0] * (1 - fi) * (1 - fj) + corners[:, 1] * (1 - fi) * fj
+                   + corners[:, 2] * fi * (1 - fj) + corners[:, 3] * fi * fj)
+
+        # 邻格高差大（陡坎）或格内上下表面相距远（墙面、悬挑）的位置插值不可靠
+        spans = [self.heights[1][i, j] - self.heights[0][i, j] for i, j in ((i0, j0), (i0, j1), (i1, j0), (i1, j1))]
+        missing = np.isnan(corners).any(axis=1)
+        with np.errstate(invalid="ignore"):
+            steep = ~missing & ((np.ptp(corners, axis=1) > max_step) | (np.max(spans, axis=0) > max_step))
+        valid = inside & ~missing
+
+        if fallback is not None:
+            exact = ~valid | steep
+            if exact.any():
+                exact_heights, exact_valid = fallback(points[exact])
+                heights[exact] = exact_heights
+                valid[exact] = exact_valid
+        else:
+            nearest = np.clip(np.rint(u).astype(np.int64), 0, shape - 1)
+            nearest_heights = channel[nearest[:, 0], nearest[:, 1]]
+            heights[steep] = nearest_heights[steep]
+            valid &= ~np.isnan(heights)
+        return heights, valid
+
+
+def trimesh_ray_heights(mesh, reduction="max", up_axis=2):
+    """
+    用 trimesh 沿 up_axis 的竖直光线做精确求交，作为 HeightField.query 的 fallback。
+    返回 fallback(points) -> (heights, valid)，points 为另外两个轴上的坐标。
+    """
+    plane_axes = [axis for axis in range(3) if axis != up_axis]
+
+    def fallback(points):
+        origins = np.zeros((len(points), 3))
+        origins[:, plane_axes] = points
+        origins[:, up_axis] = mesh.bounds[1][up_axis] + 1
+        directions = np.zeros_like(origins)
+        directions[:, up_axis] = -1
+        heights = np.full(len(points), -np.inf if reduction == "max" else np.inf)
+        locations, index_ray, _ = mesh.ray.intersects_location(origins, directions)
+        if len(index_ray):
+            reduce_at = np.maximum.at if reduction == "max" else np.minimum.at
+            reduce_at(heights, index_ray, locations[:, up_axis])
+        valid = np.isfinite(heights)
+        heights[~valid] = 0.0
+        return heights, valid
+
+    return fallback
@@ -1,23 +1,50 @@
 import bpy
+import bmesh
 import sys
 import os
+import time
 import argparse
 import mathutils
 import math
+import numpy as np
 
-def import_glb_files(input_dir):
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+import glb_merge
+
+def is_outside_crop(obj, crop):
+    """
+    判断导入的瓦片包围盒是否完全在裁剪范围外。
+    crop 为最终（重映射后）世界坐标下的 (x_min, x_max, z_min, z_max)，
+    对应导入时世界坐标的 x 和 -y。
+    """
+    corners = np.array([list(obj.matrix_world @ mathutils.Vector(c)) for c in obj.bound_box])
+    xs, zs = corners[:, 0], -corners[:, 1]
+    x_min, x_max, z_min, z_max = crop
+    return xs.max() < x_min or xs.min() > x_max or zs.max() < z_min or zs.min() > z_max
+
+def import_glb_files(input_dir, crop=None):
     """
-    导入所有 .glb 文件到场景
+    导入所有 .glb 文件到场景；给定 crop 时丢弃完全在范围外的瓦片
     """
     glb_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.glb')]
     imported_objects = []
+    skipped = 0
     for glb_file in glb_files:
         file_path = os.path.join(input_dir, glb_file)
         bpy.ops.import_scene.gltf(filepath=file_path)
+        if crop is not None:
+            bpy.context.view_layer.update()
         # 获取新导入的对象
         for obj in bpy.context.selected_objects:
             if obj.type == 'MESH':
+                if crop is not None and is_outside_crop(obj, crop):
+                    bpy.data.objects.remove(obj, do_unlink=True)
+                    skipped += 1
+                    continue
                 imported_objects.append(obj)
+    if skipped:
+        print(f"裁剪范围外的瓦片 {skipped} 个已跳过。")
     return imported_objects
 
 def merge_mesh_objects(mesh_objects):
@@ -73,6 +100,51 @@ def cleanup_scene():
             obj.select_set(True)
     bpy.ops.object.transform_apply(location=True, rotation=False, scale=False)
     bpy.ops.object.select_all(action='DESELECT')
+    delete_empty_objects()
+    # 提取mesh并集成父节点的世界平移
+    print("递归删除完成，只保留 mesh 对象，并集成父节点平移。")
+
+# (x, y, z) -> (x, z, -y)，与逐顶点循环中的坐标轴重映射一致
+AXIS_REMAP = np.array([[1.0, 0.0, 0.0],
+                       [0.0, 0.0, 1.0],
+                       [0.0, -1.0, 0.0]])
+
+def remap_vertices_loop(obj):
+    """
+    逐顶点重映射坐标轴（原始实现，保留用于对比测试）
+    """
+    mesh = obj.data
+    for v in mesh.vertices:
+        x, y, z = v.co
+        v.co = mathutils.Vector((x, z, -y))  # 重新映射坐标轴
+
+def remap_vertices_bulk(obj, offset=None):
+    """
+    用 foreach_get/foreach_set 批量重映射坐标轴，offset 为重映射前先加到顶点上的平移
+    """
+    mesh = obj.data
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    co = co.reshape(-1, 3).astype(np.float64)
+    if offset is not None:
+        co += offset
+    co = co @ AXIS_REMAP.T
+    mesh.vertices.foreach_set("co", co.astype(np.float32).ravel())
+    mesh.update()
+
+def apply_location_and_remap(obj):
+    """
+    一次遍历完成 cleanup_scene 中的解除父子关系 + 应用位移，以及坐标轴重映射：
+    父节点的世界变换折叠进物体矩阵，位移部分 (RS)^-1 t 直接加到顶点上，不再调用 transform_apply。
+    """
+    mw = np.array(obj.matrix_world)
+    offset = np.linalg.solve(mw[:3, :3], mw[:3, 3])
+    remap_vertices_bulk(obj, offset)
+    mw[:3, 3] = 0.0
+    obj.parent = None
+    obj.matrix_world = mathutils.Matrix(mw.tolist())
+
+def delete_empty_objects():
     while True:
         bpy.ops.object.select_all(action='DESELECT')
         to_delete = [obj for obj in bpy.context.scene.objects if is_empty_object(obj)]
@@ -83,8 +155,36 @@ def cleanup_scene():
             print(f"已递归删除 {len(to_delete)} 个空节点。")
         else:
             break
-    # 提取mesh并集成父节点的世界平移
-    print("递归删除完成，只保留 mesh 对象，并集成父节点平移。")
+
+def weld_mesh(obj, distance):
+    """
+    焊接合并后网格中距离小于 distance 的重复顶点（瓦片接缝），并删除退化面。
+    UV 保存在面角上，因此跨贴图的接缝顶点也能安全合并。
+    """
+    mesh = obj.data
+    num_verts, num_faces = len(mesh.vertices), len(mesh.polygons)
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=distance)
+    bmesh.ops.dissolve_degenerate(bm, dist=distance, edges=bm.edges)
+    bm.to_mesh(mesh)
+    bm.free()
+    mesh.update()
+    removed_verts = num_verts - len(mesh.vertices)
+    removed_faces = num_faces - len(mesh.polygons)
+    print(f"焊接 {obj.name}：删除 {removed_verts} 个重复顶点，{removed_faces} 个退化面")
+    return removed_verts, removed_faces
+
+def import_merged_glb(input_dir, output_file, weld_distance=0.0, crop=None):
+    """
+    用 NumPy 引擎把所有 .glb 合并为一个打包好的 .glb，再一次性导入 Blender。
+    坐标轴重映射已在合并时完成，无需逐顶点处理。
+    """
+    merged_glb = os.path.splitext(output_file)[0] + ".glb"
+    glb_merge.merge_glbs(input_dir, merged_glb, weld_distance=weld_distance, crop=crop)
+    bpy.ops.import_scene.gltf(filepath=merged_glb)
+    mesh_objects = [obj for obj in bpy.context.selected_objects if obj.type == 'MESH']
+    return merge_mesh_objects(mesh_objects)
 
 def main():
     if "--" not in sys.argv:
@@ -95,32 +195,59 @@ def main():
     parser = argparse.ArgumentParser(description="Merge all .glb files in a directory into one .blend file using Blender")
     parser.add_argument('--input_dir', required=True, help='Directory containing all .glb files to merge')
     parser.add_argument('--output_file', required=True, help='Path to save the output .blend file')
+    parser.add_argument('--engine', choices=['blender', 'numpy'], default='blender',
+                        help='blender: import and join every .glb; numpy: decode and pack all .glb outside Blender first')
+    parser.add_argument('--remap', choices=['bulk', 'loop'], default='bulk',
+                        help='bulk: remap axes with foreach_get/foreach_set in NumPy; loop: per-vertex Python loop')
+    parser.add_argument('--weld_distance', type=float, default=0.0,
+                        help='Weld vertices closer than this distance in meters across tile seams (0 disables)')
+    parser.add_argument('--crop_rad', type=float, default=None,
+                        help='Drop tiles (and, with the numpy engine, vertices) outside [-rad, rad] on the world x/z axes')
     args = parser.parse_args()
 
     input_dir = args.input_dir
     output_file = args.output_file
+    crop = None if args.crop_rad is None else (-args.crop_rad, args.crop_rad, -args.crop_rad, args.crop_rad)
 
     # 清空场景
     bpy.ops.object.select_all(action='SELECT')
     bpy.ops.object.delete(use_global=False)
 
     print(f"导入 {input_dir} 目录下的所有 .glb 文件并合并...")
-    mesh_objects = import_glb_files(input_dir)
-    merged_obj = merge_mesh_objects(mesh_objects)
+    merged_obj = None
+    if args.engine == 'numpy':
+        try:
+            merged_obj = import_merged_glb(input_dir, output_file, args.weld_distance, crop)
+        except glb_merge.UnsupportedGLB as e:
+            print(f"NumPy 合并不支持该数据（{e}），改用 Blender 合并。")
+            bpy.ops.object.select_all(action='SELECT')
+            bpy.ops.object.delete(use_global=False)
 
-    cleanup_scene()
+    if merged_obj is None:
+        mesh_objects = import_glb_files(input_dir, crop)
+        merged_obj = merge_mesh_objects(mesh_objects)
 
-    # 遍历所有 mesh 对象
-    for obj in bpy.data.objects:
-        if obj.type == 'MESH':
-            # 进入对象数据模式，处理网格数据
-            mesh = obj.data
-            for v in mesh.vertices:
-                x, y, z = v.co
-                v.co = mathutils.Vector((x, z, -y))  # 重新映射坐标轴
-
-            # 重置 rotation_euler 为原来的 -90 度（保留你的原始旋转）
-            obj.rotation_euler = (math.radians(-90), 0, 0)
+        start = time.perf_counter()
+        if args.remap == 'bulk':
+            for obj in bpy.data.objects:
+                if obj.type == 'MESH':
+                    apply_location_and_remap(obj)
+            delete_empty_objects()
+        else:
+            cleanup_scene()
+            for obj in bpy.data.objects:
+                if obj.type == 'MESH':
+                    remap_vertices_loop(obj)
+
+        # 遍历所有 mesh 对象，重置 rotation_euler 为原来的 -90 度（保留你的原始旋转）
+        for obj in bpy.data.objects:
+            if obj.type == 'MESH':
+                obj.rotation_euler = (math.radians(-90), 0, 0)
+        print(f"坐标轴重映射（{args.remap}）耗时 {time.perf_counter() - start:.2f}s")
+    # numpy 引擎在 merge_glbs 中只焊接了同一贴图分组内的顶点；相邻瓦片的接缝顶点分属不同贴图、UV 也不同，
+    # 两种引擎都在这里按位置跨材质焊接一次
+    if merged_obj and args.weld_distance > 0:
+        weld_mesh(merged_obj, args.weld_distance)
     if merged_obj:
         print(f"成功合并为对象: {merged_obj.name}")
         # 只保存合并后的对象
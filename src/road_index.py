@@ -0,0 +1,151 @@
+import os
+import json
+import pickle
+
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+
+# 文件格式版本，读取时不一致则视为不存在
+ROAD_INDEX_VERSION = 1
+# cKDTree.__getstate__ 中按数组存盘的字段下标：节点缓冲区与点的排序下标
+TREE_BUFFER, TREE_INDICES = 0, 7
+
+
+class RoadIndex:
+    """
+    stage 2 产出的道路参考点索引，供 create_mask 及后续各 stage 共用。
+
+    - points: (N, 4) 的 [x, y, z, road_id]，同一道路类型的点连续存放，type_slices[type] = (start, stop)，
+      各类型内部及 'all' 的点序与 create_mask.flat 原先拼接的顺序一致；
+    - road_types / road_params: 每条道路（road_id）的类型与拟合平面参数 (A, B, C, D, E, F)；
+    - 每个类型以及 'all' 在水平面 (x, z) 上的 cKDTree 一并存盘（节点缓冲区 + 下标），
+      load 时用 __setstate__ 直接恢复，不必反序列化 pickle 或重建树。
+      __setstate__ 会把节点缓冲区与下标复制进树，树中只有 xz 坐标仍是 mmap 视图；
+      points / road_params 同样以 mmap 方式打开，按需读取。
+
+    存盘为一个目录：points.npy / xz.npy / road_params.npy / tree_<i>_*.npy + meta.json。
+    """
+    def __init__(self, points, xz, type_slices, road_types, road_params, trees=None):
+        self.points = points
+        self.xz = xz
+        self.type_slices = dict(type_slices)
+        self.road_types = list(road_types)
+        self.road_params = road_params
+        self._trees = dict(trees or {})
+
+    @classmethod
+    def from_reference_points(cls, reference_points, road_info):
+        """
+        reference_points: smooth_sampled_points 返回的 street_view_loc_clean_all，(N, 4)；
+        road_info: smooth_sampled_points 返回的 road_info_dict，{road_id: {"type", "param"}}
+        """
+        types2road = {}
+        for road in road_info:
+            types2road.setdefault(road_info[road]['type'], []).append(road)
+        road_column = reference_points[:, 3]
+        chunks, type_slices, start = [], {}, 0
+        for type, roads in types2road.items():
+            type_chunks = [reference_points[road_column == road, :] for road in roads]
+            chunks.extend(type_chunks)
+            type_slices[type] = (start, start + sum(len(chunk) for chunk in type_chunks))
+            start = type_slices[type][1]
+        points = np.ascontiguousarray(np.concatenate(chunks, axis=0), dtype=np.float64)
+        road_types = [road_info[road]['type'] for road in sorted(road_info)]
+        road_params = np.array([road_info[road]['param'] for road in sorted(road_info)], dtype=np.float64).reshape(-1, 6)
+        return cls(points, np.ascontiguousarray(points[:, [0, 2]]), type_slices, road_types, road_params)
+
+    @property
+    def types(self):
+        return list(self.type_slices)
+
+    def reference_points(self):
+        """{type: (n, 4) 视图, 'all': 全部点}，与 create_mask.flat 原先构造的 reference_points 相同"""
+        result = {type: self.points[start:stop] for type, (start, stop) in self.type_slices.items()}
+        result['all'] = self.points
+        return result
+
+    def tree(self, type='all'):
+        if type not in self._trees:
+            start, stop = self.type_slices[type] if type != 'all' else (0, len(self.points))
+            self._trees[type] = cKDTree(self.xz[start:stop])
+        return self._trees[type]
+
+    def trees(self):
+        """{type: cKDTree, 'all': cKDTree}，键与 reference_points() 一致"""
+        return {type: self.tree(type) for type in self.types + ['all']}
+
+    def road_info(self):
+        """还原为 smooth_sampled_points 返回的 road_info_dict 格式"""
+        return {road: {"type": type, "param": tuple(params)}
+                for road, (type, params) in enumerate(zip(self.road_types, self.road_params))}
+
+    @staticmethod
+    def meta_path(path):
+        return os.path.join(path, "meta.json")
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+
+        def write(name, array):
+            out = np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode="w+",
+                                            dtype=array.dtype, shape=array.shape)
+            out[:] = array
+            out.flush()
+
+        write("points", self.points)
+        write("xz", self.xz)
+        write("road_params", self.road_params)
+        trees = []
+        for i, type in enumerate(self.types + ['all']):
+            state = self.tree(type).__getstate__()
+            write(f"tree_{i}_buffer", state[TREE_BUFFER])
+            write(f"tree_{i}_indices", state[TREE_INDICES])
+            trees.append({
+                "type": type,
+                "n": int(state[2]), "m": int(state[3]), "leafsize": int(state[4]),
+                "maxes": np.asarray(state[5]).tolist(), "mins": np.asarray(state[6]).tolist(),
+            })
+        meta = {
+            "version": ROAD_INDEX_VERSION,
+            "scipy": scipy.__version__,
+            "type_slices": {type: list(span) for type, span in self.type_slices.items()},
+            "road_types": self.road_types,
+            "trees": trees,
+        }
+        with open(self.meta_path(path), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(cls.meta_path(path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != ROAD_INDEX_VERSION:
+            raise ValueError(f"Road index {path} has version {meta.get('version')}, expected {ROAD_INDEX_VERSION}")
+
+        def read(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        index = cls(read("points"), read("xz"), {type: tuple(span) for type, span in meta["type_slices"].items()},
+                    meta["road_types"], read("road_params"))
+        # cKDTree 的状态布局随 scipy 版本可能变化，版本不同时按需重建
+        if meta.get("scipy") == scipy.__version__:
+            for i, info in enumerate(meta["trees"]):
+                type = info["type"]
+                start, stop = index.type_slices[type] if type != 'all' else (0, len(index.points))
+                tree = cKDTree.__new__(cKDTree)
+                tree.__setstate__((read(f"tree_{i}_buffer"), index.xz[start:stop], info["n"], info["m"],
+                                   info["leafsize"], np.array(info["maxes"]), np.array(info["mins"]),
+                                   read(f"tree_{i}_indices"), None, None))
+                index._trees[type] = tree
+        return index
+
+
+def load_reference_points(path):
+    """
+    读取参考地面点 (N, 4)：path 为 RoadIndex 目录时以 mmap 方式打开，否则按 street_view_loc_clean_all 的 pickle 读取
+    """
+    if os.path.isdir(path):
+        return RoadIndex.load(path).points
+    with open(path, "rb") as fb:
+        return pickle.load(fb)
@@ -0,0 +1,233 @@
+import os
+import json
+
+import numpy as np
+import shapely
+
+# 文件格式版本，读取时不一致则视为不存在
+ROAD_RASTER_VERSION = 1
+# 单批查询的格子数上限，控制峰值内存
+RASTER_CHUNK_CELLS = 1_000_000
+# ground 通道：不在任何地面多边形内 / 同时落在多个地面多边形内
+NO_GROUND, MULTIPLE_GROUNDS = -1, -2
+# 预览图中各通道的颜色
+GROUND_COLOR = (40, 110, 40)
+BUILDING_COLOR = (110, 110, 110)
+LAYER_COLORS = [(230, 60, 60), (240, 170, 40), (240, 240, 70), (70, 200, 230), (70, 110, 240),
+                (200, 90, 230), (240, 120, 170), (150, 240, 150)]
+
+
+class RoadRaster:
+    """
+    场景的道路走廊栅格：在水平面 (x, z) 上按 resolution 划分网格，每个格子中心记录
+
+    - labels: uint16 位掩码，第 i 位表示格子属于 layers[i]（某类道路中心线按宽度缓冲后的走廊，或建筑轮廓）；
+    - ground: 所在地面多边形的下标，NO_GROUND / MULTIPLE_GROUNDS 见上；
+    - height / road: 最近道路参考点的高度与道路 id。
+
+    格子 (i, j) 的中心为 origin + (i + 0.5, j + 0.5) * resolution，与 HeightField 相同。
+    查询均返回 (values, certain)：落在网格外、处于取值边界（3x3 邻域不一致）或高度陡变处的点
+    certain 为 False，调用方对这些点回退到 KD 树 / 多边形判断。
+    certain 只说明格子中心的 3x3 邻域取值一致：走廊是参考点圆盘的并集，格内的点仍可能落在走廊之间的缝隙里，
+    因此栅格给出的是近似结果，与逐点的 KD 树判断在走廊边缘附近可能不同。
+    以目录形式存盘（labels.npy / ground.npy / height.npy / road.npy + meta.json），load 时以 mmap 方式打开。
+    """
+    def __init__(self, labels, ground, height, road, origin, resolution, layers):
+        self.labels = labels
+        self.ground = ground
+        self.height = height
+        self.road = road
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.resolution = float(resolution)
+        self.layers = list(layers)
+        self._interior = {}
+
+    @classmethod
+    def from_road_index(cls, road_index, corridors, ground_polygons=(), buildings=(), resolution=0.5,
+                        height_radius=25.0):
+        """
+        road_index: RoadIndex；
+        corridors: {layer: [(道路类型, 宽度), ...]}，距任一列出类型的参考点小于对应宽度的格子属于该 layer；
+        ground_polygons / buildings: x, z 平面上的 shapely 多边形，建筑轮廓写入 "building" layer；
+        height_radius: 只记录距道路参考点 height_radius 以内格子的 height / road，更远处留空（查询时回退）
+        """
+        layers = list(corridors) + ["building"]
+        if len(layers) > 16:
+            raise ValueError(f"At most 16 layers fit in the label channel, got {len(layers)}")
+        max_width = max([width for members in corridors.values() for _, width in members], default=0.0)
+        bounds = [road_index.xz.min(axis=0) - max_width, road_index.xz.max(axis=0) + max_width]
+        for polygon in ground_polygons:
+            bounds[0] = np.minimum(bounds[0], polygon.bounds[:2])
+            bounds[1] = np.maximum(bounds[1], polygon.bounds[2:])
+        origin = bounds[0]
+        shape = np.floor((bounds[1] - origin) / resolution).astype(np.int64) + 1
+
+        labels = np.zeros(shape, dtype=np.uint16)
+        ground = np.full(shape, NO_GROUND, dtype=np.int32)
+        height = np.full(shape, np.nan, dtype=np.float32)
+        road = np.full(shape, -1, dtype=np.int32)
+
+        # 每种道路类型只做一次有上界的最近邻查询，各 layer 共用
+        type_widths = {}
+        for members in corridors.values():
+            for type, width in members:
+                if type in road_index.type_slices:
+                    type_widths[type] = max(type_widths.get(type, 0.0), width)
+        rows = max(1, RASTER_CHUNK_CELLS // shape[1])
+        for start in range(0, shape[0], rows):
+            centers = cls.cell_centers(origin, resolution, np.arange(start, min(start + rows, shape[0])),
+                                       np.arange(shape[1]))
+            flat_centers = centers.reshape(-1, 2)
+            distances = {type: road_index.tree(type).query(flat_centers, k=1, distance_upper_bound=width,
+                                                           workers=-1)[0]
+                         for type, width in type_widths.items()}
+            chunk = np.zeros(len(flat_centers), dtype=np.uint16)
+            for bit, members in enumerate(corridors.values()):
+                for type, width in members:
+                    if type in distances:
+                        chunk[distances[type] < width] |= np.uint16(1 << bit)
+            labels[start:start + rows] = chunk.reshape(centers.shape[:2])
+            if len(road_index.points):
+                _, nearest = road_index.tree('all').query(flat_centers, k=1, distance_upper_bound=height_radius,
+                                                          workers=-1)
+                found = nearest < len(road_index.points)
+                chunk_height = np.full(len(flat_centers), np.nan)
+                chunk_road = np.full(len(flat_centers), -1)
+                chunk_height[found] = road_index.points[nearest[found], 1]
+                chunk_road[found] = road_index.points[nearest[found], 3]
+                height[start:start + rows] = chunk_height.reshape(centers.shape[:2])
+                road[start:start + rows] = chunk_road.reshape(centers.shape[:2])
+
+        building_bit = np.uint16(1 << layers.index("building"))
+        for polygon in buildings:
+            i, j, inside = cls.rasterize_polygon(polygon, origin, resolution, shape)
+            labels[i[inside], j[inside]] |= building_bit
+        for ground_idx, polygon in enumerate(ground_polygons):
+            i, j, inside = cls.rasterize_polygon(polygon, origin, resolution, shape)
+            i, j = i[inside], j[inside]
+            ground[i, j] = np.where(ground[i, j] == NO_GROUND, ground_idx, MULTIPLE_GROUNDS)
+        return cls(labels, ground, height, road, origin, resolution, layers)
+
+    @staticmethod
+    def cell_centers(origin, resolution, rows, cols):
+        """rows × cols 个格子中心，形状 (len(rows), len(cols), 2)"""
+        x = origin[0] + (rows + 0.5) * resolution
+        z = origin[1] + (cols + 0.5) * resolution
+        return np.stack(np.meshgrid(x, z, indexing="ij"), axis=-1)
+
+    @classmethod
+    def rasterize_polygon(cls, polygon, origin, resolution, shape):
+        """多边形包围盒内的格子中心做一次 contains_xy，返回 (i, j, inside)"""
+        min_x, min_z, max_x, max_z = polygon.bounds
+        lower = np.clip(np.floor((np.array([min_x, min_z]) - origin) / resolution).astype(np.int64), 0, shape)
+        upper = np.clip(np.floor((np.array([max_x, max_z]) - origin) / resolution).astype(np.int64) + 1, 0, shape)
+        rows, cols = np.arange(lower[0], upper[0]), np.arange(lower[1], upper[1])
+        centers = cls.cell_centers(origin, resolution, rows, cols).reshape(-1, 2)
+        i, j = np.meshgrid(rows, cols, indexing="ij")
+        inside = shapely.contains_xy(polygon, centers[:, 0], centers[:, 1])
+        return i.reshape(-1), j.reshape(-1), inside
+
+    def cells(self, xz):
+        """(N, 2) 的 x, z 坐标所在的格子 (i, j, inside)，网格外的点 clip 到边缘格子"""
+        ij = np.floor((np.asarray(xz, dtype=np.float64).reshape(-1, 2) - self.origin) / self.resolution).astype(np.int64)
+        shape = np.array(self.labels.shape)
+        inside = np.all((ij >= 0) & (ij < shape), axis=1)
+        np.clip(ij, 0, shape - 1, out=ij)
+        return ij[:, 0], ij[:, 1], inside
+
+    @staticmethod
+    def neighborhood_reduce(values, reduce):
+        """3x3 邻域（边缘复制）上的逐元素归约，reduce 为 np.minimum / np.maximum / np.logical_and 等"""
+        padded = np.pad(values, 1, mode="edge")
+        h, w = values.shape
+        result = padded[1:h + 1, 1:w + 1].copy()
+        for di in range(3):
+            for dj in range(3):
+                result = reduce(result, padded[di:di + h, dj:dj + w])
+        return result
+
+    def interior(self, key, values):
+        """3x3 邻域内取值全部相同的格子，按 key 缓存"""
+        if key not in self._interior:
+            values = np.asarray(values)
+            self._interior[key] = (self.neighborhood_reduce(values, np.minimum) ==
+                                   self.neighborhood_reduce(values, np.maximum))
+        return self._interior[key]
+
+    def layer(self, name, xz):
+        """返回 (属于 layer, certain)"""
+        bit = self.layers.index(name)
+        i, j, inside = self.cells(xz)
+        flags = ((np.asarray(self.labels)[i, j] >> bit) & 1).astype(bool)
+        if ("layer", bit) not in self._interior:
+            self.interior(("layer", bit), (np.asarray(self.labels) >> bit) & 1)
+        return flags, inside & self._interior[("layer", bit)][i, j]
+
+    def ground_index(self, xz):
+        """返回 (地面多边形下标, certain)，certain 的点只落在该多边形内或不在任何多边形内"""
+        i, j, inside = self.cells(xz)
+        ids = np.asarray(self.ground)[i, j]
+        return ids, inside & (ids != MULTIPLE_GROUNDS) & self.interior("ground", self.ground)[i, j]
+
+    def nearest_y(self, xz, y, max_step=0.05, close_y=2.0):
+        """
+        最近道路参考点的 (高度, 道路 id, certain)，即 create_mask.nearest_y_batched 的选点结果。
+        只在邻域高度差不超过 max_step、且顶点高度 y 与该高度相差不到 close_y 时视为可信：
+        此时 40 个近邻中第一个高差不超过 close_y 的点通常就是最近点。
+        格子中心之间的参考点可能被漏掉，返回的高度与道路 id 是近似值
+        """
+        i, j, inside = self.cells(xz)
+        heights = np.asarray(self.height)[i, j].astype(np.float64)
+        if "height_ptp" not in self._interior:
+            height = np.asarray(self.height)
+            self._interior["height_ptp"] = (self.neighborhood_reduce(height, np.fmax) -
+                                            self.neighborhood_reduce(height, np.fmin))
+        with np.errstate(invalid="ignore"):
+            certain = (inside & (self._interior["height_ptp"][i, j] <= max_step) &
+                       (np.abs(np.asarray(y) - heights) <= close_y - max_step))
+        return heights, np.asarray(self.road)[i, j], certain
+
+    def preview(self):
+        """(W, H, 3) 的 uint8 预览图：地面为绿色，建筑为灰色，道路走廊按 layer 着色（靠前的 layer 在上层）"""
+        image = np.zeros(self.labels.shape + (3,), dtype=np.uint8)
+        image[np.asarray(self.ground) != NO_GROUND] = GROUND_COLOR
+        labels = np.asarray(self.labels)
+        for bit in reversed(range(len(self.layers))):
+            color = BUILDING_COLOR if self.layers[bit] == "building" else LAYER_COLORS[bit % len(LAYER_COLORS)]
+            image[((labels >> bit) & 1).astype(bool)] = color
+        return image.transpose(1, 0, 2)
+
+    def save_preview(self, path):
+        from PIL import Image
+        Image.fromarray(self.preview()).save(path)
+
+    @staticmethod
+    def meta_path(path):
+        return os.path.join(path, "meta.json")
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ("labels", "ground", "height", "road"):
+            array = getattr(self, name)
+            out = np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode="w+",
+                                            dtype=array.dtype, shape=array.shape)
+            out[:] = array
+            out.flush()
+        meta = {
+            "version": ROAD_RASTER_VERSION,
+            "origin": self.origin.tolist(),
+            "resolution": self.resolution,
+            "layers": self.layers,
+        }
+        with open(self.meta_path(path), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(cls.meta_path(path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != ROAD_RASTER_VERSION:
+            raise ValueError(f"Road raster {path} has version {meta.get('version')}, expected {ROAD_RASTER_VERSION}")
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                  for name in ("labels", "ground", "height", "road")]
+        return cls(*arrays, meta["origin"], meta["resolution"], meta["layers"])
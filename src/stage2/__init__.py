@@ -1,5 +1,5 @@
 from .export_glb import export_glb
 from .align_road import align_road
 from .smooth_points import smooth_sampled_points
-from .create_mask import create_masks
+from .create_mask import create_masks, build_road_raster
 from .cut_glbs import cut_selected_mesh_xz
\ No newline at end of file
@@ -1,19 +1,24 @@
 import os
-import pdb
 import open3d as o3d
 import pickle
 import osmnx as ox
 from shapely.strtree import STRtree
 from shapely.geometry import Point, Polygon
 import math
+import shapely
 import requests
 import trimesh
 from tqdm import tqdm
 import numpy as np
 from scipy.spatial import cKDTree
+from .osm_cache import OSMCache, DEFAULT_TTL
+from height_field import HeightField, trimesh_ray_heights
+
+# 可通过环境变量指向本地替身服务（见 overpass_stub.py）
+OVERPASS_URL = os.environ.get("OVERPASS_URL", "http://overpass-api.de/api/interpreter")
 
 def fetch_buildings(lat, lng, rad):
-    overpass_url = "http://overpass-api.de/api/interpreter"
+    overpass_url = OVERPASS_URL
     overpass_query = f"""
     [out:json];
     (
@@ -29,54 +34,118 @@ def fetch_buildings(lat, lng, rad):
     return data
 
 
+def index_osm_elements(data):
+    """
+    为 Overpass 响应建立 id 索引，避免在 elements 上反复线性查找。
+    返回 (node_index: {node_id: 行号}, node_coords: (N, 2) 的 [lon, lat] 数组, ways: {way_id: way})
+    """
+    nodes = [element for element in data['elements'] if element['type'] == 'node']
+    node_index = {node['id']: i for i, node in enumerate(nodes)}
+    node_coords = np.array([(node['lon'], node['lat']) for node in nodes], dtype=np.float64).reshape(-1, 2)
+    ways = {element['id']: element for element in data['elements'] if element['type'] == 'way'}
+    return node_index, node_coords, ways
+
+
+def way_coords(node_ids, node_index, node_coords):
+    """按节点 id 序列取出 (n, 2) 的 [lon, lat] 坐标，缺失的节点跳过"""
+    rows = [node_index[node_id] for node_id in node_ids if node_id in node_index]
+    return node_coords[rows]
+
+
+def assemble_rings(node_lists):
+    """
+    把 multipolygon relation 的成员 way（节点 id 序列）按公共端点首尾相接拼成闭合环。
+    已闭合的 way 直接成环，最终无法闭合的残段丢弃。
+    """
+    rings = []
+    open_ways = []
+    for nodes in node_lists:
+        if len(nodes) < 2:
+            continue
+        if nodes[0] == nodes[-1]:
+            rings.append(list(nodes))
+        else:
+            open_ways.append(nodes)
+
+    ways_by_end = {}
+    for idx, nodes in enumerate(open_ways):
+        ways_by_end.setdefault(nodes[0], []).append(idx)
+        ways_by_end.setdefault(nodes[-1], []).append(idx)
+    used = [False] * len(open_ways)
+    for start in range(len(open_ways)):
+        if used[start]:
+            continue
+        used[start] = True
+        ring = list(open_ways[start])
+        while ring[0] != ring[-1]:
+            next_idx = next((idx for idx in ways_by_end[ring[-1]] if not used[idx]), None)
+            if next_idx is None:
+                break
+            used[next_idx] = True
+            nodes = open_ways[next_idx]
+            ring.extend(nodes[1:] if nodes[0] == ring[-1] else nodes[-2::-1])
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+    return rings
+
+
+def assemble_multipolygon(relation, ways, node_index, node_coords):
+    """把 multipolygon relation 组装成若干带洞的 Polygon：inner 环归属到包含它的 outer 环"""
+    members = {'outer': [], 'inner': []}
+    for member in relation['members']:
+        if member['type'] == 'way' and member['ref'] in ways:
+            # 缺省 role 按 outer 处理
+            members['inner' if member.get('role') == 'inner' else 'outer'].append(ways[member['ref']]['nodes'])
+
+    def ring_coords(rings):
+        coords = [way_coords(ring, node_index, node_coords) for ring in rings]
+        return [c for c in coords if len(c) >= 4]
+
+    outers = [Polygon(c) for c in ring_coords(assemble_rings(members['outer']))]
+    holes = [[] for _ in outers]
+    for inner in ring_coords(assemble_rings(members['inner'])):
+        probe = Point(inner[0])
+        owner = next((i for i, outer in enumerate(outers) if outer.intersects(probe)), None)
+        if owner is not None:
+            holes[owner].append(inner)
+    return [Polygon(outer.exterior.coords, hole) if hole else outer for outer, hole in zip(outers, holes)]
+
+
 # Step 2: Parse the building data and create Shapely polygons
 def parse_buildings(data):
-    # Step 1: Create a dictionary for nodes
-    nodes = {element['id']: (element['lat'], element['lon']) for element in data['elements'] if
-             element['type'] == 'node'}
-    nodes_1 = {element['id']: element for element in data['elements'] if
-             element['type'] != 'node'}
+    node_index, node_coords, ways = index_osm_elements(data)
+    relations = [element for element in data['elements'] if element['type'] == 'relation']
+    member_way_ids = {member['ref'] for relation in relations for member in relation['members']
+                      if member['type'] == 'way'}
     buildings = []
 
-    # Step 2: Create polygons for ways
-    for element in data['elements']:
-        if element['type'] == 'way' and 'members' not in element and len(element['nodes']) > 3:
-            try:
-                coords = [(nodes[node_id][1], nodes[node_id][0]) for node_id in element['nodes']]
-                if len(coords) < 4:
-                    pdb.set_trace()
-                buildings.append(Polygon(coords))
-            except KeyError:
-                # Handle the case where node_id is not found in nodes
-                continue
-
-        # Step 3: Handle relations (multipolygon)
-        elif element['type'] == 'relation' or 'members' in element:
-            outer_coords = []
-            for member in element['members']:
-                if member['role'] == 'outer' and member['type'] == 'way':
-                    way_id = member['ref']
-                    if way_id in [way['id'] for way in data['elements'] if way['type'] == 'way']:
-                        way = next(way for way in data['elements'] if way['id'] == way_id)
-                        outer_coords.extend([(nodes[node_id][1], nodes[node_id][0]) for node_id in way['nodes']])
+    # 独立的建筑 way；只作为 relation 成员出现（无 building 标签）的 way 交给 relation 组装
+    for way in ways.values():
+        if way['id'] in member_way_ids and 'building' not in way.get('tags', {}):
+            continue
+        if len(way['nodes']) > 3 and all(node_id in node_index for node_id in way['nodes']):
+            buildings.append(Polygon(way_coords(way['nodes'], node_index, node_coords)))
 
-            if outer_coords:
-                outer_polygon = Polygon(outer_coords)
-                buildings.append(outer_polygon)
+    # multipolygon relation
+    for relation in relations:
+        buildings.extend(assemble_multipolygon(relation, ways, node_index, node_coords))
 
     return buildings
 
 
 def are_points_outside_buildings(lat_lng_list, buildings):
-    result = []
-    for p in lat_lng_list:
-        point = Point(p)
-        possible_polygons = buildings.query(point)
-        if not any(poly.contains(point) for poly in possible_polygons):
-            result.append(True)
-        else:
-            result.append(False)
-    return np.array(result)
+    """
+    lat_lng_list: (N, 2) 的 [lat, lng]；buildings: 以 (lng, lat) 建立的建筑 STRtree。
+    一次 STRtree.query(points, predicate='within') 批量判断，返回 N 个布尔值，True 表示不在任何建筑内
+    """
+    lat_lng = np.asarray(lat_lng_list, dtype=np.float64).reshape(-1, 2)
+    outside = np.ones(len(lat_lng), dtype=bool)
+    if len(lat_lng) == 0:
+        return outside
+    points = shapely.points(lat_lng[:, 1], lat_lng[:, 0])
+    point_indices, _ = buildings.query(points, predicate='within')
+    outside[point_indices] = False
+    return outside
 
 
 def is_point_in_building(lat, lng, buildings):
@@ -87,61 +156,78 @@ def is_point_in_building(lat, lng, buildings):
     return False
 
 
-def reorder_points(points_list, nodes_list):
-    nodes_table = {}
-    for idx, nodes in enumerate(nodes_list):
-        assert len(nodes) > 1
-        for node in [nodes[0], nodes[-1]]:
-            if node not in nodes_table:
-                nodes_table[node] = []
-            nodes_table[node].append(idx)
-
-    ordered_points = []
-    ordered_nodes = []
-    starting_nodes = []
-    for k, v in nodes_table.items():
-        if len(v) % 2 == 1:
-            starting_nodes.append((k, v[0]))
-            nodes_table[k] = v[1:]
-    current_node = starting_nodes[0][0]
-    current_idx = starting_nodes[0][1]
-    ordered_points.append(points_list[current_idx])
-    ordered_nodes.append(nodes_list[current_idx])
-    processed_starting_nodes = [current_node]
-    counter = 0
-    while len(processed_starting_nodes) < len(starting_nodes):
-        counter += 1
-        if counter > 1000:
-            return sum(points_list, [])
-        start_n, end_n = nodes_list[current_idx][0], nodes_list[current_idx][-1]
-        current_node = start_n if end_n == current_node else end_n
-        if len(nodes_table[current_node]) == 2:
-            current_idx = nodes_table[current_node][0] if nodes_table[current_node][1] == current_idx else (
-                nodes_table)[current_node][1]
-        elif len(nodes_table[current_node]) == 0:
-            processed_starting_nodes.append(current_node)
-            if len(processed_starting_nodes) < len(starting_nodes):
-                for node in starting_nodes:
-                    if node[0] not in processed_starting_nodes:
-                        current_node = node[0]
-                        current_idx = node[1]
-                        break
+def chain_way_polylines(points_list, nodes_list):
+    """
+    把同名道路的多条 way 按公共端点首尾相接成有序折线，线性时间。
+
+    以 way 的首尾节点为顶点、每条 way 为一条边建多重图，再加一个虚拟顶点连向所有奇度顶点，
+    使全部顶点变为偶度；Hierholzer 算法求欧拉回路后在虚拟边处断开，
+    得到的就是覆盖所有 way 且条数最少的一组折线（分叉处自然断开，环路自成一条）。
+
+    points_list: 每条 way 的采样点，(n_i, 2) 数组；nodes_list: 每条 way 的节点 id 序列。
+    返回有序折线列表，每条为 (m, 2) 数组；反向经过的 way 其采样点也会反转，连接处的重复点只保留一个。
+    """
+    virtual = None
+    ends = [(nodes[0], nodes[-1]) for nodes in nodes_list]
+    adjacency = {}
+    for edge, (u, v) in enumerate(ends):
+        adjacency.setdefault(u, []).append(edge)
+        adjacency.setdefault(v, []).append(edge)
+    # 自环 way 在其端点处出现两次，度数自然为偶
+    odd_nodes = [node for node, edges in adjacency.items() if len(edges) % 2 == 1]
+    for node in odd_nodes:
+        edge = len(ends)
+        ends.append((virtual, node))
+        adjacency.setdefault(virtual, []).append(edge)
+        adjacency[node].append(edge)
+
+    used = [False] * len(ends)
+    cursor = {node: 0 for node in adjacency}
+
+    def euler_circuit(start):
+        # 迭代版 Hierholzer，返回按遍历顺序排列的 (边, 出发顶点)
+        stack = [(start, None)]
+        circuit = []
+        while stack:
+            node, arrived_by = stack[-1]
+            edges = adjacency[node]
+            while cursor[node] < len(edges) and used[edges[cursor[node]]]:
+                cursor[node] += 1
+            if cursor[node] < len(edges):
+                edge = edges[cursor[node]]
+                used[edge] = True
+                u, v = ends[edge]
+                stack.append((v if u == node else u, (edge, node)))
+            else:
+                stack.pop()
+                if arrived_by is not None:
+                    circuit.append(arrived_by)
+        circuit.reverse()
+        return circuit
+
+    starts = [virtual] if odd_nodes else []
+    starts += [ends[edge][0] for edge in range(len(points_list))]
+    polylines = []
+    for start in starts:
+        current = []
+        for edge, from_node in euler_circuit(start):
+            if edge >= len(points_list):
+                # 虚拟边：当前折线结束
+                if current:
+                    polylines.append(np.concatenate(current))
+                current = []
                 continue
-        else:
-            for j, idx in enumerate(nodes_table[current_node]):
-                if idx == current_idx:
-                    nodes_table[current_node].remove(current_idx)
-                    current_idx = nodes_table[current_node][0]
-                    nodes_table[current_node].remove(current_idx)
-                    break
-        ordered_points.append(points_list[current_idx])
-        ordered_nodes.append(nodes_list[current_idx])
-    ordered_points = sum(ordered_points, [])
-    return np.array(ordered_points)
+            points = np.asarray(points_list[edge]).reshape(-1, 2)
+            if from_node != ends[edge][0]:
+                points = points[::-1]
+            current.append(points[1:] if current else points)
+        if current:
+            polylines.append(np.concatenate(current))
+    return polylines
 
 
 def get_roads(lat, lng, radius):
-    overpass_url = "http://overpass-api.de/api/interpreter"
+    overpass_url = OVERPASS_URL
 
     overpass_query = f"""
     [out:json];
@@ -163,134 +249,248 @@ def get_roads(lat, lng, radius):
         return None
 
 
+GROUND_TAGS = {
+    'leisure': ['park', 'pitch', 'playground'],
+    'landuse': ['grass', 'meadow', 'recreation_ground'],
+    'natural': ['grassland', 'meadow'],
+    'amenity': ['parking']
+}
+
+
 def get_ground_areas(lat, lng, radius):
     location_point = (lat, lng)
-    tags = {
-        'leisure': ['park', 'pitch', 'playground'],
-        'landuse': ['grass', 'meadow', 'recreation_ground'],
-        'natural': ['grassland', 'meadow'],
-        'amenity': ['parking']
-    }
+    tags = GROUND_TAGS
+    if "OVERPASS_URL" in os.environ:
+        # osmnx 1.x / 2.x 的设置项名称不同
+        ox.settings.overpass_endpoint = OVERPASS_URL.rsplit("/", 1)[0]
+        ox.settings.overpass_url = OVERPASS_URL.rsplit("/", 1)[0]
     gdf = ox.features_from_point(location_point, tags, dist=radius)
     gdf_polygons = gdf[gdf.geometry.type == 'Polygon']
     return gdf_polygons
 
 
-def sample_points_on_way(way_nodes, num_points=100):
-    lats = [node['lat'] for node in way_nodes]
-    lons = [node['lon'] for node in way_nodes]
+def fetch_osm_features(lat, lng, radius):
+    """
+    一次 Overpass 请求同时取回道路、建筑和地面区域。
+    地面区域与 osmnx.features_from_point 一样使用以 (lat, lng) 为中心、半边长 radius 的包围盒。
+    """
+    d_lat = math.degrees(radius / 6371009)
+    d_lng = math.degrees(radius / (6371009 * math.cos(math.radians(lat))))
+    bbox = f"{lat - d_lat},{lng - d_lng},{lat + d_lat},{lng + d_lng}"
+    ground_filters = "\n".join(
+        f'      way["{key}"~"^({"|".join(values)})$"]({bbox});' for key, values in GROUND_TAGS.items()
+    )
+    overpass_query = f"""
+    [out:json];
+    (
+      way["highway"](around:{radius},{lat},{lng});
+      way["building"](around:{radius},{lat},{lng});
+      relation["building"](around:{radius},{lat},{lng});
+{ground_filters}
+    );
+    out body;
+    >;
+    out skel qt;
+    """
+    response = requests.get(OVERPASS_URL, params={'data': overpass_query})
+    if response.status_code == 200:
+        return response.json()
+    print(f"Error: {response.status_code}")
+    return None
+
+
+def is_ground_element(tags):
+    return any(tags.get(key) in values for key, values in GROUND_TAGS.items())
 
-    lat_samples = np.interp(np.linspace(0, len(lats) - 1, num_points), np.arange(len(lats)), lats)
-    lon_samples = np.interp(np.linspace(0, len(lons) - 1, num_points), np.arange(len(lons)), lons)
+
+def split_osm_features(data):
+    """
+    把 fetch_osm_features 的合并响应拆成 align_road 原本使用的三种结构：
+    (get_roads 格式的道路数据, fetch_buildings 格式的建筑数据, get_ground_areas 格式的地面 GeoDataFrame)
+    """
+    import geopandas as gpd
+
+    nodes = [element for element in data['elements'] if element['type'] == 'node']
+    node_coords = {node['id']: (node['lon'], node['lat']) for node in nodes}
+    road_ways, building_elements, ground_rows, ground_geoms = [], [], [], []
+    building_member_ids = set()
+    for element in data['elements']:
+        tags = element.get('tags', {})
+        if element['type'] == 'relation' and 'building' in tags:
+            building_elements.append(element)
+            building_member_ids.update(m['ref'] for m in element['members'] if m['type'] == 'way')
+        elif element['type'] == 'way' and tags:
+            if 'highway' in tags:
+                road_ways.append(element)
+            if 'building' in tags:
+                building_elements.append(element)
+            if is_ground_element(tags):
+                way_nodes = element['nodes']
+                if len(way_nodes) >= 4 and way_nodes[0] == way_nodes[-1] and all(n in node_coords for n in way_nodes):
+                    ground_rows.append(dict(tags, element_type='way', osmid=element['id']))
+                    ground_geoms.append(Polygon([node_coords[n] for n in way_nodes]))
+    # 与 fetch_buildings 的 ">" 递归输出一致：建筑 relation 的成员 way 也一并交给 parse_buildings
+    building_elements.extend(element for element in data['elements']
+                             if element['type'] == 'way' and element['id'] in building_member_ids)
+
+    road_data = {'elements': road_ways + nodes}
+    building_data = {'elements': building_elements + nodes}
+    ground_data = gpd.GeoDataFrame(ground_rows, geometry=ground_geoms, crs="EPSG:4326")
+    return road_data, building_data, ground_data
+
+
+# 各类道路沿线的采样间距（米），未列出的类型使用 DEFAULT_SAMPLE_SPACING
+HIGHWAY_SAMPLE_SPACING = {
+    'motorway': 3.0,
+    'trunk': 3.0,
+    'primary': 2.0,
+    'secondary': 2.0,
+    'tertiary': 1.5,
+    'residential': 1.5,
+    'unclassified': 1.5,
+    'service': 1.0,
+    'living_street': 1.0,
+    'pedestrian': 1.0,
+    'cycleway': 1.0,
+    'footway': 0.5,
+    'path': 0.5,
+    'steps': 0.5,
+}
+DEFAULT_SAMPLE_SPACING = 1.0
+
+
+def sample_points_on_way(way_nodes, spacing=DEFAULT_SAMPLE_SPACING, radius=6371000):
+    """
+    沿 way 的真实长度按弧长等间距采样，相邻采样点间距不超过 spacing 米，两端点总会被采到。
+    way_nodes: (n, 2) 的 [lat, lon] 数组
+    """
+    if len(way_nodes) < 2:
+        return np.asarray(way_nodes, dtype=np.float64).reshape(-1, 2)
+    lats = way_nodes[:, 0]
+    lons = way_nodes[:, 1]
+
+    # 局部等距近似下的分段长度，足以覆盖场景半径内的 way
+    d_north = np.radians(np.diff(lats)) * radius
+    d_east = np.radians(np.diff(lons)) * radius * np.cos(np.radians((lats[:-1] + lats[1:]) / 2))
+    arc_length = np.concatenate(([0.0], np.cumsum(np.hypot(d_north, d_east))))
+    num_points = max(int(np.ceil(arc_length[-1] / spacing)) + 1, 2)
+    samples = np.linspace(0.0, arc_length[-1], num_points)
+
+    lat_samples = np.interp(samples, arc_length, lats)
+    lon_samples = np.interp(samples, arc_length, lons)
 
     return np.column_stack((lat_samples, lon_samples))
 
 
-def sample_points_on_polygon(polygon, density=0.00001):
+def sample_points_on_polygon(polygon, density=1.0):
+    """
+    在 polygon 内按间距 density（与 polygon 坐标同单位，align_road 中为米）取规则网格点，
+    用 shapely.contains_xy 批量判断包含关系，返回 (n, 2) 数组
+    """
     min_x, min_y, max_x, max_y = polygon.bounds
     x_coords = np.arange(min_x, max_x, density)
     y_coords = np.arange(min_y, max_y, density)
-    points = np.array([(x, y) for x in x_coords for y in y_coords if polygon.contains(Point(x, y))])
-    return points
+    grid_x, grid_y = np.meshgrid(x_coords, y_coords, indexing='ij')
+    grid_x, grid_y = grid_x.ravel(), grid_y.ravel()
+    inside = shapely.contains_xy(polygon, grid_x, grid_y)
+    return np.column_stack((grid_x[inside], grid_y[inside]))
 
 
 def latlng_to_xyz(lat, lng, origin_lat, origin_lng, radius=6371000):
-    lat_diff = -math.radians(lat - origin_lat)
-    lng_diff = math.radians(lng - origin_lng)
+    """lat / lng 可以是标量或同形状的数组"""
+    lat_diff = -np.radians(np.subtract(lat, origin_lat))
+    lng_diff = np.radians(np.subtract(lng, origin_lng))
 
     x = lng_diff * radius * math.cos(math.radians(origin_lat))
     z = lat_diff * radius
     return x, z
 
 
+def ring_to_xyz(ring, origin_lat, origin_lng):
+    lng, lat = np.asarray(ring.coords).T
+    x, z = latlng_to_xyz(lat, lng, origin_lat, origin_lng)
+    return np.column_stack((x, z))
+
+
 def polygon_to_xyz(polygon, origin_lat, origin_lng):
-    xz_coords = [latlng_to_xyz(lat, lng, origin_lat, origin_lng) for lng, lat in polygon.exterior.coords]
-    return Polygon(xz_coords)
+    """外轮廓与内洞（庭院、建筑挖空）一并转换到局部 xz 平面"""
+    return Polygon(ring_to_xyz(polygon.exterior, origin_lat, origin_lng),
+                   [ring_to_xyz(interior, origin_lat, origin_lng) for interior in polygon.interiors])
 
 
-def find_mesh_upper_bound_y(mesh, xz_list):
+def find_mesh_upper_bound_y(mesh, xz_list, height_field=None):
+    """
+    查询 xz_list 处网格表面的高度，返回命中点的 (x, y, z)，全部未命中时返回 None。
+    给定 height_field 时走高度场查表，陡变或缺失处回退到光线求交；否则全部用光线求交。
+    """
+    xz = np.asarray(xz_list, dtype=np.float64).reshape(-1, 2)
     bounds = mesh.bounds
-    filtered_xz_list = np.array([[x, z, bounds[1][2] + 1] for x, z in xz_list if bounds[0][0] < x < bounds[1][0] and
-                                  bounds[0][1] < z < bounds[1][1]])
-    if len(filtered_xz_list) == 0:
+    xz = xz[(bounds[0][0] < xz[:, 0]) & (xz[:, 0] < bounds[1][0]) &
+            (bounds[0][1] < xz[:, 1]) & (xz[:, 1] < bounds[1][1])]
+    if len(xz) == 0:
         return None
-    ray_directions = np.array([[0, 0, -1]] * len(filtered_xz_list))
-    locations, index_ray, index_tri = mesh.ray.intersects_location(filtered_xz_list, ray_directions)
-    if len(index_ray) == 0:
+    # glb 坐标下世界 y 为 -z，"上界" 即最小的 z
+    ray_heights = trimesh_ray_heights(mesh, reduction="min")
+    if height_field is not None:
+        heights, valid = height_field.query(xz, reduction="min", fallback=ray_heights)
+    else:
+        heights, valid = ray_heights(xz)
+    if not valid.any():
         return None
-    unique_indices, inverse_indices = np.unique(index_ray, return_inverse=True)
-    min_y = np.full(unique_indices.shape, np.inf)
-    np.minimum.at(min_y, inverse_indices, locations[:, -1])
-    valid_indices = min_y != np.inf
-    result_xz = filtered_xz_list[unique_indices[valid_indices]]
-    result_y = -min_y[valid_indices]
-    return np.column_stack((result_xz[:, 0], result_y, result_xz[:, 1]))
+    return np.column_stack((xz[valid, 0], -heights[valid], xz[valid, 1]))
+
+
+def future_points_support(height_list, step_list, direction, height_diff, future_points_num):
+    """
+    对每个点 k，统计沿 direction（-1 向左 / +1 向右）之后 future_points_num 个点 j 中满足
+    |h[k] - h[j]| / step[j] <= height_diff 的个数；step[j] 为 j 与其前一个点（朝 k 方向）的水平距离
+    """
+    n = len(height_list)
+    support = np.zeros(n, dtype=np.int64)
+    k = np.arange(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for offset in range(1, future_points_num + 1):
+            j = k + direction * offset
+            in_range = (j >= 0) & (j < n)
+            kk, jj = k[in_range], j[in_range]
+            # 左侧 step_list[j] 为 |loc[j] - loc[j+1]|，右侧为 |loc[j] - loc[j-1]|
+            steps = step_list[jj] if direction < 0 else step_list[jj - 1]
+            support[kk] += np.abs(height_list[kk] - height_list[jj]) / steps <= height_diff
+    return support
 
 
 def filter_anomalous_points(points, height_diff=0.5, height_diff_max=0.8, future_points_num=10, future_points_ratio=0.8):
+    """
+    从最低点出发向两侧逐点生长：与上一个接受点的坡度不超过 height_diff 且高差小于 height_diff_max 的点直接接受；
+    坡度超限但高差不超过 height_diff_max 时，若之后 future_points_num 个点中至少 future_points_ratio 比例与它坡度相容，也接受。
+    前瞻计数只依赖点本身，用 NumPy 滑窗一次算出，生长过程为单次线性扫描。
+    """
     if len(points) == 0:
         return []
-    loc_list = points[:, [0,2]]
-    height_list = points[:, 1]
-    lowest_point_index = np.argmin(height_list)
-    lowest_height = np.min(height_list)
-    lowest_loc = loc_list[lowest_point_index]
-    left_height = lowest_height
-    right_height = lowest_height
-    left_loc = lowest_loc
-    right_loc = lowest_loc
-    points_valid = [False] * len(points)
+    points = np.asarray(points)
+    loc_list = points[:, [0, 2]].astype(np.float64)
+    height_list = points[:, 1].astype(np.float64)
+    step_list = np.linalg.norm(np.diff(loc_list, axis=0), axis=1)   # step_list[i] = |loc[i+1] - loc[i]|
+    lowest_point_index = int(np.argmin(height_list))
+    required = future_points_ratio * future_points_num
+    points_valid = np.zeros(len(points), dtype=bool)
     points_valid[lowest_point_index] = True
-    for i in range(max(len(points) - lowest_point_index, lowest_point_index)):
-        left_index = lowest_point_index - i - 1
-        if left_index >= 0:
-            new_left_height = height_list[left_index]
-            new_left_loc = loc_list[left_index]
-            # print(abs(new_left_height - left_height) / np.linalg.norm(left_loc - new_left_loc))
-            if abs(new_left_height - left_height) / np.linalg.norm(left_loc - new_left_loc) <= height_diff and \
-                    abs(new_left_height - left_height) < height_diff_max:
-            # if abs(new_left_height - left_height) * 0.3 <= height_diff:
-                left_height = new_left_height
-                left_loc = new_left_loc
-                points_valid[left_index] = True
-            else:
-                if abs(new_left_height - left_height) <= height_diff_max:
-                    checked_future_points = 0
-                    valid_future_points = 0
-                    j = left_index
-                    while checked_future_points < future_points_num and j > 0:
-                        j -= 1
-                        if abs(new_left_height - height_list[j]) / np.linalg.norm(loc_list[j] - loc_list[j+1]) <= height_diff:
-                            valid_future_points += 1
-                    if valid_future_points >= future_points_ratio * future_points_num:
-                        left_height = new_left_height
-                        left_loc = new_left_loc
-                        points_valid[left_index] = True
-        right_index = lowest_point_index + i + 1
-        if right_index < len(points):
-            new_right_height = height_list[right_index]
-            new_right_loc = loc_list[right_index]
-            if abs(new_right_height - right_height) / np.linalg.norm(right_loc - new_right_loc) <= height_diff and \
-                    abs(new_right_height - right_height) < height_diff_max:
-            # if abs(new_right_height - right_height) * 0.3 <= height_diff:
-                right_height = new_right_height
-                right_loc = new_right_loc
-                points_valid[right_index] = True
-            else:
-                if abs(new_right_height - right_height) <= height_diff_max:
-                    checked_future_points = 0
-                    valid_future_points = 0
-                    j = right_index
-                    while checked_future_points < future_points_num and j < len(points) - 1:
-                        j += 1
-                        if abs(new_right_height - height_list[j]) / np.linalg.norm(loc_list[j] - loc_list[j-1]) <= height_diff:
-                            valid_future_points += 1
-                    if valid_future_points >= future_points_ratio * future_points_num:
-                        right_height = new_right_height
-                        right_loc = new_right_loc
-                        points_valid[right_index] = True
-    filtered_points = [points[i] for i in range(len(points)) if points_valid[i]]
-    return filtered_points
+
+    heights = height_list.tolist()
+    xs, zs = loc_list[:, 0].tolist(), loc_list[:, 1].tolist()
+    for direction, indices in ((-1, range(lowest_point_index - 1, -1, -1)),
+                               (1, range(lowest_point_index + 1, len(points)))):
+        future_ok = (future_points_support(height_list, step_list, direction, height_diff, future_points_num)
+                     >= required).tolist()
+        last_height, last_x, last_z = heights[lowest_point_index], xs[lowest_point_index], zs[lowest_point_index]
+        for k in indices:
+            diff = abs(heights[k] - last_height)
+            dist = math.hypot(xs[k] - last_x, zs[k] - last_z)
+            slope_ok = dist > 0 and diff / dist <= height_diff
+            if (slope_ok and diff < height_diff_max) or (diff <= height_diff_max and future_ok[k]):
+                last_height, last_x, last_z = heights[k], xs[k], zs[k]
+                points_valid[k] = True
+    return points[points_valid]
 
 
 def filter_ground_points(points, distance_threshold=1.0, neighbor_count=20):
@@ -298,19 +498,30 @@ def filter_ground_points(points, distance_threshold=1.0, neighbor_count=20):
         return points
     min_y = np.min(points[:, 1])
     tree = cKDTree(points[:, [0, 2]])
-    filtered_points = []
-    for i, point in enumerate(points):
-        indices = tree.query(point[[0, 2]], k=neighbor_count)[1]
-        neighbors = points[indices]
-        if np.any(neighbors[:, 1] < point[1] - distance_threshold) or point[1] - min_y > 3 * distance_threshold:
-            continue
-        filtered_points.append(point)
-    return np.array(filtered_points)
-
-def align_road(input_glb_path, lat, lng, rad):
-    road_data = get_roads(lat, lng, rad)
-    ground_data = get_ground_areas(lat, lng, rad)
-    data = fetch_buildings(lat, lng, rad)
+    # 一次批量查询所有点的近邻，邻域最低点用花式索引求出
+    _, indices = tree.query(points[:, [0, 2]], k=min(neighbor_count, len(points)), workers=-1)
+    neighbor_min_y = points[indices.reshape(len(points), -1), 1].min(axis=1)
+    keep = (neighbor_min_y >= points[:, 1] - distance_threshold) & (points[:, 1] - min_y <= 3 * distance_threshold)
+    return points[keep]
+
+def align_road(input_glb_path, lat, lng, rad, cache_dir=None, cache_ttl=DEFAULT_TTL, offline=False, combined_query=True,
+               ground_density=1.0, height_field_resolution=0.25, road_spacing=None, return_buildings=False):
+    """
+    road_spacing: 道路类型 -> 采样间距（米），缺省为 HIGHWAY_SAMPLE_SPACING
+    return_buildings: 为 True 时额外返回 x, z 平面上的建筑轮廓多边形列表
+    """
+    cache = OSMCache(cache_dir, ttl=cache_ttl, offline=offline)
+    road_spacing = HIGHWAY_SAMPLE_SPACING if road_spacing is None else road_spacing
+    if combined_query:
+        combined_data = cache.fetch("combined", lat, lng, rad, fetch_osm_features)
+        if combined_data is None:
+            print("No data found.")
+            return
+        road_data, data, ground_data = split_osm_features(combined_data)
+    else:
+        road_data = cache.fetch("roads", lat, lng, rad, get_roads)
+        ground_data = cache.fetch("grounds", lat, lng, rad, get_ground_areas, fmt="pkl")
+        data = cache.fetch("buildings", lat, lng, rad, fetch_buildings)
     buildings = parse_buildings(data)
     
     if not road_data and not ground_data:
@@ -324,9 +535,7 @@ def align_road(input_glb_path, lat, lng, rad):
     ground_polygons = []
     types = set()
     if road_data:
-        # Create a dictionary of node ID to node coordinates
-        node_dict = {node['id']: {'lat': node['lat'], 'lon': node['lon']} for node in road_data['elements'] if
-                     node['type'] == 'node'}
+        node_index, node_coords, _ = index_osm_elements(road_data)
 
         for element in road_data['elements']:
             types.update({element['type']})
@@ -338,64 +547,81 @@ def align_road(input_glb_path, lat, lng, rad):
                 layer = element['tags'].get('layer', 0)
                 covered = covered or tunnel != '' or str(layer).startswith('-')
 
-                # Get the node coordinates for this way
-                way_nodes = [{'lat': node_dict[node_id]['lat'], 'lon': node_dict[node_id]['lon']} for node_id in
-                             element['nodes'] if node_id in node_dict]
+                # Get the node coordinates for this way as [lat, lon]
+                way_nodes = way_coords(element['nodes'], node_index, node_coords)[:, ::-1]
 
                 # Sample points on this way
-                sampled_points = sample_points_on_way(way_nodes, num_points=300)
+                spacing = road_spacing.get(highway, DEFAULT_SAMPLE_SPACING)
+                sampled_points = sample_points_on_way(way_nodes, spacing=spacing)
+                if len(sampled_points) < 2:
+                    continue
                 # Store the sampled points in the dictionary
                 if name in roads_dict:
-                    roads_dict[name][1].append(sampled_points.tolist())
+                    roads_dict[name][1].append(sampled_points)
                     roads_dict[name][3].append(element['nodes'])
                 else:
-                    roads_dict[name] = [highway, [sampled_points.tolist()], covered, [element['nodes']]]
+                    roads_dict[name] = [highway, [sampled_points], covered, [element['nodes']]]
 
+    # 同名道路的 way 串成若干条有序折线
     for name in tqdm(roads_dict):
-        if len(roads_dict[name][1]) > 1:
-            roads_dict[name][1] = reorder_points(roads_dict[name][1], roads_dict[name][3])
-        else:
-            roads_dict[name][1] = roads_dict[name][1][0]
+        roads_dict[name][1] = chain_way_polylines(roads_dict[name][1], roads_dict[name][3])
     origin_lat, origin_lng = lat, lng
     all_valid_points = []
     all_points = []
     all_ground_points = []
     tmesh = trimesh.load(input_glb_path, force='mesh')
+    height_field = None
+    if height_field_resolution:
+        # 与 fetch_pano_meta_data.py 共用 aligned.glb 旁的高度场文件
+        height_field = HeightField.load_or_build(
+            os.path.splitext(input_glb_path)[0] + "_height_field.npy", tmesh,
+            resolution=height_field_resolution, source=input_glb_path,
+        )
     buildings_str_tree = STRtree(buildings)
 
-    for road_name, value in tqdm(roads_dict.items()):
+    # 所有道路的采样点一次性做建筑包含判断
+    road_items = list(roads_dict.items())
+    road_lat_lng = [np.concatenate(value[1]) for _, value in road_items]
+    all_lat_lng = np.concatenate(road_lat_lng) if road_lat_lng else np.empty((0, 2))
+    outside = are_points_outside_buildings(all_lat_lng, buildings_str_tree)
+    road_outside = np.split(outside, np.cumsum([len(p) for p in road_lat_lng])[:-1])
+
+    for (road_name, value), lat_lng, results in tqdm(zip(road_items, road_lat_lng, road_outside), total=len(road_items)):
         highway = value[0]
-        points = value[1]
         covered = value[2]
-        sampled_points = []
-        sampled_lat_lng = []
-        for point in points:
-            x, z = latlng_to_xyz(point[0], point[1], origin_lat, origin_lng)
-            sampled_points.append((x, z))
-            sampled_lat_lng.append((point[0], point[1]))
-        sampled_points = np.array(sampled_points)
-        results = are_points_outside_buildings(sampled_lat_lng, buildings_str_tree)
-        sampled_points = sampled_points[results]
-        valid_points = find_mesh_upper_bound_y(tmesh, sampled_points)
-        if valid_points is None:
+        x, z = latlng_to_xyz(lat_lng[:, 0], lat_lng[:, 1], origin_lat, origin_lng)
+        # 折线之间不连续，异常点过滤逐条折线进行
+        polyline_ids = np.repeat(np.arange(len(value[1])), [len(polyline) for polyline in value[1]])[results]
+        sampled_points = np.column_stack((x, z))[results]
+        splits = np.flatnonzero(np.diff(polyline_ids)) + 1
+        valid_pieces, filtered_pieces = [], []
+        for polyline_points in np.split(sampled_points, splits):
+            piece = find_mesh_upper_bound_y(tmesh, polyline_points, height_field)
+            if piece is not None:
+                valid_pieces.append(piece)
+                filtered_pieces.append(filter_anomalous_points(piece))
+        if not valid_pieces:
             continue
-        filtered_points = filter_anomalous_points(valid_points)
+        valid_points = np.concatenate(valid_pieces)
+        filtered_points = np.concatenate(filtered_pieces)
         if highway not in ['corridor', 'via_ferrata', 'steps'] and not covered:
             all_valid_points.append([highway, np.array(filtered_points)])
             all_points.append(valid_points)
             
     # Process ground data
     for idx, polygon in tqdm(enumerate(ground_data.geometry)):
-        ground_points = sample_points_on_polygon(polygon, density=0.00001)
-        sampled_points = []
-        for point in ground_points:
-            x, z = latlng_to_xyz(point[1], point[0], origin_lat, origin_lng)
-            sampled_points.append((x, z))
-        valid_points = find_mesh_upper_bound_y(tmesh, sampled_points)
+        # 直接在局部 xz 平面（米）上采样，省去逐点经纬度转换
+        xz_polygon = polygon_to_xyz(polygon, origin_lat, origin_lng)
+        sampled_points = sample_points_on_polygon(xz_polygon, density=ground_density)
+        valid_points = find_mesh_upper_bound_y(tmesh, sampled_points, height_field)
         if valid_points is None or len(valid_points) <= 20:
             continue
         filtered_ground_points = filter_ground_points(valid_points)
         all_ground_points.append(filtered_ground_points)
-        ground_polygons.append(polygon_to_xyz(polygon, origin_lat, origin_lng))
+        # 掩码阶段沿用原先只含外轮廓的地面多边形
+        ground_polygons.append(Polygon(xz_polygon.exterior))
 
+    if return_buildings:
+        building_polygons = [polygon_to_xyz(building, origin_lat, origin_lng) for building in buildings]
+        return all_valid_points, all_ground_points, ground_polygons, building_polygons
     return all_valid_points, all_ground_points, ground_polygons
@@ -1,5 +1,4 @@
 import os
-import pdb
 import time
 import bpy
 import bmesh
@@ -9,7 +8,11 @@ from scipy.spatial import cKDTree
 from tqdm import tqdm
 import sys
 import argparse
+import multiprocessing
+import shapely
 from shapely.geometry import Point
+from road_index import RoadIndex
+from road_raster import RoadRaster, NO_GROUND
 
 def export_scene(output_path):
     bpy.ops.wm.save_as_mainfile(filepath=os.path.abspath(output_path))
@@ -36,81 +39,6 @@ DISTANCES_VEHICLE = [
 ]
 
 
-def near_vehicle_way(coord, tree):
-    # if road_info_dict is not None and use_road_dict:
-    # if road_info_dict is not None:
-    for type, distance_thres in DISTANCES_VEHICLE:
-        if type not in tree:
-            continue
-        distances, indices = tree[type].query((coord[0], coord[2]), k=1)
-        if distances < distance_thres:
-            return True
-    return False
-
-
-def get_nearest_y(coord, tree, ref_points, road_info_dict=None, use_road_dict=True, ignore_y_diff=False,
-                  focus_road=False):
-    y_diff = None
-    road = None
-    # if road_info_dict is not None and use_road_dict:
-    # if road_info_dict is not None:
-    if focus_road:
-        selected_type = None
-        for type, distance_thres, _y_diff in DISTANCES:
-            if type not in tree:
-                continue
-            distances, indices = tree[type].query((coord[0], coord[2]), k=1)
-            if distances < distance_thres and (abs(coord[1] - ref_points[type][indices][1]) < _y_diff or ignore_y_diff):
-                selected_type = type
-                y_diff = _y_diff
-                break
-        if selected_type is not None:
-            distances, indices = tree[selected_type].query((coord[0], coord[2]), k=40)
-            indices = indices[indices < len(ref_points[selected_type])]
-            nearest_points = ref_points[selected_type][indices]
-        else:
-            distances, indices = tree['all'].query((coord[0], coord[2]), k=40)
-            indices = indices[indices < len(ref_points['all'])]
-            nearest_points = ref_points['all'][indices]
-        close_points = [point for point in nearest_points if abs(point[1] - coord[1]) <= 2]
-        if close_points:
-            chosen_point = min(close_points, key=lambda point: np.linalg.norm(point[[0, 2]] -
-                                                                              np.array([coord[0], coord[2]])))
-        else:
-            chosen_point = nearest_points[0]
-        road = chosen_point[-1]
-        if not use_road_dict:
-            y_new = chosen_point[1]
-        else:
-            A, B, C, D, E, F = road_info_dict[road]["param"]
-            y_new = B * coord[0] + D * coord[2] + F
-        # y_new = (D * coord[0] - E * coord[2] - F) / B
-    else:
-        distances, indices = tree['all'].query((coord[0], coord[2]), k=40)
-        nearest_points = ref_points['all'][indices]
-        close_points = [point for point in nearest_points if abs(point[1] - coord[1]) <= 2]
-        if close_points:
-            chosen_point = min(close_points, key=lambda point: np.linalg.norm(point[[0, 2]] -
-                                                                              np.array([coord[0], coord[2]])))
-        else:
-            chosen_point = nearest_points[0]
-        y_new = chosen_point[1]
-        if road_info_dict is not None:
-            road = chosen_point[-1]
-    return y_new, y_diff, road
-
-
-def should_modify_y(coord, tree, ref_points, ydiff, road_info_dict, ydiff_force=None, focus_road=False):
-    nearest_y, _ydiff, road = get_nearest_y(coord, tree, ref_points, road_info_dict=road_info_dict, use_road_dict=False,
-                                            focus_road=focus_road)
-    # return abs(nearest_y - coord[1]) <= ydiff, road
-    if ydiff_force is not None:
-        return coord[1] - nearest_y <= ydiff_force, road
-    if focus_road:
-        return abs(nearest_y - coord[1]) <= ydiff, road
-    return (coord[1] - nearest_y <= 0.5) and (coord[1] - nearest_y >= -1), road
-
-
 def auto_split_for_groups(obj):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.context.tool_settings.use_mesh_automerge = True
@@ -137,50 +65,418 @@ def auto_split_for_groups(obj):
     bpy.ops.object.mode_set(mode='OBJECT')
 
 
-def find_subgraphs(bm, min_island_size, tree, ref_points, world_matrix, height_thres=4, area_thres=150):
-    bpy.ops.mesh.select_mode(type="FACE")
-    bpy.ops.mesh.select_all(action='DESELECT')
-    bm.select_flush(False)
-
-    islands = []
-    islands_new = []
-    islands_large = []
-    processed_states = np.zeros(len(bm.faces), dtype=bool)
-    counter = 0
-    for f in tqdm(bm.faces, desc="Find subgraphs"):
-        if not processed_states[f.index]:
-            f.select = True
-            bpy.ops.mesh.select_linked(delimit={'SEAM'})
-            subgraph = [f for f in bm.faces if f.select]
-            processed_states[[f.index for f in subgraph]] = True
-            if len(subgraph) > min_island_size * 10:
-                bpy.ops.mesh.select_all(action='DESELECT')
-                bm.select_flush(False)
-                continue
-            subgraph_coords = [[world_matrix @ v.co for v in face.verts] for face in subgraph]
-            subgraph_coords = np.array(sum(subgraph_coords, []))
-            height = np.max(subgraph_coords[:, 1]) - np.min(subgraph_coords[:, 1])
-            area = ((np.max(subgraph_coords[:, 0]) - np.min(subgraph_coords[:, 0])) *
-                    (np.max(subgraph_coords[:, 2]) - np.min(subgraph_coords[:, 2])))
-            min_y = np.min(subgraph_coords[:, 1])
-            y_new, y_diff, road = get_nearest_y(subgraph_coords[0], tree, ref_points)
-            if (len(subgraph) < min_island_size or height <= height_thres) and area < area_thres and min_y <= y_new + 1:
-                near_way = False
-                for coord in subgraph_coords:
-                    if near_vehicle_way(coord, tree):
-                        near_way = True
-                if near_way:
-                    islands.extend(subgraph)
-                    islands_new.append(subgraph)
-            else:
-                islands_large.append(subgraph)
-            bpy.ops.mesh.select_all(action='DESELECT')
-            bm.select_flush(False)
+def near_vehicle_way_batched(coords, tree, raster=None):
+    """
+    每个顶点在 XZ 平面上是否落在 DISTANCES_VEHICLE 任一类型道路的宽度之内。
+    给定 RoadRaster 时只对 "vehicle" 走廊边界附近的顶点做 KD 树查询
+    """
+    near_way = np.zeros(len(coords), dtype=bool)
+    exact = np.ones(len(coords), dtype=bool)
+    if raster is not None:
+        near_way, certain = raster.layer("vehicle", coords[:, [0, 2]])
+        exact = ~certain
+        near_way[exact] = False
+    for type, distance_thres in DISTANCES_VEHICLE:
+        if type not in tree or not exact.any():
+            continue
+        distances, _ = tree[type].query(coords[exact][:, [0, 2]], k=1, workers=QUERY_WORKERS)
+        near_way[np.flatnonzero(exact)[distances < distance_thres]] = True
+    return near_way
+
+
+def build_road_raster(road_index, ground_info, buildings=(), resolution=0.5):
+    """
+    按 DISTANCES / DISTANCES_VEHICLE 的宽度把道路参考点栅格化：每种道路类型一个 "road_<type>" 走廊，
+    DISTANCES_VEHICLE 各类型合并为 "vehicle" 走廊，另含地面多边形与建筑轮廓
+    """
+    corridors = {f"road_{type}": [(type, width)] for type, width, _ in DISTANCES}
+    corridors["vehicle"] = list(DISTANCES_VEHICLE)
+    ground_polygons = [ground_info[ground_idx]['polygon'] for ground_idx in sorted(ground_info)]
+    return RoadRaster.from_road_index(road_index, corridors, ground_polygons, buildings, resolution=resolution)
+
+
+def connected_components(num_items, pairs_a, pairs_b):
+    """
+    数组版并查集：每轮把每对元素所在的两个根中较大的挂到较小的上，再做指针跳跃压缩路径，
+    直到所有对都同根。返回每个元素的代表（所在连通分量的最小下标）
+    """
+    parent = np.arange(num_items)
+    pairs_a, pairs_b = np.asarray(pairs_a), np.asarray(pairs_b)
+    while True:
+        root_a, root_b = parent[pairs_a], parent[pairs_b]
+        differ = root_a != root_b
+        if not differ.any():
+            return parent
+        np.minimum.at(parent, np.maximum(root_a[differ], root_b[differ]), np.minimum(root_a[differ], root_b[differ]))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def seam_delimited_islands(obj):
+    """
+    与 select_linked(delimit={'SEAM'}) 相同的连通关系：共享一条非缝合线边的两个面相连。
+    返回 (每个面的岛代表, loop 起点, loop -> 顶点, loop -> 面)
+    """
+    mesh = obj.data
+    loop_start = np.empty(len(mesh.polygons), dtype=np.int64)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    loop_total = np.empty(len(mesh.polygons), dtype=np.int64)
+    mesh.polygons.foreach_get("loop_total", loop_total)
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int64)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    loop_edges = np.empty(len(mesh.loops), dtype=np.int64)
+    mesh.loops.foreach_get("edge_index", loop_edges)
+    use_seam = np.empty(len(mesh.edges), dtype=bool)
+    mesh.edges.foreach_get("use_seam", use_seam)
+
+    loop_faces = np.repeat(np.arange(len(loop_start)), loop_total)
+    # 按边排序后，相邻且属于同一条边的 loop 对应相邻的两个面
+    order = np.argsort(loop_edges, kind='stable')
+    sorted_edges = loop_edges[order]
+    shared = (sorted_edges[1:] == sorted_edges[:-1]) & ~use_seam[sorted_edges[1:]]
+    labels = connected_components(len(loop_start), loop_faces[order[:-1][shared]], loop_faces[order[1:][shared]])
+    return labels, loop_start, loop_verts, loop_faces
+
+
+def find_islands(obj, min_island_size, tree, ref_points, height_thres=4, area_thres=150, raster=None):
+    """
+    find_subgraphs 的批量实现：一次并查集求出所有岛，再用 bincount / minimum.at / maximum.at
+    归约每个岛的面数、包围盒、高度，近邻查询也全部批量完成。
+    返回 (islands: 面下标数组, islands_new: 每个小岛的面下标数组列表, islands_large: 同上)
+    """
+    labels, loop_start, loop_verts, loop_faces = seam_delimited_islands(obj)
+    roots, island_of_face = np.unique(labels, return_inverse=True)
+    num_islands = len(roots)
+    face_count = np.bincount(island_of_face, minlength=num_islands)
+
+    world_coords = read_world_mesh(obj)[0]
+    loop_coords = world_coords[loop_verts]
+    island_of_loop = island_of_face[loop_faces]
+    lower = np.full((num_islands, 3), np.inf)
+    upper = np.full((num_islands, 3), -np.inf)
+    np.minimum.at(lower, island_of_loop, loop_coords)
+    np.maximum.at(upper, island_of_loop, loop_coords)
+    height = upper[:, 1] - lower[:, 1]
+    area = (upper[:, 0] - lower[:, 0]) * (upper[:, 2] - lower[:, 2])
+    min_y = lower[:, 1]
 
+    # 岛代表即岛内最小的面下标，与原先按面顺序遍历时取到的第一个面、第一个顶点一致
+    y_new, _ = nearest_y_batched(world_coords[loop_verts[loop_start[roots]]], tree, ref_points, raster=raster)
+    near_way_vert = near_vehicle_way_batched(world_coords, tree, raster=raster)
+    near_way = np.bincount(island_of_loop, weights=near_way_vert[loop_verts], minlength=num_islands) > 0
+
+    considered = face_count <= min_island_size * 10
+    small = (((face_count < min_island_size) | (height <= height_thres)) & (area < area_thres) &
+             (min_y <= y_new + 1))
+    faces_by_island = np.split(np.argsort(island_of_face, kind='stable'), np.cumsum(face_count)[:-1])
+    islands_new = [faces_by_island[i] for i in np.flatnonzero(considered & small & near_way)]
+    islands_large = [faces_by_island[i] for i in np.flatnonzero(considered & ~small)]
+    islands = np.concatenate(islands_new) if islands_new else np.zeros(0, dtype=np.int64)
     return islands, islands_new, islands_large
 
-def flat(reference_points, road_info, ground_info):
-    ydiff = 0.75
+
+def find_subgraphs(bm, min_island_size, tree, ref_points, world_matrix, height_thres=4, area_thres=150, raster=None):
+    """
+    保持原接口：在编辑模式下调用，返回 BMFace 列表。
+    连通岛的计算见 find_islands，不再逐岛调用 select_linked。world_matrix 取自对象本身
+    """
+    obj = bpy.context.edit_object
+    obj.update_from_editmode()
+    islands, islands_new, islands_large = find_islands(obj, min_island_size, tree, ref_points,
+                                                       height_thres=height_thres, area_thres=area_thres, raster=raster)
+    bm.faces.ensure_lookup_table()
+    to_faces = lambda indices: [bm.faces[i] for i in indices]
+    return to_faces(islands), [to_faces(island) for island in islands_new], [to_faces(island) for island in islands_large]
+
+
+QUERY_CHUNK_SIZE = 200000
+# cKDTree.query 的线程数；classify_faces_chunked 的子进程中设为 1，避免进程数 × CPU 数的线程
+QUERY_WORKERS = -1
+
+
+def choose_nearest_points(coords, indices, ref_points):
+    """
+    最近参考点的选点规则：在按距离排序的近邻 indices (N, k) 中取第一个与顶点高差不超过 2 的点，
+    没有则取最近点。返回被选中的参考点 (N, C)
+    """
+    neighbor_y = ref_points[indices, 1]
+    close = np.abs(neighbor_y - coords[:, 1:2]) <= 2
+    first_close = np.where(close.any(axis=1), np.argmax(close, axis=1), 0)
+    return ref_points[indices[np.arange(len(indices)), first_close]]
+
+
+def query_nearest_points(coords, tree, ref_points, k=40):
+    """对 coords (N, 3) 分块做一次 k 近邻批量查询，返回 choose_nearest_points 选出的参考点"""
+    k = min(k, tree.n)
+    chosen = np.empty((len(coords), ref_points.shape[1]))
+    for start in range(0, len(coords), QUERY_CHUNK_SIZE):
+        chunk = coords[start:start + QUERY_CHUNK_SIZE]
+        _, indices = tree.query(chunk[:, [0, 2]], k=k, workers=QUERY_WORKERS)
+        chosen[start:start + QUERY_CHUNK_SIZE] = choose_nearest_points(chunk, indices.reshape(len(chunk), k), ref_points)
+    return chosen
+
+
+def nearest_y_batched(coords, tree, ref_points, raster=None):
+    """
+    每个顶点在全部道路参考点中按 choose_nearest_points 选出的参考点，返回 (nearest_y, road)。
+    给定 RoadRaster 时先查栅格，只有栅格不可信的顶点才做 KD 树查询
+    """
+    nearest_y = np.empty(len(coords))
+    road = np.empty(len(coords))
+    exact = np.ones(len(coords), dtype=bool)
+    if raster is not None:
+        raster_y, raster_road, certain = raster.nearest_y(coords[:, [0, 2]], coords[:, 1])
+        nearest_y[certain], road[certain] = raster_y[certain], raster_road[certain]
+        exact = ~certain
+    if exact.any():
+        chosen = query_nearest_points(coords[exact], tree['all'], ref_points['all'])
+        nearest_y[exact], road[exact] = chosen[:, 1], chosen[:, -1]
+    return nearest_y, road
+
+
+def focus_road_y_batched(coords, tree, ref_points, raster=None):
+    """
+    只看道路的最近参考点：
+    按 DISTANCES 的顺序为每个顶点选第一个宽度与高差都满足的道路类型，再在该类型（或全部）参考点中选点。
+    给定 RoadRaster 时，栅格确定不在该类型走廊内的顶点不再查询该类型的 KD 树。
+    返回 (nearest_y, road)
+    """
+    selected = np.full(len(coords), -1)
+    for type_idx, (type, distance_thres, _y_diff) in enumerate(DISTANCES):
+        if type not in tree or tree[type].n == 0:
+            continue
+        pending = np.flatnonzero(selected < 0)
+        if raster is not None and len(pending):
+            in_corridor, certain = raster.layer(f"road_{type}", coords[pending][:, [0, 2]])
+            pending = pending[in_corridor | ~certain]
+        if len(pending) == 0:
+            continue
+        distances, indices = tree[type].query(coords[pending][:, [0, 2]], k=1, workers=QUERY_WORKERS)
+        # 只对宽度内的顶点取参考点高度，超出宽度的查询结果（距离 inf 时下标越界）不参与比较
+        within = distances < distance_thres
+        pending, indices = pending[within], indices[within]
+        match = np.abs(coords[pending, 1] - ref_points[type][indices, 1]) < _y_diff
+        selected[pending[match]] = type_idx
+
+    chosen = np.empty((len(coords), ref_points['all'].shape[1]))
+    for type_idx in np.unique(selected):
+        key = 'all' if type_idx < 0 else DISTANCES[type_idx][0]
+        members = selected == type_idx
+        chosen[members] = query_nearest_points(coords[members], tree[key], ref_points[key])
+    return chosen[:, 1], chosen[:, -1]
+
+
+def ground_vertices(coords, ground_info, raster=None, verbose=True):
+    """
+    每个地面多边形包含的顶点下标：先用包围盒筛出候选顶点（按 x 排序后二分），
+    再对候选点做一次 shapely.contains_xy 批量判断。
+    给定 RoadRaster 时栅格可信的顶点直接按 ground 通道归类，其余顶点走上述精确判断
+    """
+    if raster is not None:
+        ids, certain = raster.ground_index(coords[:, [0, 2]])
+        uncertain = np.flatnonzero(~certain)
+        exact = ground_vertices(coords[uncertain], ground_info, verbose=verbose)
+        certain_ids = np.where(certain, ids, NO_GROUND)
+        return {ground_idx: np.sort(np.concatenate((np.flatnonzero(certain_ids == ground_idx), uncertain[vids])))
+                for ground_idx, vids in exact.items()}
+    order = np.argsort(coords[:, 0], kind='stable')
+    sorted_x = coords[order, 0]
+    result = {}
+    for ground_idx, ground in tqdm(ground_info.items(), desc="Processing grounds", disable=not verbose):
+        polygon = ground['polygon']
+        min_x, min_z, max_x, max_z = polygon.bounds
+        start = np.searchsorted(sorted_x, min_x, side='left')
+        stop = np.searchsorted(sorted_x, max_x, side='right')
+        candidates = order[start:stop]
+        z = coords[candidates, 2]
+        candidates = candidates[(z >= min_z) & (z <= max_z)]
+        inside = shapely.contains_xy(polygon, coords[candidates, 0], coords[candidates, 2])
+        result[ground_idx] = np.sort(candidates[inside])
+    return result
+
+
+def read_world_mesh(obj):
+    """
+    用 foreach_get 读出网格的世界坐标、世界系面法线（与原先 world_matrix.to_3x3() @ face.normal 相同）、
+    每个面的 loop 起点以及 loop -> 顶点 / 边 索引
+    """
+    mesh = obj.data
+    world_matrix = np.array(obj.matrix_world)
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    coords = co.reshape(-1, 3).astype(np.float64) @ world_matrix[:3, :3].T + world_matrix[:3, 3]
+
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    mesh.polygons.foreach_get("normal", normals)
+    normals = normals.reshape(-1, 3) @ world_matrix[:3, :3].T
+
+    loop_start = np.empty(len(mesh.polygons), dtype=np.int64)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int64)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    loop_edges = np.empty(len(mesh.loops), dtype=np.int64)
+    mesh.loops.foreach_get("edge_index", loop_edges)
+    return coords, normals, loop_start, loop_verts, loop_edges
+
+
+def all_verts_of_faces(vert_flags, loop_start, loop_verts):
+    """每个面的所有顶点是否都满足 vert_flags"""
+    if len(loop_start) == 0:
+        return np.zeros(0, dtype=bool)
+    return np.logical_and.reduceat(vert_flags[loop_verts], loop_start)
+
+
+def select_faces(vert_select, flat_select, loop_start, loop_verts):
+    """
+    按原先逐面循环的顺序语义求出选中的面：面 f 在其全部顶点已选中、或 flat_select[f] 为真时被选中，
+    而选中一个面会同时选中它的顶点，使下标更大的面随之满足条件。
+    sel_order[v] 记录顶点 v 最早被选中的时刻（-1 为第 I 步选中，否则为选中它的面下标），
+    面 f 的条件即其全部顶点的 sel_order < f。sel_order 单调减小、选中的面单调增加，
+    迭代到不再变化时的不动点与逐面循环的结果相同
+    """
+    num_faces = len(loop_start)
+    if num_faces == 0:
+        return np.zeros(0, dtype=bool)
+    loop_faces = np.repeat(np.arange(num_faces), np.diff(np.append(loop_start, len(loop_verts))))
+    sel_order = np.where(vert_select, -1, num_faces)
+    face_select = flat_select.copy()
+    while True:
+        face_select |= np.maximum.reduceat(sel_order[loop_verts], loop_start) < np.arange(num_faces)
+        selected_loops = face_select[loop_faces]
+        new_order = sel_order.copy()
+        np.minimum.at(new_order, loop_verts[selected_loops], loop_faces[selected_loops])
+        if np.array_equal(new_order, sel_order):
+            return face_select
+        sel_order = new_order
+
+
+def write_face_selection(mesh, face_select, loop_start, loop_verts, loop_edges):
+    """按面模式写回选择：选中面的顶点与边也被选中，其余全部取消"""
+    loop_select = np.repeat(face_select, np.diff(np.append(loop_start, len(loop_verts))))
+    vert_select = np.zeros(len(mesh.vertices), dtype=bool)
+    vert_select[loop_verts[loop_select]] = True
+    edge_select = np.zeros(len(mesh.edges), dtype=bool)
+    edge_select[loop_edges[loop_select]] = True
+    mesh.vertices.foreach_set("select", vert_select)
+    mesh.edges.foreach_set("select", edge_select)
+    mesh.polygons.foreach_set("select", face_select)
+
+
+def classify_faces(world_coords, face_normals, loop_start, loop_verts, tree, reference_points, ground_info,
+                   road_raster=None, ydiff=0.75, verbose=True):
+    """
+    flat 的逐顶点 / 逐面判断，只用 NumPy 数组、不访问 bpy。
+    返回 (vert_select, flat_select, road2vert, ground2vert)：vert_select 为第 I 步选中的顶点，
+    flat_select 为第 II 步中朝上且全部顶点贴近道路的面，二者交给 select_faces 求出保留原材质的面；
+    road2vert / ground2vert 为 {道路 id / 地面下标: 顶点下标数组}
+    """
+    # Road vertices I / II：两次阈值判断共用同一次近邻查询
+    if verbose:
+        print("Processing road vertices I/II")
+    nearest_y, _ = nearest_y_batched(world_coords, tree, reference_points, raster=road_raster)
+    height_above = world_coords[:, 1] - nearest_y
+    vert_select = height_above <= 2
+    flat_select = (face_normals[:, 1] > 0.95) & all_verts_of_faces(height_above <= 2.3, loop_start, loop_verts)
+
+    # Process grounds
+    ground2vert = ground_vertices(world_coords, ground_info, raster=road_raster, verbose=verbose)
+
+    # Road vertices III
+    if verbose:
+        print("Processing road vertices III")
+    focus_y, focus_road = focus_road_y_batched(world_coords, tree, reference_points, raster=road_raster)
+    on_road = np.abs(focus_y - world_coords[:, 1]) <= ydiff
+    road2vert = {int(road): np.flatnonzero(on_road & (focus_road == road)) for road in np.unique(focus_road[on_road])}
+    return vert_select, flat_select, road2vert, ground2vert
+
+
+# classify_chunk 在 fork 出的子进程中运行，KD 树、参考点等只读数据通过该全局变量以写时复制的方式共享
+_chunk_context = {}
+
+
+def face_chunks(world_coords, loop_start, loop_verts, chunk_size):
+    """按每个面首个顶点所在的 XZ 方格（边长 chunk_size 米）划分面，返回各块的面下标数组"""
+    first_xz = world_coords[loop_verts[loop_start]][:, [0, 2]]
+    cells = np.floor((first_xz - first_xz.min(axis=0)) / chunk_size).astype(np.int64)
+    keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    return np.split(order, np.flatnonzero(np.diff(keys[order])) + 1)
+
+
+def chunk_submesh(faces, world_coords, face_normals, loop_start, loop_verts):
+    """
+    取出一块面及其全部顶点，重新编号为局部网格。跨块边界的面会把邻块的顶点一并带入，即相邻块之间的重叠部分。
+    返回 (全局顶点下标, 局部顶点坐标, 面法线, 局部 loop 起点, 局部 loop -> 顶点)
+    """
+    loop_total = np.diff(np.append(loop_start, len(loop_verts)))[faces]
+    chunk_start = np.concatenate(([0], np.cumsum(loop_total)[:-1]))
+    loops = np.repeat(loop_start[faces] - chunk_start, loop_total) + np.arange(loop_total.sum())
+    vert_ids, local_verts = np.unique(loop_verts[loops], return_inverse=True)
+    return vert_ids, world_coords[vert_ids], face_normals[faces], chunk_start, local_verts
+
+
+def limit_query_workers():
+    global QUERY_WORKERS
+    QUERY_WORKERS = 1
+
+
+def classify_chunk(chunk):
+    vert_ids, coords, normals, loop_start, loop_verts = chunk
+    context = _chunk_context
+    vert_select, flat_select, road2vert, ground2vert = classify_faces(
+        coords, normals, loop_start, loop_verts, context['tree'], context['reference_points'],
+        context['ground_info'], road_raster=context['road_raster'], verbose=False)
+    return (vert_ids[vert_select], flat_select, {road: vert_ids[vids] for road, vids in road2vert.items()},
+            {ground_idx: vert_ids[vids] for ground_idx, vids in ground2vert.items()})
+
+
+def classify_faces_chunked(world_coords, face_normals, loop_start, loop_verts, tree, reference_points, ground_info,
+                           road_raster=None, chunk_size=100.0, workers=1):
+    """
+    分块版 classify_faces：按 XZ 方格把面分块逐块判断，再拼回全局的 vert_select / flat_select / road2vert / ground2vert。
+    每个面的判断只依赖它自己的顶点和全局参考点，结果与整体计算一致。
+    分块的用途是让各块可以并行判断，并不降低峰值内存：网格与 world_coords 等逐顶点数组仍整体读入内存，
+    近邻查询本身已按 QUERY_CHUNK_SIZE 分批。
+    workers > 1 时用 fork 出的多个进程并行处理各块（0 表示使用全部 CPU），子进程内的 KD 树查询单线程执行
+    """
+    _chunk_context.update(tree=tree, reference_points=reference_points, ground_info=ground_info,
+                          road_raster=road_raster)
+    chunks = face_chunks(world_coords, loop_start, loop_verts, chunk_size)
+    submeshes = (chunk_submesh(faces, world_coords, face_normals, loop_start, loop_verts) for faces in chunks)
+    vert_select = np.zeros(len(world_coords), dtype=bool)
+    flat_select = np.zeros(len(loop_start), dtype=bool)
+    road2vert, ground2vert = {}, {}
+    workers = workers or os.cpu_count()
+    pool = multiprocessing.get_context("fork").Pool(workers, initializer=limit_query_workers) if workers > 1 else None
+    try:
+        results = pool.imap(classify_chunk, submeshes) if pool is not None else map(classify_chunk, submeshes)
+        for faces, (chunk_verts, chunk_flat, chunk_roads, chunk_grounds) in tqdm(
+                zip(chunks, results), total=len(chunks), desc="Processing chunks"):
+            vert_select[chunk_verts] = True
+            flat_select[faces] = chunk_flat
+            for road, vids in chunk_roads.items():
+                road2vert.setdefault(road, []).append(vids)
+            for ground_idx, vids in chunk_grounds.items():
+                ground2vert.setdefault(ground_idx, []).append(vids)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _chunk_context.clear()
+    # 重叠部分的顶点在相邻块中各判断一次，结果相同，合并时去重
+    road2vert = {road: np.unique(np.concatenate(vids)) for road, vids in road2vert.items()}
+    ground2vert = {ground_idx: np.unique(np.concatenate(vids)) for ground_idx, vids in ground2vert.items()}
+    return vert_select, flat_select, road2vert, ground2vert
+
+
+def flat(reference_points, road_info, ground_info, road_index=None, road_raster=None, chunk_size=0, workers=1):
+    """
+    chunk_size: 大于 0 时按该边长（米）的 XZ 方格分块并行判断，见 classify_faces_chunked；
+    workers: 分块时的并行进程数
+    """
         # obj = bpy.context.scene.objects[0]
     obj = None
     for o in bpy.context.scene.objects:
@@ -192,87 +488,36 @@ def flat(reference_points, road_info, ground_info):
         return
     print(f"Processing object: {obj.name}")
     bpy.context.view_layer.objects.active = obj
-    bpy.ops.object.mode_set(mode='EDIT')
-    bm = bmesh.from_edit_mesh(obj.data)
-    bm.select_mode = {'VERT', 'EDGE', 'FACE'}
-    bm.select_flush_mode()
-    bpy.ops.mesh.select_all(action='DESELECT')
+    # 全部在 OBJECT 模式下用 foreach_get / foreach_set 批量读写
+    bpy.ops.object.mode_set(mode='OBJECT')
 
-    types2road = {}
-    for road in road_info:
-        if road_info[road]['type'] not in types2road:
-            types2road[road_info[road]['type']] = [road]
-        else:
-            types2road[road_info[road]['type']].append(road)
-    road_column = reference_points[:, 3]
-    points_dict = {}
-
-    for type in types2road:
-        points = []
-        for road in types2road[type]:
-            points.append(reference_points[road_column == road, :])
-        points = np.concatenate(points, axis=0)
-        points_dict[type] = points
-    tree = {type: cKDTree(points_dict[type][:, [0, 2]]) for type in points_dict}
-    all_points = np.concatenate([points_dict[key] for key in points_dict], axis=0)
-    tree['all'] = cKDTree(all_points[:, [0, 2]])
-    reference_points = {type: points_dict[type] for type in points_dict}
-    reference_points['all'] = np.concatenate([points_dict[key] for key in points_dict], axis=0)
-    world_matrix = obj.matrix_world
-    road2vert = [[] for _ in range(len(road_info))]
-    ground2vert = [[] for _ in range(len(ground_info))]
+    # 按道路类型分组的参考点与 KD 树；stage 2 已存盘的 RoadIndex 可直接传入，免去重建
+    if road_index is None:
+        road_index = RoadIndex.from_reference_points(reference_points, road_info)
+    tree = road_index.trees()
+    reference_points = road_index.reference_points()
     obj.select_set(True)
     bpy.context.view_layer.objects.active = obj
 
-    bm.verts.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
-    for vid, v in tqdm(enumerate(bm.verts), desc="Processing road vertices I"):
-        world_coord = world_matrix @ v.co
-        modify, road = should_modify_y(world_coord, tree, reference_points, ydiff, road_info_dict=road_info,
-                                       ydiff_force=2)
-        if modify:
-            v.select = True
+    world_coords, face_normals, loop_start, loop_verts, loop_edges = read_world_mesh(obj)
+    if chunk_size:
+        vert_select, flat_select, road_verts, ground_verts = classify_faces_chunked(
+            world_coords, face_normals, loop_start, loop_verts, tree, reference_points, ground_info,
+            road_raster=road_raster, chunk_size=chunk_size, workers=workers)
+    else:
+        vert_select, flat_select, road_verts, ground_verts = classify_faces(
+            world_coords, face_normals, loop_start, loop_verts, tree, reference_points, ground_info,
+            road_raster=road_raster)
+    face_select = select_faces(vert_select, flat_select, loop_start, loop_verts)
+    road2vert = [[] for _ in range(len(road_info))]
+    ground2vert = [[] for _ in range(len(ground_info))]
+    for road, vids in road_verts.items():
+        road2vert[int(road)] = vids.tolist()
+    for ground_idx, vids in ground_verts.items():
+        ground2vert[ground_idx] = vids.tolist()
 
-    # Process grounds
-    point_list = [world_matrix @ v.co for v in bm.verts]
-    point_list = [Point(world_coord.x, world_coord.z) for world_coord in point_list]
-    for ground_idx, ground in tqdm(ground_info.items(), desc="Processing grounds"):
-        polygon = ground['polygon']
-        for vid in range(len(bm.verts)):
-            if polygon.contains(point_list[vid]):
-                ground2vert[ground_idx].append(vid)
-
-    for fid, face in tqdm(enumerate(bm.faces), desc="Processing road vertices II"):
-        normal = world_matrix.to_3x3() @ face.normal
-        should_select = True
-        for v in face.verts:
-            if not v.select:
-                should_select = False
-        if should_select:
-            face.select = True
-            continue
-        if normal[1] > 0.95:
-            should_select = True
-            for v in face.verts:
-                coord = world_matrix @ v.co
-                modify, road = should_modify_y(coord, tree, reference_points, ydiff, road_info_dict=road_info,
-                                               ydiff_force=2.3)
-                if not modify:
-                    should_select = False
-            if should_select:
-                face.select = True
-                continue
-
-    for vid, v in tqdm(enumerate(bm.verts), desc="Processing road vertices III"):
-        world_coord = world_matrix @ v.co
-        modify, road = should_modify_y(world_coord, tree, reference_points, ydiff, road_info_dict=road_info,
-                                       focus_road=True)
-        if modify:
-            if road is not None:
-                road2vert[int(road)].append(vid)
-
-    bpy.ops.mesh.select_mode(use_extend=False, use_expand=False, type='FACE')
-    bpy.ops.mesh.select_all(action='INVERT')
+    # 未选中的面（即原先 select_all INVERT 后的选择）使用黑色材质
+    face_select = ~face_select
     material = bpy.data.materials.new(name="BlackMaterial")
     material.use_nodes = True
     nodes = material.node_tree.nodes
@@ -292,12 +537,18 @@ def flat(reference_points, road_info, ground_info):
     if len(obj.material_slots) == 0:
         bpy.ops.object.material_slot_add()
     obj.material_slots[0].material = material
-    for face in bm.faces:
-        if face.select:
-            face.material_index = 0
-    bmesh.update_edit_mesh(obj.data)
+    mesh = obj.data
+    material_index = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", material_index)
+    material_index[face_select] = 0
+    mesh.polygons.foreach_set("material_index", material_index)
+    write_face_selection(mesh, face_select, loop_start, loop_verts, loop_edges)
+    mesh.update()
+    return road2vert, ground2vert
 
 
-def create_masks(reference_points, road_type_list, ground_info, output_path):
-    flat(reference_points, road_type_list, ground_info)
+def create_masks(reference_points, road_type_list, ground_info, output_path, road_index=None, road_raster=None,
+                 chunk_size=0, workers=1):
+    flat(reference_points, road_type_list, ground_info, road_index=road_index, road_raster=road_raster,
+         chunk_size=chunk_size, workers=workers)
     export_scene(output_path=output_path)
\ No newline at end of file
@@ -1,5 +1,5 @@
 import bpy
-import bmesh
+import numpy as np
 
 def cut_selected_mesh_xz(x_min, x_max, z_min, z_max, mesh_name=None):
     # 如果有名字，主动选中
@@ -14,18 +14,26 @@ def cut_selected_mesh_xz(x_min, x_max, z_min, z_max, mesh_name=None):
         if obj is None or obj.type != 'MESH':
             raise Exception("请选中一个 mesh 对象！")
     
+    # 在 OBJECT 模式下批量读取顶点，用 NumPy 掩码一次算出范围外的顶点
+    bpy.ops.object.mode_set(mode='OBJECT')
+    mesh = obj.data
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    mw = np.array(obj.matrix_world)
+    world_coords = co.reshape(-1, 3) @ mw[:3, :3].T + mw[:3, 3]
+    outside = ((world_coords[:, 0] < x_min) | (world_coords[:, 0] > x_max) |
+               (world_coords[:, 2] < z_min) | (world_coords[:, 2] > z_max))
+    if not outside.any():
+        print("没有需要裁剪的顶点。")
+        return
+    mesh.polygons.foreach_set("select", np.zeros(len(mesh.polygons), dtype=bool))
+    mesh.edges.foreach_set("select", np.zeros(len(mesh.edges), dtype=bool))
+    mesh.vertices.foreach_set("select", outside)
     bpy.ops.object.mode_set(mode='EDIT')
-    bm = bmesh.from_edit_mesh(obj.data)
-    bm.verts.ensure_lookup_table()
-    bpy.ops.mesh.select_all(action='DESELECT')
-    for v in bm.verts:
-        world_coord = obj.matrix_world @ v.co
-        if world_coord.x < x_min or world_coord.x > x_max or world_coord.z < z_min or world_coord.z > z_max:
-            v.select = True
-    bmesh.update_edit_mesh(obj.data)
+    bpy.ops.mesh.select_mode(type='VERT')
     bpy.ops.mesh.delete(type='VERT')
     bpy.ops.object.mode_set(mode='OBJECT')
-    print("已完成软裁边（顶点删除）！")
+    print(f"已完成软裁边（删除 {int(outside.sum())} 个顶点）！")
 
 # 用法：
 # cut_selected_mesh_xz(-400, 400, -400, 400, mesh_name='你的mesh名字')
\ No newline at end of file
@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+
+DEFAULT_TTL = 7 * 24 * 3600  # 一周
+
+
+class OSMCache:
+    """
+    Overpass / OSM 响应的磁盘缓存，按 (查询类型, lat, lng, radius) 的内容哈希寻址。
+
+    - cache_dir 为 None 时直接透传到网络请求，不做缓存；
+    - ttl 秒内的缓存直接复用，过期后重新请求；
+    - offline=True 时只读缓存（回放模式），缓存缺失直接报错，不访问网络。
+    """
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL, offline=False):
+        if offline and cache_dir is None:
+            raise ValueError("offline mode requires a cache_dir")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(kind, lat, lng, radius):
+        payload = json.dumps([kind, round(float(lat), 7), round(float(lng), 7), float(radius)])
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def path(self, kind, lat, lng, radius, fmt="json"):
+        return os.path.join(self.cache_dir, f"{kind}_{self.key(kind, lat, lng, radius)}.{fmt}")
+
+    def fetch(self, kind, lat, lng, radius, fetch_fn, fmt="json"):
+        """
+        读取缓存，未命中或过期时调用 fetch_fn(lat, lng, radius) 并写回缓存。
+        fmt 为 "json"（Overpass 原始响应）或 "pkl"（如 osmnx 返回的 GeoDataFrame）。
+        fetch_fn 返回 None 时视为请求失败，不写缓存。
+        """
+        if self.cache_dir is None:
+            return fetch_fn(lat, lng, radius)
+
+        path = self.path(kind, lat, lng, radius, fmt)
+        if os.path.isfile(path) and (self.offline or time.time() - os.path.getmtime(path) < self.ttl):
+            print(f"Using cached {kind} response: {path}")
+            return self._load(path, fmt)
+        if self.offline:
+            raise FileNotFoundError(f"Offline mode: no cached {kind} response for ({lat}, {lng}, {radius}) at {path}")
+
+        data = fetch_fn(lat, lng, radius)
+        if data is not None:
+            self._dump(data, path, fmt)
+        return data
+
+    @staticmethod
+    def _load(path, fmt):
+        if fmt == "json":
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def _dump(data, path, fmt):
+        # 先写临时文件再原子替换，避免中断时留下半个缓存文件
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        if fmt == "json":
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        else:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,146 @@
+"""
+本地 Overpass 替身服务，用于在无网络环境下测试 / 基准测试 stage 2。
+
+- 若 --cache_dir 中存在 OSMCache 记录的同一查询的响应，则原样回放；
+- 否则根据查询里的 around:(rad, lat, lng) 生成一个规则的合成街区（道路网格、建筑、公园）。
+
+用法：
+    python src/stage2/overpass_stub.py --port 8765 --cache_dir <osm_cache>
+    OVERPASS_URL=http://127.0.0.1:8765/api/interpreter blender -b --python src/align_mask.py -- ...
+"""
+import os
+import re
+import sys
+import json
+import math
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from osm_cache import OSMCache
+
+EARTH_RADIUS = 6371000
+AROUND_PATTERN = re.compile(r"around:([\d.]+),(-?[\d.]+),(-?[\d.]+)")
+HIGHWAY_TYPES = ["primary", "residential", "tertiary", "service", "footway", "cycleway"]
+
+
+def query_kind(query):
+    kinds = [kind for kind, keyword in (("roads", '"highway"'), ("buildings", '"building"'), ("grounds", '"leisure"'))
+             if keyword in query]
+    if len(kinds) > 1:
+        return "combined"
+    return kinds[0] if kinds else "grounds"
+
+
+def synthetic_response(kind, lat, lng, rad, block=100.0, node_step=20.0, first_id=1):
+    """
+    生成以 (lat, lng) 为中心、半径 rad 内的规则街区，返回 Overpass JSON
+    """
+    if kind == "combined":
+        elements = []
+        for i, sub_kind in enumerate(("roads", "buildings", "grounds")):
+            elements += synthetic_response(sub_kind, lat, lng, rad, block, node_step, first_id=(i + 1) * 10 ** 7)["elements"]
+        return {"version": 0.6, "generator": "overpass_stub", "elements": elements}
+    elements = []
+    next_id = [first_id]
+
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+
+    def add_node(x, z):
+        node_id = new_id()
+        elements.append({
+            "type": "node", "id": node_id,
+            "lat": lat - math.degrees(z / EARTH_RADIUS),
+            "lon": lng + math.degrees(x / (EARTH_RADIUS * math.cos(math.radians(lat)))),
+        })
+        return node_id
+
+    def add_way(coords, tags):
+        if coords[0] == coords[-1]:
+            node_ids = [add_node(x, z) for x, z in coords[:-1]]
+            node_ids.append(node_ids[0])
+        else:
+            node_ids = [add_node(x, z) for x, z in coords]
+        elements.append({"type": "way", "id": new_id(), "nodes": node_ids, "tags": tags})
+
+    lines = [i * block for i in range(-int(rad // block), int(rad // block) + 1)]
+    if kind == "roads":
+        steps = [i * node_step - rad for i in range(int(2 * rad // node_step) + 1)]
+        for i, c in enumerate(lines):
+            tags = {"highway": HIGHWAY_TYPES[i % len(HIGHWAY_TYPES)]}
+            add_way([(s, c) for s in steps], dict(tags, name=f"Street {i}"))
+            add_way([(c, s) for s in steps], dict(tags, name=f"Avenue {i}"))
+    else:
+        for i, x in enumerate(lines[:-1]):
+            for j, z in enumerate(lines[:-1]):
+                cx, cz = x + block / 2, z + block / 2
+                if kind == "buildings" and (i + j) % 4 != 0:
+                    h = block / 4
+                    tags = {"building": "yes"}
+                elif kind == "grounds" and (i + j) % 4 == 0:
+                    h = block / 3
+                    tags = {"leisure": "park"}
+                else:
+                    continue
+                add_way([(cx - h, cz - h), (cx + h, cz - h), (cx + h, cz + h), (cx - h, cz + h), (cx - h, cz - h)], tags)
+    return {"version": 0.6, "generator": "overpass_stub", "elements": elements}
+
+
+class OverpassStubHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def _respond(self, body, content_type="application/json"):
+        payload = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, params):
+        if urlparse(self.path).path.endswith("/status"):
+            self._respond("Connected as: 0\nRate limit: 0\n2 slots available now.\nCurrently running queries:\n",
+                          content_type="text/plain")
+            return
+        query = params.get("data", [""])[0]
+        match = AROUND_PATTERN.search(query)
+        if match is None:
+            self._respond(json.dumps({"elements": []}))
+            return
+        rad, lat, lng = (float(v) for v in match.groups())
+        kind = query_kind(query)
+        if self.cache is not None and kind != "grounds":
+            path = self.cache.path(kind, lat, lng, rad, "json")
+            if os.path.isfile(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    self._respond(f.read())
+                return
+        self._respond(json.dumps(synthetic_response(kind, lat, lng, rad)))
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self._handle(parse_qs(self.rfile.read(length).decode("utf-8")))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, cache_dir=None):
+    OverpassStubHandler.cache = OSMCache(cache_dir) if cache_dir else None
+    server = ThreadingHTTPServer(("127.0.0.1", port), OverpassStubHandler)
+    print(f"Overpass stub listening on http://127.0.0.1:{port}/api/interpreter")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Overpass API")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--cache_dir", type=str, default=None, help="OSMCache directory whose recorded responses are replayed")
+    args = parser.parse_args()
+    serve(args.port, args.cache_dir)
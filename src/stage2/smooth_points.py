@@ -34,50 +34,105 @@ def surface_fit_with_minimal_y_change(points):
     return adjusted_points, (A, B, C, D, E, F)
 
 
-def smooth_sampled_points(all_road_data, all_ground_data, ground_polygons):
+def fit_planes_batched(point_sets, regularization=2.0, iterations=30, eps=1e-8):
+    """
+    对多组点同时拟合平面 y = B * x + D * z + F：
+        min sum((B * x + D * z + F - y) ** 2) + regularization * n * (|B| + |D|)
+    与 surface_fit_with_minimal_y_change 一样每个点计一份 L1 正则。中心化后 F 有闭式解，
+    (B, D) 的 L1 项用 IRLS 迭代，所有组的 2x2 正规方程堆叠为 (G, 2, 2) 一次求解。
+    返回与 surface_fit_with_minimal_y_change 相同格式的 (A, B, C, D, E, F) 列表，A = C = E = 0
+    """
+    if len(point_sets) == 0:
+        return []
+    counts = np.array([len(points) for points in point_sets])
+    points = np.concatenate([np.asarray(points)[:, :3] for points in point_sets]).astype(np.float64)
+    group = np.repeat(np.arange(len(point_sets)), counts)
+
+    def group_sum(values):
+        return np.bincount(group, weights=values, minlength=len(point_sets))
+
+    mean = np.stack([group_sum(points[:, axis]) for axis in range(3)], axis=1) / counts[:, None]
+    xc, yc, zc = (points - mean[group]).T
+    gram = np.empty((len(point_sets), 2, 2))
+    gram[:, 0, 0] = group_sum(xc * xc)
+    gram[:, 0, 1] = gram[:, 1, 0] = group_sum(xc * zc)
+    gram[:, 1, 1] = group_sum(zc * zc)
+    rhs = np.stack((group_sum(xc * yc), group_sum(zc * yc)), axis=1)[..., None]
+
+    # |c| 的 IRLS 上界：|c| <= c^2 / (2|c_prev|) + |c_prev| / 2，代入后正规方程的对角项为 regularization * n / 2 / |c_prev|；
+    # 初值取 |c_prev| = 1（即岭回归），对共线的道路点同样适定
+    penalty = regularization * counts[:, None] / 2
+    coef = np.ones((len(point_sets), 2))
+    diag = np.zeros_like(gram)
+    for _ in range(iterations):
+        diag[:, [0, 1], [0, 1]] = penalty / np.maximum(np.abs(coef), eps)
+        coef = np.linalg.solve(gram + diag, rhs)[..., 0]
+    coef[np.abs(coef) <= eps] = 0.0
+
+    B, D = coef[:, 0], coef[:, 1]
+    F = mean[:, 1] - B * mean[:, 0] - D * mean[:, 2]
+    return [(0.0, b, 0.0, d, 0.0, f) for b, d, f in zip(B, D, F)]
+
+
+def neighborhood_min(tree, query_points, values, k, chunk_size=20000):
+    """
+    每个查询点 k 近邻（含自身）中 values 的最小值。
+    分块做批量 cKDTree.query(workers=-1)，避免 (N, k) 的索引矩阵一次占满内存
+    """
+    k = min(k, tree.n)
+    result = np.empty(len(query_points))
+    for start in tqdm(range(0, len(query_points), chunk_size), desc="Neighborhood min"):
+        _, indices = tree.query(query_points[start:start + chunk_size], k=k, workers=-1)
+        result[start:start + chunk_size] = values[indices.reshape(-1, k)].min(axis=1)
+    return result
+
+
+def smooth_sampled_points(all_road_data, all_ground_data, ground_polygons, plane_solver="batched"):
+    """
+    plane_solver: "batched" 用 fit_planes_batched 一次拟合所有道路与地面；
+                  "least_squares" 为逐个调用 surface_fit_with_minimal_y_change 的原实现
+    """
     road_info_dict = {}
     ground_info_dict = {}
 
     output_data = []
     output_all_data = []
 
-    road_idx = 0
-    for highway, data in all_road_data:
-        if len(data) > 0:
-            adjusted_data, road_param = surface_fit_with_minimal_y_change(data)
-            road_idx_column = np.full((adjusted_data.shape[0], 1), road_idx)
+    road_items = [(highway, data) for highway, data in all_road_data if len(data) > 0]
+    ground_items = [(data, polygon) for data, polygon in zip(all_ground_data, ground_polygons) if len(data) > 0]
+    if plane_solver == "batched":
+        params = fit_planes_batched([data for _, data in road_items] + [data for data, _ in ground_items])
+    else:
+        params = [surface_fit_with_minimal_y_change(data)[1] for _, data in road_items] + \
+                 [surface_fit_with_minimal_y_change(data)[1] for data, _ in ground_items]
+    road_params, ground_params = params[:len(road_items)], params[len(road_items):]
+
+    for road_idx, ((highway, data), road_param) in enumerate(zip(road_items, road_params)):
+        A, B, C, D, E, F = road_param
+        adjusted_data = np.column_stack((data[:, 0], B * data[:, 0] + D * data[:, 2] + F, data[:, 2]))
+        road_idx_column = np.full((adjusted_data.shape[0], 1), road_idx)
 
-            adjusted_data = np.hstack((adjusted_data, road_idx_column))
-            data = np.hstack((data, road_idx_column))
+        adjusted_data = np.hstack((adjusted_data, road_idx_column))
+        data = np.hstack((data, road_idx_column))
 
-            output_data.append(adjusted_data)
-            output_all_data.append(data)
+        output_data.append(adjusted_data)
+        output_all_data.append(data)
 
-            road_info_dict[road_idx] = {
-                "type": highway,
-                "param": road_param
-            }
-            road_idx += 1
+        road_info_dict[road_idx] = {
+            "type": highway,
+            "param": road_param
+        }
     street_view_loc_clean_smooth = np.concatenate(output_data, axis=0)
     output_all_data = np.concatenate(output_all_data, axis=0)
-    street_view_loc_clean_all = []
     tree = cKDTree(output_all_data[:, [0, 1]])
-    for datapoint in tqdm(output_all_data):
-        if tree.query(datapoint[[0, 1]], k=400):
-            y_min = output_all_data[tree.query(datapoint[[0, 1]], k=300)[1]][:, 2].min()
-            if datapoint[2] < y_min + 2.0:
-                street_view_loc_clean_all.append(datapoint)
-    street_view_loc_clean_all = np.array(street_view_loc_clean_all)
+    y_min = neighborhood_min(tree, output_all_data[:, [0, 1]], output_all_data[:, 2], k=300)
+    street_view_loc_clean_all = output_all_data[output_all_data[:, 2] < y_min + 2.0]
 
     # process grounds
-    ground_idx = 0
-    for ground_data, polygon in zip(all_ground_data, ground_polygons):
-        if len(ground_data) > 0:
-            _, ground_param = surface_fit_with_minimal_y_change(ground_data)
-            ground_info_dict[ground_idx] = {
-                "polygon": polygon,
-                "param": ground_param
-            }
-            ground_idx += 1
+    for ground_idx, ((ground_data, polygon), ground_param) in enumerate(zip(ground_items, ground_params)):
+        ground_info_dict[ground_idx] = {
+            "polygon": polygon,
+            "param": ground_param
+        }
 
     return road_info_dict, street_view_loc_clean_smooth, street_view_loc_clean_all, ground_info_dict